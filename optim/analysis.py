@@ -23,7 +23,6 @@ Contains the methods used to quantify the "goodness" of fit
 between model and observed parameters
 """
 
-import functools
 import math
 import sys
 
@@ -46,31 +45,43 @@ def load_space(fname):
     space['plot_label'] = [b2s(n) for n in space['plot_label']]
     return space
 
-def npsum(f):
-    """Return the array-wise sum of the returned array"""
-    @functools.wraps(f)
-    def wrapper(*args):
-        return np.sum(f(*args))
-    return wrapper
+def chi2_batch(obs, mod, err):
+    """Like chi2, but for the model values of several particles at once:
+    obs, mod and err broadcast to (nparticles, nobs) arrays, and one value
+    per particle is returned"""
+    obs, mod, err = np.broadcast_arrays(*[np.atleast_2d(a) for a in (obs, mod, err)])
+    return np.sum((mod - obs) ** 2 / (err ** 2), axis=1)
 
-@npsum
-def chi2(obs, mod, err):
-    return (mod - obs) ** 2 / (err ** 2)
-
-@npsum
-def studentT(obs, mod, err):
+def studentT_batch(obs, mod, err):
+    """Like studentT, but for the model values of several particles at once,
+    like chi2_batch. The log of the distribution is calculated directly
+    (with the log of the Gamma function), so it doesn't overflow for large nu"""
+    obs, mod, err = np.broadcast_arrays(*[np.atleast_2d(a) for a in (obs, mod, err)])
     sigma = (obs - mod) / err
-    var = sum(sigma ** 2 / len(sigma))
+    var = np.sum(sigma ** 2, axis=1, keepdims=True) / sigma.shape[1]
     nu = (2 * var) / (var - 1)
     x = (mod - obs) ** 2 / err
-    t = (
-        (scipy.special.gamma((nu + 1) / 2.0))
-        / ((nu * math.pi) ** (0.5) * scipy.special.gamma(nu / 2.0))
-        * (1 + x / nu) ** (-1 * (nu + 1) / 2.0)
-    )
-    return np.log(t)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        logt = (
+            scipy.special.gammaln((nu + 1) / 2.0)
+            - scipy.special.gammaln(nu / 2.0)
+            - 0.5 * np.log(nu * math.pi)
+            - (nu + 1) / 2.0 * np.log1p(x / nu)
+        )
+    return np.sum(logt, axis=1)
+
+def chi2(obs, mod, err):
+    return chi2_batch(obs, mod, err)[0]
+
+def studentT(obs, mod, err):
+    return studentT_batch(obs, mod, err)[0]
 
 stat_tests = {
     'student-t': studentT,
     'chi2': chi2
-}
\ No newline at end of file
+}
+
+batch_stat_tests = {
+    'student-t': studentT_batch,
+    'chi2': chi2_batch
+}
@@ -0,0 +1,100 @@
+#
+# ICRAR - International Centre for Radio Astronomy Research
+# (c) UWA - The University of Western Australia, 2019
+# Copyright by UWA (in the framework of the ICRAR)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""
+A persistent cache of the evaluations of shark parameter sets
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+def _binary_version(program):
+    """Identifies the given program (looked up in $PATH if it has no
+    directory) by its real path, size and modification time, so a rebuilt
+    binary doesn't reuse the evaluations of the previous one"""
+    candidates = [program]
+    if not os.path.dirname(program):
+        candidates = [os.path.join(d, program) for d in os.environ.get('PATH', '').split(os.pathsep)] + candidates
+    for fname in candidates:
+        if os.path.isfile(fname):
+            fname = os.path.realpath(fname)
+            st = os.stat(fname)
+            return '%s:%d:%r' % (fname, st.st_size, st.st_mtime)
+    return program
+
+class EvaluationCache(object):
+    """Stores the per-constraint statistics of evaluated particles on disk,
+    so particles evaluated before (e.g., by earlier iterations, or by a
+    previous optimization) don't need to run shark again.
+
+    Entries are keyed by the contents of the shark configuration file, the
+    shark binary (its path, size and modification time), the particle's parameter values (to `digits` significant digits), the
+    subvolumes, the constraints (with their domains) and the stat test.
+    Each entry is a small JSON file written atomically, so the same cache
+    directory can be shared by concurrent processes and optimizations."""
+
+    def __init__(self, cache_dir, config, shark_binary, space, subvols, constraints, stat_test, digits=10):
+        with open(config, 'rb') as f:
+            config_hash = hashlib.md5(f.read()).hexdigest()
+        self.cache_dir = cache_dir
+        self.space = space
+        self.digits = digits
+        self.base_key = 'config=%s shark=%s subvolumes=%s constraints=%s stat_test=%s' % (
+            config_hash, _binary_version(shark_binary), ','.join(map(str, subvols)),
+            ','.join('%s(%r-%r)' % (c.__class__.__name__, c.domain[0], c.domain[1]) for c in constraints),
+            stat_test)
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+
+    def _key(self, particle):
+        values = ' '.join('%s%s=%.*g' % (name, '(log)' if is_log else '', self.digits, value)
+                          for value, name, is_log in zip(particle, self.space['name'], self.space['is_log']))
+        return '%s %s' % (self.base_key, values)
+
+    def _fname(self, key):
+        return os.path.join(self.cache_dir, hashlib.md5(key.encode('utf8')).hexdigest() + '.json')
+
+    def get(self, particle):
+        """Returns the list of per-constraint statistics stored for particle,
+        or None if it hasn't been evaluated yet"""
+        key = self._key(particle)
+        try:
+            with open(self._fname(key)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('key') != key:
+            return None
+        logger.info('Found evaluation of particle %r in cache', particle)
+        return entry['stats']
+
+    def put(self, particle, stats):
+        """Stores the per-constraint statistics of particle"""
+        key = self._key(particle)
+        fname = self._fname(key)
+        tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+        with open(tmp_fname, 'wt') as f:
+            json.dump({'key': key, 'stats': [float(s) for s in stats]}, f)
+        os.rename(tmp_fname, fname)
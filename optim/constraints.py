@@ -22,6 +22,7 @@
 Constraints for optimizers to evaluate shark models against observations
 """
 
+import collections
 import os
 
 import common
@@ -40,25 +41,89 @@ dm = 0.2
 mbins = np.arange(mlow, mupp, dm)
 xmf = mbins + dm/2.0
 
-mlow2 = 5
-mupp2 = 14
-dm2 = 0.3
-mbins2 = np.arange(mlow2,mupp2,dm2)
-xmf2 = mbins2 + dm2/2.0
 
-ssfrlow = -6
-ssfrupp = 4
-dssfr = 0.2
-ssfrbins = np.arange(ssfrlow,ssfrupp,dssfr)
-
-
-# These are two easily create variables of these different shapes without
-# actually storing a reference ourselves; we don't need it
-zeros1 = lambda: np.zeros(shape=(1, 3, len(xmf)))
-zeros2 = lambda: np.zeros(shape=(1, 3, len(xmf2)))
-zeros3 = lambda: np.zeros(shape=(1, len(mbins)))
-zeros4 = lambda: np.empty(shape=(1), dtype=np.bool_)
-zeros5 = lambda: np.zeros(shape=(1, len(ssfrbins)))
+# The model histograms constraints compare against. Each is calculated from
+# the few (derived) galaxy properties it needs, so only those are read
+def _hist_smf(data):
+    return np.histogram(data['log_mstars'], bins=np.append(mbins,mupp))[0]
+
+def _hist_HImf(data):
+    matom = data['matom']
+    mass_atom = np.zeros(shape = len(matom))
+    ind = np.where(matom > 0)
+    mass_atom[ind] = np.log10(matom[ind]) - np.log10(float(data['h0'])) + np.log10(smf.XH)
+    return np.histogram(mass_atom, bins=np.append(mbins,mupp))[0]
+
+_histograms = {
+    'smf': (('log_mstars',), _hist_smf),
+    'HImf': (('matom',), _hist_HImf),
+}
+
+def model_histograms(modeldir, subvols, redshift_table, requests):
+    """Returns h0 and a dictionary with the log10 of the histograms requested
+    as (z, histogram name) pairs, keyed by them. Each snapshot is read once,
+    and only the fields needed by the histograms requested at it are read"""
+
+    if  len(subvols) > 1:
+        subvols = ["multiple_batches"]
+
+    requests_per_snapshot = collections.OrderedDict()
+    for z, name in requests:
+        snapshot_requests = requests_per_snapshot.setdefault(redshift_table[z], [])
+        if (z, name) not in snapshot_requests:
+            snapshot_requests.append((z, name))
+
+    h0, hists = None, {}
+    for snapshot, snapshot_requests in requests_per_snapshot.items():
+        fields = []
+        for _, name in snapshot_requests:
+            fields += [f for f in _histograms[name][0] if f not in fields]
+        data = common.read_catalogue(modeldir, snapshot, {'derived': tuple(fields)}, subvols)
+        h0, volh = data['h0'], data['vol']
+        vol = volh/pow(h0,3.)  # In Mpc^3
+        for z, name in snapshot_requests:
+            H = _histograms[name][1](data)
+            hist = H/vol/dm if volh > 0 else H.astype(float)
+            ind = np.where(hist > 0.)
+            hist[ind] = np.log10(hist[ind])
+            hists[z, name] = hist
+
+    return h0, hists
+
+class ModelData(object):
+    """The model data of a single evaluation (i.e., of one shark output), to be
+    shared by all the constraints evaluated on it.
+
+    The histograms needed by the given constraints are grouped by snapshot.
+    The first time a histogram is requested its snapshot is read, and all the
+    histograms needed at that snapshot are calculated at once"""
+
+    def __init__(self, modeldir, subvols, redshift_table, constraints):
+        self.modeldir = modeldir
+        self.subvols = subvols
+        self.redshift_table = redshift_table
+        self.requests = [(z, c.histogram) for c in constraints for z in c.z]
+        self.h0 = None
+        self.hists = {}
+
+    def histogram(self, z, name):
+        """Returns the log10 of the named histogram at redshift z"""
+        if (z, name) not in self.hists:
+            snapshot = self.redshift_table[z]
+            requests = [(z, name)] + [r for r in self.requests
+                                      if self.redshift_table[r[0]] == snapshot and r not in self.hists]
+            self.h0, hists = model_histograms(self.modeldir, self.subvols, self.redshift_table, requests)
+            self.hists.update(hists)
+        return self.hists[z, name]
+
+def get_all_data(constraints, modeldir, subvols):
+    """Returns the result of get_data for all constraints, reading each
+    snapshot only once for all of them"""
+    model_data = ModelData(modeldir, subvols, constraints[0].redshift_table, constraints)
+    return [c.get_data(modeldir, subvols, model_data) for c in constraints]
+
+# Observations don't change, so they are loaded only once per process
+_observations = {}
 
 class Constraint(object):
     """Base classes for constraint objects"""
@@ -66,62 +131,36 @@ class Constraint(object):
     def __init__(self):
         self.redshift_table = None
 
-    def _load_model_data(self, modeldir, subvols):
-
-        if  len(subvols) > 1:
-            subvols = ["multiple_batches"]
-
-        # Histograms we are interested in
-        hist_smf = zeros3()
-        hist_HImf = zeros3()
-
-        fields = {
-            'galaxies': (
-                'sfr_disk', 'sfr_burst', 'mstars_disk', 'mstars_bulge',
-                'rstar_disk', 'm_bh', 'matom_disk', 'mmol_disk', 'mgas_disk',
-                'matom_bulge', 'mmol_bulge', 'mgas_bulge',
-                'mgas_metals_disk', 'mgas_metals_bulge',
-                'mstars_metals_disk', 'mstars_metals_bulge', 'type',
-                'mvir_hosthalo', 'rstar_bulge')
-        }
-
-        for index, z in enumerate(self.z):
-            hdf5_data = common.read_data(modeldir, self.redshift_table[z], fields, subvols)
-            h0 = hdf5_data[0]
-            smf.prepare_data(hdf5_data, index, hist_smf, zeros3(), zeros3(),
-                             zeros3(), zeros3(), hist_HImf, zeros3(), zeros3(),
-                             zeros3(), zeros3(), zeros3(), zeros1(), zeros1(),
-                             zeros1(), zeros1(), zeros1(), zeros1(), zeros1(),
-                             zeros1(), zeros1(), zeros1(), zeros1(), zeros1(),
-                             zeros1(), zeros4(), zeros4(), zeros2(), zeros5(),
-                             zeros1(), zeros1(), zeros1(), zeros1(), zeros1(),
-                             zeros1())
-
-        #########################
-        # take logs
-        ind = np.where(hist_smf > 0.)
-        hist_smf[ind] = np.log10(hist_smf[ind])
-        ind = np.where(hist_HImf > 0.)
-        hist_HImf[ind] = np.log10(hist_HImf[ind])
-
-        return h0, hist_smf, hist_HImf
-
-    def load_observation(self, *args, **kwargs):
-        obsdir = os.path.normpath(os.path.abspath(os.path.join(__file__, '..', '..', 'data')))
-        return common.load_observation(obsdir, *args, **kwargs)
-
-    def _get_raw_data(self, modeldir, subvols):
+    def _load_model_data(self, modeldir, subvols, model_data=None):
+        if model_data is None:
+            model_data = ModelData(modeldir, subvols, self.redshift_table, [self])
+        hist = np.array([model_data.histogram(z, self.histogram) for z in self.z])
+        return model_data.h0, hist
+
+    def load_observation(self, fname, cols):
+        key = (fname, tuple(cols))
+        if key not in _observations:
+            obsdir = os.path.normpath(os.path.abspath(os.path.join(__file__, '..', '..', 'data')))
+            data = common.load_observation(obsdir, fname, cols)
+            for col in data:
+                col.flags.writeable = False
+            _observations[key] = data
+        return _observations[key]
+
+    def _get_raw_data(self, modeldir, subvols, model_data=None):
         """Gets the model and observational data for further analysis.
         The model data is interpolated to match the observation's X values."""
 
-        h0, hist_smf, hist_HImf = self._load_model_data(modeldir, subvols)
+        h0, hist = self._load_model_data(modeldir, subvols, model_data)
         x_obs, y_obs, y_dn, y_up = self.get_obs_x_y_err(h0)
-        x_mod, y_mod = self.get_model_x_y(hist_smf, hist_HImf)
+        x_mod, y_mod = self.get_model_x_y(hist)
         return x_obs, y_obs, y_dn, y_up, x_mod, y_mod
 
-    def get_data(self, modeldir, subvols):
+    def get_data(self, modeldir, subvols, model_data=None):
+        """Returns the observed and model Y values within the domain, and their
+        errors. model_data can be a ModelData shared with other constraints"""
 
-        x_obs, y_obs, y_dn, y_up, x_mod, y_mod = self._get_raw_data(modeldir, subvols)
+        x_obs, y_obs, y_dn, y_up, x_mod, y_mod = self._get_raw_data(modeldir, subvols, model_data)
 
         # Linearly interpolate model Y values respect to the observations'
         # X values, and only take those within the domain.
@@ -137,6 +176,7 @@ class HIMF(Constraint):
 
     domain = (7, 12)
     z = [0]
+    histogram = 'HImf'
 
     def get_obs_x_y_err(self, h0):
         # Load Jones18 data and correct data for their choice of cosmology
@@ -150,7 +190,7 @@ class HIMF(Constraint):
         y_up = dpupHI
         return x_obs, y_obs, y_dn, y_up
 
-    def get_model_x_y(self, _, hist_HImf):
+    def get_model_x_y(self, hist_HImf):
         y = hist_HImf[0]
         ind = np.where(y < 0.)
         return xmf[ind], y[ind]
@@ -159,8 +199,9 @@ class SMF(Constraint):
     """Common logic for SMF constraints"""
 
     domain = (8, 13)
+    histogram = 'smf'
 
-    def get_model_x_y(self, hist_smf, _):
+    def get_model_x_y(self, hist_smf):
         y = hist_smf[0,:]
         ind = np.where(y < 0.)
         return xmf[ind], y[ind]
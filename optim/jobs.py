@@ -0,0 +1,207 @@
+#
+# ICRAR - International Centre for Radio Astronomy Research
+# (c) UWA - The University of Western Australia, 2019
+# Copyright by UWA (in the framework of the ICRAR)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""
+Backends submitting shark executions for a set of particles, and telling
+when each of them finishes
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+
+
+logger = logging.getLogger(__name__)
+
+if sys.version_info[0] == 3:
+    b2s = lambda b: b.decode('ascii')
+else:
+    b2s = lambda b: b
+
+def count_jobs(job_name):
+    """Returns how many jobs with self.jobs_name are currently queued or running"""
+
+    try:
+        out, err, code = common.exec_command("squeue")
+    except OSError:
+        raise RuntimeError("Couldn't run squeue, is it installed?")
+
+    if code:
+        raise RuntimeError("squeue failed with code %d: stdout: %s, stderr: %s" % (code, out, err))
+
+    lines_with_jobname = [l for l in b2s(out).splitlines() if job_name in l]
+    return len(lines_with_jobname)
+
+def exec_shark(msg, cmdline):
+    logger.info('%s with command line: %s', msg, subprocess.list2cmdline(cmdline))
+    out, err, code = common.exec_command(cmdline)
+    if code != 0:
+        logger.error('Error while executing %s (exit code %d):\n' +
+                     'stdout:\n%s\nstderr:\n%s', cmdline[0], code, b2s(out), b2s(err))
+        raise RuntimeError('%s error' % cmdline[0])
+
+
+class SqueueJobs(object):
+    """Submits all particles as a single job via shark-submit, and waits for
+    the whole job to finish by polling squeue"""
+
+    poll_interval = 10
+
+    def __init__(self, opts):
+        self.opts = opts
+
+    def submit(self, shark_options, job_name, outdir, subvols):
+        """Submits one shark execution per list of options in shark_options.
+        The execution for the j-th list writes its output under outdir/j"""
+
+        # Prepare the file that will be used by the shark submission scripts
+        # to determine which values shark will be run for. We put a final \n so the
+        # final line gets properly counted by wc (used by shark-submit)
+        opts = self.opts
+        positions_fname = tempfile.mktemp('particle_positions.txt')
+        logger.info('Creating particle positions file at %s', positions_fname)
+        with open(positions_fname, 'wt') as f:
+            f.write('\n'.join(' '.join('-o "%s"' % option for option in options)
+                              for options in shark_options) + '\n')
+
+        # Submit the execution of multiple shark instances, one for each particle
+        cmdline = ['./shark-submit', '-S', opts.shark_binary, '-w', opts.walltime,
+                   '-n', job_name, '-O', outdir, '-E', positions_fname,
+                   '-V', ' '.join(map(str, subvols))]
+        if opts.account:
+            cmdline += ['-a', opts.account]
+        if opts.queue:
+            cmdline += ['-Q', opts.queue]
+        if opts.nodes:
+            cmdline += ['-N', str(opts.nodes)]
+        else:
+            cmdline += ['-m', opts.memory, '-c', str(opts.cpus)]
+        cmdline.append(opts.config)
+        exec_shark('Queueing PSO particles', cmdline)
+
+    def wait(self, job_name, outdir, n):
+        """Yields the index of each of the n submitted executions as they
+        finish"""
+        while count_jobs(job_name) > 0:
+            time.sleep(self.poll_interval)
+        return iter(range(n))
+
+
+class SentinelJobs(SqueueJobs):
+    """Submits particles like SqueueJobs, but notices each finished execution
+    through the sentinel file that shark-run writes next to its output
+    directory (outdir/j.done, holding its exit code). squeue is only checked
+    now and then to detect jobs that died without writing all sentinels"""
+
+    poll_interval = 1
+    check_interval = 60
+
+    def submit(self, shark_options, job_name, outdir, subvols):
+        # Sentinels of previous submissions into the same directory (e.g., of
+        # an earlier campaign, or before resuming) would be taken as ours
+        for j in range(len(shark_options)):
+            try:
+                os.remove(os.path.join(outdir, '%d.done' % j))
+            except OSError:
+                pass
+        super(SentinelJobs, self).submit(shark_options, job_name, outdir, subvols)
+
+    def wait(self, job_name, outdir, n):
+        pending = list(range(n))
+        last_check = time.time()
+        while pending:
+            for j in list(pending):
+                code = _read_sentinel(os.path.join(outdir, '%d.done' % j))
+                if code is None:
+                    continue
+                pending.remove(j)
+                if code != 0:
+                    raise RuntimeError('shark execution %d of job %s failed with exit code %d' % (j, job_name, code))
+                yield j
+            if not pending:
+                break
+            if time.time() - last_check >= self.check_interval:
+                # Check the sentinels once more after making sure the job is
+                # gone, in case they were written in between
+                last_check = time.time()
+                if count_jobs(job_name) == 0 and all(_read_sentinel(os.path.join(outdir, '%d.done' % j)) is None for j in pending):
+                    raise RuntimeError('Job %s finished without completing executions %r' % (job_name, pending))
+                continue
+            time.sleep(self.poll_interval)
+
+
+class LocalJobs(object):
+    """Runs each particle as a shark process on the local machine, as a
+    stand-in for a queueing system"""
+
+    poll_interval = 0.1
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.procs = []
+
+    def submit(self, shark_options, job_name, outdir, subvols):
+        opts = self.opts
+        try:
+            os.makedirs(outdir)
+        except OSError:
+            pass
+        self.procs = []
+        for j, options in enumerate(shark_options):
+            cmdline = [opts.shark_binary, opts.config, '-t', str(opts.cpus),
+                       '-o', 'execution.output_directory=%s' % os.path.join(outdir, str(j)),
+                       '-o', 'execution.simulation_batches=%s' % ' '.join(map(str, subvols))]
+            for option in options:
+                cmdline += ['-o', option]
+            logger.info('Starting local shark instance with command line: %s', subprocess.list2cmdline(cmdline))
+            with open(os.path.join(outdir, 'shark_paramset_%d.log' % j), 'wb') as log:
+                self.procs.append(subprocess.Popen(cmdline, stdout=log, stderr=subprocess.STDOUT))
+
+    def wait(self, job_name, outdir, n):
+        pending = list(range(n))
+        while pending:
+            for j in list(pending):
+                code = self.procs[j].poll()
+                if code is None:
+                    continue
+                pending.remove(j)
+                if code != 0:
+                    raise RuntimeError('shark execution %d of job %s failed with exit code %d' % (j, job_name, code))
+                yield j
+            if pending:
+                time.sleep(self.poll_interval)
+
+
+def _read_sentinel(fname):
+    try:
+        with open(fname) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+backends = {
+    'squeue': SqueueJobs,
+    'sentinel': SentinelJobs,
+    'local': LocalJobs,
+}
@@ -24,9 +24,7 @@ import math
 import multiprocessing
 import os
 import shutil
-import subprocess
 import sys
-import tempfile
 import time
 
 def _abspath(p):
@@ -39,42 +37,19 @@ def _abspath(p):
 sys.path.insert(0, _abspath(os.path.join(__file__, '..', '..', 'standard_plots')))
 
 import analysis
+import cache
 import common
 import constraints
+import jobs
 import numpy as np
 import pso
+import surrogate
 
 
 logger = logging.getLogger('main')
 
 if sys.version_info[0] == 3:
-    b2s = lambda b: b.decode('ascii')
     raw_input = input
-else:
-    b2s = lambda b: b
-
-def count_jobs(job_name):
-    """Returns how many jobs with self.jobs_name are currently queued or running"""
-
-    try:
-        out, err, code = common.exec_command("squeue")
-    except OSError:
-        raise RuntimeError("Couldn't run squeue, is it installed?")
-
-    if code:
-        raise RuntimeError("squeue failed with code %d: stdout: %s, stderr: %s" % (code, out, err))
-
-    lines_with_jobname = [l for l in out.splitlines() if job_name in l]
-    return len(lines_with_jobname)
-
-def _exec_shark(msg, cmdline):
-    logger.info('%s with command line: %s', msg, subprocess.list2cmdline(cmdline))
-    out, err, code = common.exec_command(cmdline)
-    if code != 0:
-        logger.error('Error while executing %s (exit code %d):\n' +
-                     'stdout:\n%s\nstderr:\n%s', cmdline[0], code, b2s(out), b2s(err))
-        raise RuntimeError('%s error' % cmdline[0])
-
 
 def _to_shark_options(particle, space):
     """Given `particle` in `space` return an iterable with the corresponding
@@ -85,6 +60,23 @@ def _to_shark_options(particle, space):
         yield '%s=%s' % (name, value)
 
 
+def _lean_output_options(opts, redshift_table):
+    """Returns the shark options that make it write only the snapshots the
+    constraints read, and no star formation histories"""
+    snapshots = set(redshift_table[z] for c in opts.constraints for z in c.z)
+    # shark evolves galaxies only up to the last output snapshot,
+    # which must stay the same for the results to do so
+    snapshots.add(max(common.read_output_snapshots(opts.config)))
+    return ['execution.output_snapshots=%s' % ' '.join(map(str, sorted(snapshots, reverse=True))),
+            'execution.output_sf_histories=false']
+
+
+def _evaluate_constraints(opts, modeldir, subvols, statTest):
+    """Returns the value of statTest for each constraint on the given model"""
+    return [statTest(y_obs, y_mod, err)
+            for y_obs, y_mod, err in constraints.get_all_data(opts.constraints, modeldir, subvols)]
+
+
 count = 0
 def run_shark_hpc(particles, *args):
     """
@@ -99,80 +91,78 @@ def run_shark_hpc(particles, *args):
 
     opts, space, subvols, statTest = args
 
-    # Prepare the file that will be used by the shark submission scripts
-    # to determine which values shark will be run for. We put a final \n so the
-    # final line gets properly counted by wc (used by shark-submit)
-    shark_options = [
-        ' '.join(['-o "%s"' % option for option in _to_shark_options(particle, space)])
-        for particle in particles
-    ]
-    positions_fname = tempfile.mktemp('particle_positions.txt')
-    logger.info('Creating particle positions file at %s', positions_fname)
-    with open(positions_fname, 'wt') as f:
-        f.write('\n'.join(shark_options) + '\n')
-
-    # Submit the execution of multiple shark instances, one for each particle
-    job_name = 'PSOSMF_%d' % count
-    shark_output_base = os.path.join(opts.outdir, job_name)
-    cmdline = ['./shark-submit', '-S', opts.shark_binary, '-w', opts.walltime,
-               '-n', job_name, '-O', shark_output_base, '-E', positions_fname,
-               '-V', ' '.join(map(str, subvols))]
-    if opts.account:
-        cmdline += ['-a', opts.account]
-    if opts.queue:
-        cmdline += ['-Q', opts.queue]
-    if opts.nodes:
-        cmdline += ['-N', str(opts.nodes)]
-    else:
-        cmdline += ['-m', opts.memory, '-c', str(opts.cpus)]
-    cmdline.append(opts.config)
-    _exec_shark('Queueing PSO particles', cmdline)
+    # Particles found in the evaluation cache don't need to run again
+    ss = len(particles)
+    fx = np.zeros([ss, len(opts.constraints)])
+    to_run = []
+    for i, particle in enumerate(particles):
+        stats = opts.eval_cache.get(particle) if opts.eval_cache else None
+        if stats is None:
+            to_run.append(i)
+        else:
+            fx[i] = stats
 
-    # Actually wait for the jobs to finish...
-    while count_jobs(job_name) > 0:
-        time.sleep(10)
+    # this global count just tracks the number of iterations so they can be saved to different files
+    job_name = 'PSOSMF_%d' % count
+    count += 1
 
-    ss = len(particles)
-    fx = np.zeros([ss, 3])
-    for i in range(ss):
+    # Particles are evaluated as soon as their shark execution finishes,
+    # while the rest are still running
+    if to_run:
+        shark_output_base = os.path.join(opts.outdir, job_name)
+        shark_options = [list(_to_shark_options(particles[i], space)) + opts.output_options for i in to_run]
+        opts.jobs.submit(shark_options, job_name, shark_output_base, subvols)
         _, simu, model, _ = common.read_configuration(opts.config)
-        particle_outdir = os.path.join(shark_output_base, str(i))
-        modeldir = common.get_shark_output_dir(particle_outdir, simu, model)
-        for j, constraint in enumerate(opts.constraints):
-            y_obs, y_mod, err = constraint.get_data(modeldir, subvols)
-            fx[i, j] = statTest(y_obs, y_mod, err)
-        if not opts.keep:
-            shutil.rmtree(particle_outdir)
+        data = {}
+        for j in opts.jobs.wait(job_name, shark_output_base, len(to_run)):
+            i = to_run[j]
+            particle_outdir = os.path.join(shark_output_base, str(j))
+            modeldir = common.get_shark_output_dir(particle_outdir, simu, model)
+            data[i] = constraints.get_all_data(opts.constraints, modeldir, subvols)
+            if not opts.keep:
+                shutil.rmtree(particle_outdir)
+
+        # Each constraint is evaluated for all particles at once
+        batch_test = analysis.batch_stat_tests[opts.stat_test]
+        for k in range(len(opts.constraints)):
+            y_obs, _, err = data[to_run[0]][k]
+            y_mod = np.array([data[i][k][1] for i in to_run])
+            fx[to_run, k] = batch_test(y_obs, y_mod, err)
+        if opts.eval_cache:
+            for i in to_run:
+                opts.eval_cache.put(particles[i], fx[i])
 
     fx = np.sum(fx, 1)
     logger.info('Particles %r evaluated to %r', particles, fx)
 
-    # this global count just tracks the number of iterations so they can be saved to different files
-    count += 1
-
     return fx
 
-
 def run_shark(particle, *args):
 
     opts, space, subvols, statTest = args
 
+    stats = opts.eval_cache.get(particle) if opts.eval_cache else None
+    if stats is not None:
+        total = sum(stats)
+        logger.info('Particle %r evaluated to %f (cached)', particle, total)
+        return total
+
     pid = multiprocessing.current_process().pid
-    shark_output_base = os.path.join(opts.outdir, 'output_%d' % pid)
+    shark_output_base = os.path.join(opts.scratch_dir or opts.outdir, 'output_%d' % pid)
     _, simu, model, _ = common.read_configuration(opts.config)
     modeldir = common.get_shark_output_dir(shark_output_base, simu, model)
 
     cmdline = [opts.shark_binary, opts.config,
                '-o', 'execution.output_directory=%s' % shark_output_base,
                '-o', 'execution.simulation_batches=%s' % ' '.join(map(str, subvols))]
-    for option in _to_shark_options(particle, space):
+    for option in list(_to_shark_options(particle, space)) + opts.output_options:
         cmdline += ['-o', option]
-    _exec_shark('Executing shark instance', cmdline)
+    jobs.exec_shark('Executing shark instance', cmdline)
 
-    total = 0
-    for constraint in opts.constraints:
-        y_obs, y_mod, err = constraint.get_data(modeldir, subvols)
-        total += statTest(y_obs, y_mod, err)
+    stats = _evaluate_constraints(opts, modeldir, subvols, statTest)
+    if opts.eval_cache:
+        opts.eval_cache.put(particle, stats)
+    total = sum(stats)
 
     logger.info('Particle %r evaluated to %f', particle, total)
 
@@ -198,6 +188,8 @@ def setup_logging(outdir):
 
 def main():
 
+    global count
+
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='Configuration file used as the basis for running shark', type=_abspath)
     parser.add_argument('-v', '--subvolumes', help='Comma- and dash-separated list of subvolumes to process', default='0')
@@ -206,6 +198,14 @@ def main():
     parser.add_argument('-o', '--outdir', help='Auxiliary output directory, defaults to .', default=_abspath('.'),
                         type=_abspath)
     parser.add_argument('-k', '--keep', help='Keep temporary output files', action='store_true')
+    parser.add_argument('-l', '--lean-output', action='store_true',
+                        help='Make shark write only the snapshots needed by the constraints, and no star formation histories')
+    parser.add_argument('-L', '--scratch-dir', default=None, type=_abspath,
+                        help=('Directory where shark writes the output of each particle before it is evaluated, '
+                              'e.g., a tmpfs like /dev/shm. Defaults to the output directory. Not available in HPC mode'))
+    parser.add_argument('-e', '--eval-cache', dest='eval_cache_dir', default=None, type=_abspath,
+                        help=('Directory where the evaluation of each particle is cached, so identical '
+                              'particles (also from previous runs) do not run shark again'))
 
     pso_opts = parser.add_argument_group('PSO options')
     pso_opts.add_argument('-s', '--swarm-size', help='Size of the particle swarm. Defaults to 10 + sqrt(D) * 2 (D=number of dimensions)',
@@ -216,12 +216,26 @@ def main():
                           default='space.txt', type=_abspath)
     pso_opts.add_argument('-t', '--stat-test', help='Stat function used to calculate the value of a particle, defaults to student-t',
                           default='student-t', choices=list(analysis.stat_tests.keys()))
+    pso_opts.add_argument('-A', '--async', dest='async_pso', action='store_true',
+                          help=('Update and re-evaluate each particle as soon as its evaluation finishes, '
+                                'instead of waiting for the whole swarm. Not available in HPC mode'))
+    pso_opts.add_argument('-r', '--resume', metavar='TRACKS_DIR', default=None, type=_abspath,
+                          help=('Resume a PSO run from the checkpoint in the given tracks directory, '
+                                'with the same options it was started with. Not available together with -A'))
+    pso_opts.add_argument('-E', '--surrogate-evals', metavar='N', default=None, type=int,
+                          help=('Use the surrogate-assisted PSO, running shark for only the N most promising '
+                                'particles of each iteration. Not available together with -A or -r'))
+    pso_opts.add_argument('-T', '--surrogate-tracks', metavar='TRACKS_DIR', default=[], type=_abspath, action='append',
+                          help='Tracks directory of a previous run with the same setup to train the surrogate with. Can be given more than once')
     pso_opts.add_argument('-x', '--constraints', default='HIMF,SMF_z0,SMF_z1',
                           help=("Comma-separated list of constraints, any of HIMF, SMF_z0 or SMF_z1, defaults to 'HIMF,SMF_z0,SMF_z1'. "
                                 "Can specify a domain range after the name (e.g., 'SMF_z0(8-11)')"))
 
     hpc_opts = parser.add_argument_group('HPC options')
     hpc_opts.add_argument('-H', '--hpc-mode', help='Enable HPC mode', action='store_true')
+    hpc_opts.add_argument('-B', '--hpc-backend', help=('How particles are run and waited for in HPC mode: sentinel files written by shark-run, '
+                                                       'squeue polling, or local shark processes (for testing). Defaults to sentinel'),
+                          default='sentinel', choices=list(jobs.backends.keys()))
     hpc_opts.add_argument('-C', '--cpus', help='Number of CPUs per shark instance', default=1, type=int)
     hpc_opts.add_argument('-M', '--memory', help='Memory needed by each shark instance', default='1500m')
     hpc_opts.add_argument('-N', '--nodes', help='Number of nodes to use', default=None, type=int)
@@ -233,6 +247,16 @@ def main():
 
     if not opts.config:
         parser.error('-c option is mandatory but missing')
+    if opts.scratch_dir and opts.hpc_mode:
+        parser.error('-L cannot be used together with -H')
+    if opts.async_pso and opts.hpc_mode:
+        parser.error('-A cannot be used together with -H')
+    if opts.resume and opts.async_pso:
+        parser.error('-r cannot be used together with -A')
+    if opts.surrogate_evals and (opts.async_pso or opts.resume):
+        parser.error('-E cannot be used together with -A or -r')
+    if opts.resume and not os.path.exists(os.path.join(opts.resume, 'checkpoint.npz')):
+        parser.error('No checkpoint found under %s' % opts.resume)
 
     if opts.shark_binary and not common.has_program(opts.shark_binary):
         parser.error("shark binary '%s' not found, specify a correct one via -b" % opts.shark_binary)
@@ -254,6 +278,7 @@ def main():
     opts.constraints = constraints.parse(opts.constraints)
     for c in opts.constraints:
         c.redshift_table = redshift_table
+    opts.output_options = _lean_output_options(opts, redshift_table) if opts.lean_output else []
 
     # Read search space specification, which is a comma-separated multiline file,
     # each line containing the following elements:
@@ -265,6 +290,12 @@ def main():
     if ss is None:
         ss = 10 + int(2 * math.sqrt(len(space)))
 
+    opts.eval_cache = None
+    if opts.eval_cache_dir:
+        opts.eval_cache = cache.EvaluationCache(opts.eval_cache_dir, opts.config, opts.shark_binary, space, subvols,
+                                                opts.constraints, opts.stat_test)
+
+    opts.jobs = jobs.backends[opts.hpc_backend](opts)
     args = (opts, space, subvols, analysis.stat_tests[opts.stat_test])
 
     if opts.hpc_mode:
@@ -282,6 +313,9 @@ def main():
     logger.info('    Subvolumes to use: %r', subvols)
     logger.info('    Output directory: %s', opts.outdir)
     logger.info('    Keep temporary output files: %d', opts.keep)
+    logger.info('    Lean shark output: %d', opts.lean_output)
+    logger.info('    Scratch directory: %s', opts.scratch_dir if opts.scratch_dir else '')
+    logger.info('    Evaluation cache directory: %s', opts.eval_cache_dir if opts.eval_cache_dir else '')
     logger.info("PSO information:")
     logger.info('    Search space parameters: %s', ' '.join(space['name']))
     logger.info('    Swarm size: %d', ss)
@@ -289,11 +323,14 @@ def main():
     logger.info('    Lower bounds: %r', space['lb'])
     logger.info('    Upper bounds: %r', space['ub'])
     logger.info('    Test function: %s', opts.stat_test)
+    logger.info('    Asynchronous: %d', opts.async_pso)
+    logger.info('    Surrogate-assisted evaluations per iteration: %s', opts.surrogate_evals or '')
     logger.info('Constraints:')
     for c in opts.constraints:
         logger.info('%10s [%.1f - %.1f]' % (c.__class__.__name__, c.domain[0], c.domain[1]))
     logger.info('HPC mode: %d', opts.hpc_mode)
     if opts.hpc_mode:
+        logger.info('    Backend: %s', opts.hpc_backend)
         logger.info('    Account used to submit: %s', opts.account if opts.account else '')
         logger.info('    Queue to submit: %s', opts.queue if opts.queue else '')
         logger.info('    Walltime per submission: %s', opts.walltime)
@@ -311,24 +348,40 @@ def main():
             continue
         break
 
-    # Directory where we store the intermediate results
-    tracksdir = os.path.join(opts.outdir, 'tracks')
+    # Directory where we store the intermediate results, and the checkpoint
+    # with the full state of the PSO after each iteration
+    tracksdir = opts.resume or os.path.join(opts.outdir, 'tracks')
     try:
         os.makedirs(tracksdir)
     except OSError:
         pass
+    checkpoint_fname = os.path.join(tracksdir, 'checkpoint.npz')
+    if opts.resume:
+        count = int(pso.load_checkpoint(checkpoint_fname)['it'])
+        logger.info('Resuming PSO from iteration %d', count)
 
     # Go, go, go!
     logger.info('Starting PSO now')
     tStart = time.time()
     if opts.hpc_mode:
         os.chdir('../hpc')
-    xopt, fopt = pso.pso(f, space['lb'], space['ub'], args=args, swarmsize=ss,
-                         maxiter=opts.max_iterations, processes=procs,
-                         dumpfile_prefix=os.path.join(tracksdir, 'track_%03d'))
+    pso_kwargs = dict(args=args, swarmsize=ss, maxiter=opts.max_iterations, processes=procs,
+                      dumpfile_prefix=os.path.join(tracksdir, 'track_%03d'))
+    if opts.async_pso:
+        xopt, fopt = pso.async_pso(f, space['lb'], space['ub'], **pso_kwargs)
+    elif opts.surrogate_evals:
+        training = [surrogate.load_tracks(d) for d in opts.surrogate_tracks]
+        training = [t for t in training if t[0] is not None]
+        if training:
+            training = tuple(np.concatenate(t) for t in zip(*training))
+            logger.info('Training surrogate with %d previous evaluations', len(training[1]))
+        xopt, fopt = pso.surrogate_pso(f, space['lb'], space['ub'], nevals=opts.surrogate_evals,
+                                       training=training or None, **pso_kwargs)
+    else:
+        xopt, fopt = pso.pso(f, space['lb'], space['ub'], checkpoint_fname=checkpoint_fname,
+                             resume=bool(opts.resume), **pso_kwargs)
     tEnd = time.time()
 
-    global count
     logger.info('Number of iterations = %d', count)
     logger.info('xopt = %r', xopt)
     logger.info('fopt = %r', fopt)
@@ -2,15 +2,25 @@
 #
 # https://github.com/tisimst/pyswarm/tree/master/pyswarm   (original pyswarms code)
 
+import collections
 from functools import partial
+import multiprocessing
+import os
+import pickle
+import sys
+
 import numpy as np
 
+import surrogate
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 def _obj_wrapper(func, args, kwargs, x):
     return func(x, *args, **kwargs)
 
-def _is_feasible_wrapper(func, x):
-    return np.all(func(x)>=0)
-
 def _cons_none_wrapper(x):
     return np.array([0])
 
@@ -19,11 +29,152 @@ def _cons_ieqcons_wrapper(ieqcons, args, kwargs, x):
 
 def _cons_f_ieqcons_wrapper(f_ieqcons, args, kwargs, x):
     return np.array(f_ieqcons(x, *args, **kwargs))
-    
+
+def _setup(func, ieqcons, f_ieqcons, args, kwargs, debug, dumpfile_prefix):
+    """Returns the objective, constraints and dumping functions used by the
+    PSO functions"""
+
+    # Initialize objective function
+    obj = partial(_obj_wrapper, func, args, kwargs)
+
+    # Initialize dumping function if required
+    if dumpfile_prefix:
+        def dump(i, x, fx):
+            np.save(dumpfile_prefix % i + "_fx", fx)
+            np.save(dumpfile_prefix % i + "_pos", x)
+    else:
+        dump = lambda *_: None
+
+    # Check for constraint function(s) #########################################
+    if f_ieqcons is None:
+        if not len(ieqcons):
+            if debug:
+                print('No constraints given.')
+            cons = _cons_none_wrapper
+        else:
+            if debug:
+                print('Converting ieqcons to a single constraint function')
+            cons = partial(_cons_ieqcons_wrapper, ieqcons, args, kwargs)
+    else:
+        if debug:
+            print('Single constraint function given in f_ieqcons')
+        cons = partial(_cons_f_ieqcons_wrapper, f_ieqcons, args, kwargs)
+
+    return obj, cons, dump
+
+def _evaluate_position(obj, cons, combined, x, c=None):
+    """Returns the objective and constraint values at x. The constraints are
+    only evaluated if not given as c, or returned by obj itself if combined"""
+    if combined:
+        fx, c = obj(x)
+        return fx, np.asarray(c)
+    if c is None:
+        c = cons(x)
+    return obj(x), c
+
+def _evaluate_position_wrapper(obj, cons, combined, x_c):
+    return _evaluate_position(obj, cons, combined, *x_c)
+
+def _evaluate_particle(obj, cons, combined, i, x, c):
+    """Returns (i, objective, constraints) at x, or (i, None, error) if the
+    evaluation failed, so errors in pool workers reach async_pso"""
+    try:
+        return (i,) + _evaluate_position(obj, cons, combined, x, c)
+    except Exception as e:
+        return i, None, e
+
+class _Evaluator(object):
+    """Evaluates the objective and feasibility of particles, with a single
+    call (and a single round trip to the pool, if any) per particle.
+
+    The constraint values at each evaluated position are cached, so they are
+    not calculated again for particles stuck at the same position (e.g., at
+    the bounds), nor to check the feasibility of the swarm's best position"""
+
+    def __init__(self, obj, cons, combined, processes, mp_pool=None):
+        self.obj = obj
+        self.cons = cons
+        self.combined = combined
+        self.processes = processes
+        self.mp_pool = mp_pool
+        self.cons_cache = {}
+
+    @staticmethod
+    def _key(x):
+        return np.asarray(x, dtype=float).tobytes()
+
+    def cached(self, x):
+        """Returns the cached constraint values at x, or None"""
+        return self.cons_cache.get(self._key(x))
+
+    def store(self, x, c):
+        """Caches the constraint values c at x, and returns whether they are
+        all satisfied"""
+        c = np.asarray(c)
+        self.cons_cache[self._key(x)] = c
+        return np.all(c >= 0)
+
+    def is_feasible(self, x):
+        c = self.cached(x)
+        if c is None:
+            c = self.obj(x)[1] if self.combined else self.cons(x)
+        return self.store(x, c)
+
+    def __call__(self, x):
+        """Returns the objective values and feasibility of all particles in x"""
+
+        cached = [self.cached(xi) for xi in x]
+        if self.processes > 1:
+            evaluate = partial(_evaluate_position_wrapper, self.obj, self.cons, self.combined)
+            results = self.mp_pool.map(evaluate, list(zip(x, cached)))
+        elif self.processes != 0:
+            results = [_evaluate_position(self.obj, self.cons, self.combined, xi, c)
+                       for xi, c in zip(x, cached)]
+        else:
+            # All particles are given to a single (batch) function
+            if self.combined:
+                fx, cs = self.obj(x)
+            else:
+                fx = self.obj(x)
+                cs = [self.cons(xi) if c is None else c for xi, c in zip(x, cached)]
+            results = list(zip(fx, cs))
+
+        fx = np.array([r[0] for r in results], dtype=float)
+        fs = np.array([self.store(xi, r[1]) for xi, r in zip(x, results)])
+        return fx, fs
+
+def save_checkpoint(fname, it, x, v, p, fp, g, fg):
+    """Saves the state of a pso search, about to start iteration `it`"""
+    rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        np.savez(f, it=it, x=x, v=v, p=p, fp=fp, g=g, fg=fg,
+                 rng_name=rng_name, rng_keys=rng_keys, rng_pos=rng_pos,
+                 rng_has_gauss=rng_has_gauss, rng_cached_gaussian=rng_cached_gaussian)
+    os.rename(tmp_fname, fname)
+
+def load_checkpoint(fname):
+    """Returns the state saved by save_checkpoint as a dictionary"""
+    with np.load(fname) as data:
+        return {name: data[name] for name in data.files}
+
+def _restore_checkpoint(fname, S, D):
+    """Restores numpy's random number generator to the state saved in fname,
+    and returns the search state saved with it"""
+    state = load_checkpoint(fname)
+    if state['x'].shape != (S, D):
+        raise ValueError('Checkpoint in %s is for %d particles with %d dimensions, not %d and %d' %
+                         ((fname,) + state['x'].shape + (S, D)))
+    np.random.set_state((str(state['rng_name']), state['rng_keys'], int(state['rng_pos']),
+                         int(state['rng_has_gauss']), float(state['rng_cached_gaussian'])))
+    return (state['x'], state['v'], state['p'], state['fp'], state['g'],
+            float(state['fg']), int(state['it']))
+
 def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={}, 
         swarmsize=100, omega=0.5, phip=0.5, phig=0.5, maxiter=100, 
         minstep=1e-8, minfunc=1e-8, debug=False, processes=1,
-        particle_output=False, dumpfile_prefix=None):
+        particle_output=False, dumpfile_prefix=None, combined=False,
+        checkpoint_fname=None, resume=False):
     """
     Perform a particle swarm optimization (PSO)
    
@@ -79,6 +230,20 @@ def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
     particle_output : boolean
         Whether to include the best per-particle position and the objective
         values at those.
+    combined : boolean
+        If True, func returns both the objective value and the 1-D array of
+        constraint values at x, so they are calculated in a single call;
+        ieqcons and f_ieqcons are then ignored. If processes = 0, func
+        returns the objective values and the constraint values of all
+        particles instead (Default: False)
+    checkpoint_fname : str
+        If given, the full state of the search (including that of numpy's
+        random number generator) is saved to this file after each iteration
+        (Default: None)
+    resume : boolean
+        Whether to continue the search from the state saved in
+        checkpoint_fname instead of starting a new one. The resumed search
+        continues exactly as the original one would have (Default: False)
    
     Returns
     =======
@@ -102,86 +267,63 @@ def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
     vhigh = np.abs(ub - lb)
     vlow = -vhigh
 
-    # Initialize objective function
-    obj = partial(_obj_wrapper, func, args, kwargs)
-
-    # Initialize dumping function if required
-    if dumpfile_prefix:
-        def dump(i, x, fx):
-            np.save(dumpfile_prefix % i + "_fx", fx)
-            np.save(dumpfile_prefix % i + "_pos", x)
-    else:
-        dump = lambda *_: None
-
-    # Check for constraint function(s) #########################################
-    if f_ieqcons is None:
-        if not len(ieqcons):
-            if debug:
-                print('No constraints given.')
-            cons = _cons_none_wrapper
-        else:
-            if debug:
-                print('Converting ieqcons to a single constraint function')
-            cons = partial(_cons_ieqcons_wrapper, ieqcons, args, kwargs)
-    else:
-        if debug:
-            print('Single constraint function given in f_ieqcons')
-        cons = partial(_cons_f_ieqcons_wrapper, f_ieqcons, args, kwargs)
-    is_feasible = partial(_is_feasible_wrapper, cons)
+    obj, cons, dump = _setup(func, ieqcons, f_ieqcons, args, kwargs,
+                             debug, dumpfile_prefix)
 
     # Initialize the multiprocessing module if necessary
+    mp_pool = None
     if processes > 1:
-        import multiprocessing
         mp_pool = multiprocessing.Pool(processes)
+    evaluate = _Evaluator(obj, cons, combined, processes, mp_pool)
+    is_feasible = evaluate.is_feasible
 
     # Initialize the particle swarm ############################################
     S = swarmsize
     D = len(lb)  # the number of dimensions each particle has
-    x = np.random.rand(S, D)  # particle positions
-    v = np.zeros_like(x)  # particle velocities
-    p = np.zeros_like(x)  # best particle positions
-    fx = np.zeros(S)  # current particle function values
-    fs = np.zeros(S, dtype=bool)  # feasibility of each particle
-    fp = np.ones(S)*np.inf  # best particle function values
-    g = []  # best swarm position
-    fg = np.inf  # best swarm position starting value
-
-    # Initialize the particle's position
-    x = lb + x*(ub - lb)
-    # Calculate objective and constraints for each particle
-    if processes > 1:
-        fx = np.array(mp_pool.map(obj, x))
-        fs = np.array(mp_pool.map(is_feasible, x))
-    elif processes != 0:
-        for i in range(S):
-            fx[i] = obj(x[i, :])
-            fs[i] = is_feasible(x[i, :])
+    if resume:
+        # Continue from the state saved after the last finished iteration
+        x, v, p, fp, g, fg, it = _restore_checkpoint(checkpoint_fname, S, D)
+        print('Resuming search from iteration {:}'.format(it))
     else:
-        fx = obj(x)
-        fs = is_feasible(x)
-    dump(0, x, fx)
+        x = np.random.rand(S, D)  # particle positions
+        v = np.zeros_like(x)  # particle velocities
+        p = np.zeros_like(x)  # best particle positions
+        fx = np.zeros(S)  # current particle function values
+        fs = np.zeros(S, dtype=bool)  # feasibility of each particle
+        fp = np.ones(S)*np.inf  # best particle function values
+        g = []  # best swarm position
+        fg = np.inf  # best swarm position starting value
 
-    # Store particle's best position (if constraints are satisfied)
-    i_update = np.logical_and((fx < fp), fs)
-    p[i_update, :] = x[i_update, :].copy()
-    print('fp', fp, 'fx', fx)
-    fp[i_update] = fx[i_update]
+        # Initialize the particle's position
+        x = lb + x*(ub - lb)
+        # Calculate objective and constraints for each particle
+        fx, fs = evaluate(x)
+        dump(0, x, fx)
 
-    # Update swarm's best position
-    i_min = np.argmin(fp)
-    if fp[i_min] < fg:
-        fg = fp[i_min]
-        g = p[i_min, :].copy()
-    else:
-        # At the start, there may not be any feasible starting point, so just
-        # give it a temporary "best" point since it's likely to change
-        g = x[0, :].copy()
+        # Store particle's best position (if constraints are satisfied)
+        i_update = np.logical_and((fx < fp), fs)
+        p[i_update, :] = x[i_update, :].copy()
+        print('fp', fp, 'fx', fx)
+        fp[i_update] = fx[i_update]
+
+        # Update swarm's best position
+        i_min = np.argmin(fp)
+        if fp[i_min] < fg:
+            fg = fp[i_min]
+            g = p[i_min, :].copy()
+        else:
+            # At the start, there may not be any feasible starting point, so just
+            # give it a temporary "best" point since it's likely to change
+            g = x[0, :].copy()
        
-    # Initialize the particle's velocity
-    v = vlow + np.random.rand(S, D)*(vhigh - vlow)
+        # Initialize the particle's velocity
+        v = vlow + np.random.rand(S, D)*(vhigh - vlow)
+
+        it = 1
+        if checkpoint_fname:
+            save_checkpoint(checkpoint_fname, it, x, v, p, fp, g, fg)
 
     # Iterate until termination criterion met ##################################
-    it = 1
     while it < maxiter:
         rp = np.random.uniform(size=(S, D))
         rg = np.random.uniform(size=(S, D))
@@ -196,16 +338,7 @@ def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
         x = x*(~np.logical_or(maskl, masku)) + lb*maskl + ub*masku
 
         # Update objectives and constraints
-        if processes > 1:
-            fx = np.array(mp_pool.map(obj, x))
-            fs = np.array(mp_pool.map(is_feasible, x))
-        elif processes != 0:
-            for i in range(S):
-                fx[i] = obj(x[i, :])
-                fs[i] = is_feasible(x[i, :])
-        else:
-            fx = obj(x)
-            fs = is_feasible(x)
+        fx, fs = evaluate(x)
         dump(it, x, fx)
 
         # Store particle's best position (if constraints are satisfied)
@@ -244,6 +377,8 @@ def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
         if debug:
             print('Best after iteration {:}: {:} {:}'.format(it, g, fg))
         it += 1
+        if checkpoint_fname:
+            save_checkpoint(checkpoint_fname, it, x, v, p, fp, g, fg)
 
     print('Stopping search: maximum iterations reached --> {:}'.format(maxiter))
     
@@ -253,3 +388,305 @@ def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
         return g, fg, p, fp
     else:
         return g, fg
+
+
+def async_pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
+              swarmsize=100, omega=0.5, phip=0.5, phig=0.5, maxiter=100,
+              minstep=1e-8, minfunc=1e-8, debug=False, processes=1,
+              particle_output=False, dumpfile_prefix=None, combined=False):
+    """
+    Perform an asynchronous particle swarm optimization (PSO)
+
+    Unlike pso, particles are not evaluated in lockstep. As soon as the
+    evaluation of a particle finishes its velocity and position are updated
+    using the swarm's best known position at that time, and the particle is
+    evaluated again, so a slow evaluation doesn't leave the other processes
+    idle. Each particle is evaluated at most ``maxiter`` times. The positions
+    and objective values of the k-th evaluation of all particles are dumped
+    together, like pso does for its k-th iteration.
+
+    Parameters and return values are the same as pso's, except that func is
+    always given a single particle, and that processes must be at least 1
+    """
+
+    assert len(lb)==len(ub), 'Lower- and upper-bounds must be the same length'
+    assert hasattr(func, '__call__'), 'Invalid function handle'
+    assert processes >= 1, 'async_pso needs at least one process'
+    lb = np.array(lb)
+    ub = np.array(ub)
+    assert np.all(ub>lb), 'All upper-bound values must be greater than lower-bound values'
+
+    vhigh = np.abs(ub - lb)
+    vlow = -vhigh
+
+    obj, cons, dump = _setup(func, ieqcons, f_ieqcons, args, kwargs,
+                             debug, dumpfile_prefix)
+    evaluate = _Evaluator(obj, cons, combined, processes)
+    is_feasible = evaluate.is_feasible
+
+    # Initialize the particle swarm ############################################
+    S = swarmsize
+    D = len(lb)  # the number of dimensions each particle has
+    x = lb + np.random.rand(S, D)*(ub - lb)  # particle positions
+    v = vlow + np.random.rand(S, D)*(vhigh - vlow)  # particle velocities
+    p = np.zeros_like(x)  # best particle positions
+    fp = np.ones(S)*np.inf  # best particle function values
+    n_evals = np.zeros(S, dtype=int)  # evaluations done by each particle
+    g = x[0, :].copy()  # best swarm position, temporary until a feasible one is found
+    fg = np.inf  # best swarm position starting value
+
+    # k -> [positions, function values, number of particles] of the k-th
+    # evaluations, until all particles are done with it and it's dumped
+    tracks = {}
+
+    # Particles are given to the pool as soon as they are ready, and come back
+    # in the order in which they finish. Tasks failing outside of
+    # _evaluate_particle (e.g., when pickling them) come back as errors too
+    if processes > 1:
+        mp_pool = multiprocessing.Pool(processes)
+        finished = queue.Queue()
+        def submit(i):
+            task = (obj, cons, combined, i, x[i, :].copy(), evaluate.cached(x[i, :]))
+            if sys.version_info[0] >= 3:
+                mp_pool.apply_async(_evaluate_particle, task, callback=finished.put,
+                                    error_callback=lambda e, i=i: finished.put((i, None, e)))
+                return
+            # Python 2 has no error_callback, and tasks that can't be pickled
+            # would never come back, so make sure they can be first
+            try:
+                pickle.dumps(task, pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                finished.put((i, None, e))
+                return
+            mp_pool.apply_async(_evaluate_particle, task, callback=finished.put)
+        next_finished = finished.get
+    else:
+        ready = collections.deque()
+        submit = ready.append
+        def next_finished():
+            i = ready.popleft()
+            return _evaluate_particle(obj, cons, combined, i, x[i, :], evaluate.cached(x[i, :]))
+
+    for i in range(S):
+        submit(i)
+    running = S
+    stop = False
+    try:
+        while running and not stop:
+            i, fx, c = next_finished()
+            running -= 1
+            if fx is None:
+                raise c
+            fs = evaluate.store(x[i, :], c)
+
+            k = n_evals[i]
+            n_evals[i] += 1
+            track = tracks.setdefault(k, [np.zeros_like(x), np.zeros(S), 0])
+            track[0][i, :] = x[i, :]
+            track[1][i] = fx
+            track[2] += 1
+            if track[2] == S:
+                dump(k, track[0], track[1])
+                del tracks[k]
+
+            # Store particle's best position (if constraints are satisfied),
+            # and compare it with the swarm's best position
+            if fs and fx < fp[i]:
+                p[i, :] = x[i, :].copy()
+                fp[i] = fx
+                if fx < fg:
+                    if debug:
+                        print('New best for swarm at evaluation {:} of particle {:}: {:} {:}'\
+                            .format(k, i, p[i, :], fx))
+                    stepsize = np.sqrt(np.sum((g - p[i, :])**2))
+                    if np.isfinite(fg) and np.abs(fg - fx) <= minfunc:
+                        print('Stopping search: Swarm best objective change less than {:}'\
+                            .format(minfunc))
+                        stop = True
+                    elif np.isfinite(fg) and stepsize <= minstep:
+                        print('Stopping search: Swarm best position change less than {:}'\
+                            .format(minstep))
+                        stop = True
+                    g = p[i, :].copy()
+                    fg = fx
+
+            if stop or n_evals[i] >= maxiter:
+                continue
+
+            # Update the particle's velocity and position, correcting for
+            # bound violations, and evaluate it again
+            rp = np.random.uniform(size=D)
+            rg = np.random.uniform(size=D)
+            v[i, :] = omega*v[i, :] + phip*rp*(p[i, :] - x[i, :]) + phig*rg*(g - x[i, :])
+            xi = x[i, :] + v[i, :]
+            maskl = xi < lb
+            masku = xi > ub
+            x[i, :] = xi*(~np.logical_or(maskl, masku)) + lb*maskl + ub*masku
+            submit(i)
+            running += 1
+    finally:
+        if processes > 1:
+            mp_pool.terminate()
+
+    if not stop:
+        print('Stopping search: maximum iterations reached --> {:}'.format(maxiter))
+        if not is_feasible(g):
+            print("However, the optimization couldn't find a feasible design. Sorry")
+    if particle_output:
+        return g, fg, p, fp
+    else:
+        return g, fg
+
+
+def surrogate_pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
+                  swarmsize=100, omega=0.5, phip=0.5, phig=0.5, maxiter=100,
+                  minstep=1e-8, minfunc=1e-8, debug=False, processes=1,
+                  particle_output=False, dumpfile_prefix=None, combined=False,
+                  nevals=None, ncandidates=4, kappa=1., training=None):
+    """
+    Perform a surrogate-assisted particle swarm optimization.
+
+    The swarm moves like in `pso`, but a Gaussian process emulator trained on
+    all positions evaluated so far pre-screens the particles' moves. Each
+    particle tries ncandidates random moves, keeping the one with the lowest
+    lower confidence bound (predicted value minus kappa standard deviations,
+    favouring both promising and uncertain positions), and only the nevals
+    particles with the lowest bounds are evaluated with func. The rest of the
+    particles move without being evaluated, and are dumped with a NaN
+    objective value. The initial swarm is always evaluated in full.
+
+    Parameters are the same as in `pso`, plus:
+
+    nevals : int
+        The number of particles evaluated with func in each iteration
+        (Default: a third of swarmsize)
+    ncandidates : int
+        The number of moves screened per particle and iteration (Default: 4)
+    kappa : scalar
+        The weight of the predicted uncertainty when screening moves
+        (Default: 1)
+    training : tuple
+        Positions and objective values of previous evaluations (e.g., from
+        `surrogate.load_tracks`) to train the emulator with, in addition to
+        the ones done by this search (Default: None)
+
+    Returns the same as `pso`
+    """
+
+    assert len(lb)==len(ub), 'Lower- and upper-bounds must be the same length'
+    assert hasattr(func, '__call__'), 'Invalid function handle'
+    lb = np.array(lb)
+    ub = np.array(ub)
+    assert np.all(ub>lb), 'All upper-bound values must be greater than lower-bound values'
+
+    vhigh = np.abs(ub - lb)
+    vlow = -vhigh
+
+    obj, cons, dump = _setup(func, ieqcons, f_ieqcons, args, kwargs,
+                             debug, dumpfile_prefix)
+
+    mp_pool = None
+    if processes > 1:
+        mp_pool = multiprocessing.Pool(processes)
+    evaluate = _Evaluator(obj, cons, combined, processes, mp_pool)
+
+    S = swarmsize
+    D = len(lb)
+    nevals = nevals or max(1, S // 3)
+
+    # All the evaluations done so far, used to train the emulator
+    train_x = [np.zeros((0, D))]
+    train_fx = [np.zeros(0)]
+    if training is not None and training[0] is not None:
+        train_x.append(np.asarray(training[0], dtype=float).reshape(-1, D))
+        train_fx.append(np.asarray(training[1], dtype=float).ravel())
+    emulator = surrogate.GaussianProcess(lb, ub)
+
+    # Initialize and evaluate the whole swarm
+    x = lb + np.random.rand(S, D)*(ub - lb)
+    p = np.zeros_like(x)
+    fp = np.ones(S)*np.inf
+    fx, fs = evaluate(x)
+    dump(0, x, fx)
+    train_x.append(x.copy())
+    train_fx.append(fx)
+    n_real = S
+
+    i_update = np.logical_and((fx < fp), fs)
+    p[i_update, :] = x[i_update, :].copy()
+    fp[i_update] = fx[i_update]
+    i_min = np.argmin(fp)
+    if np.isfinite(fp[i_min]):
+        g = p[i_min, :].copy()
+        fg = fp[i_min]
+    else:
+        g = x[0, :].copy()
+        fg = np.inf
+    v = vlow + np.random.rand(S, D)*(vhigh - vlow)
+
+    stop = False
+    it = 1
+    try:
+        while it < maxiter and not stop:
+            emulator.fit(np.concatenate(train_x), np.concatenate(train_fx))
+
+            # Screen ncandidates moves per particle, keeping the best of each
+            rp = np.random.uniform(size=(ncandidates, S, D))
+            rg = np.random.uniform(size=(ncandidates, S, D))
+            cv = omega*v + phip*rp*(p - x) + phig*rg*(g - x)
+            cx = np.clip(x + cv, lb, ub)
+            mu, sigma = emulator.predict(cx.reshape(-1, D))
+            lcb = (mu - kappa*sigma).reshape(ncandidates, S)
+            best = np.argmin(lcb, 0)
+            v = cv[best, np.arange(S)]
+            x = cx[best, np.arange(S)]
+            lcb = lcb[best, np.arange(S)]
+
+            # Only the most promising particles are evaluated for real
+            chosen = np.argsort(lcb)[:nevals]
+            fx, fs = evaluate(x[chosen])
+            # The whole swarm is dumped, with NaN for particles not evaluated
+            fx_swarm = np.full(S, np.nan)
+            fx_swarm[chosen] = fx
+            dump(it, x, fx_swarm)
+            train_x.append(x[chosen].copy())
+            train_fx.append(fx)
+            n_real += len(chosen)
+
+            i_update = np.logical_and(fx < fp[chosen], fs)
+            p[chosen[i_update], :] = x[chosen[i_update], :].copy()
+            fp[chosen[i_update]] = fx[i_update]
+
+            i_min = np.argmin(fp)
+            if fp[i_min] < fg:
+                if debug:
+                    print('New best for swarm at iteration {:}: {:} {:}'\
+                        .format(it, p[i_min, :], fp[i_min]))
+                stepsize = np.sqrt(np.sum((g - p[i_min, :])**2))
+                if np.abs(fg - fp[i_min]) <= minfunc:
+                    print('Stopping search: Swarm best objective change less than {:}'\
+                        .format(minfunc))
+                    stop = True
+                elif stepsize <= minstep:
+                    print('Stopping search: Swarm best position change less than {:}'\
+                        .format(minstep))
+                    stop = True
+                g = p[i_min, :].copy()
+                fg = fp[i_min]
+
+            if debug:
+                print('Best after iteration {:}: {:} {:}'.format(it, g, fg))
+            it += 1
+    finally:
+        if mp_pool is not None:
+            mp_pool.terminate()
+
+    if not stop:
+        print('Stopping search: maximum iterations reached --> {:}'.format(maxiter))
+        if not evaluate.is_feasible(g):
+            print("However, the optimization couldn't find a feasible design. Sorry")
+    print('Evaluated {:} positions with the objective function'.format(n_real))
+    if particle_output:
+        return g, fg, p, fp
+    else:
+        return g, fg
@@ -0,0 +1,109 @@
+#
+# ICRAR - International Centre for Radio Astronomy Research
+# (c) UWA - The University of Western Australia, 2019
+# Copyright by UWA (in the framework of the ICRAR)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""
+A Gaussian process emulator of the objective function, used to decide which
+particles are worth evaluating with shark
+"""
+
+import glob
+import os
+
+import numpy as np
+import scipy.linalg
+
+
+def load_tracks(tracks_dir):
+    """Returns all positions and objective values dumped by the PSO under
+    tracks_dir, as two arrays"""
+    xs, fxs = [], []
+    for pos_fname in sorted(glob.glob(os.path.join(tracks_dir, 'track_*_pos.npy'))):
+        fx_fname = pos_fname[:-len('_pos.npy')] + '_fx.npy'
+        if not os.path.exists(fx_fname):
+            continue
+        xs.append(np.load(pos_fname))
+        fxs.append(np.load(fx_fname))
+    if not xs:
+        return None, None
+    return np.concatenate(xs), np.concatenate(fxs)
+
+
+class GaussianProcess(object):
+    """A Gaussian process regressor with a squared exponential kernel on the
+    search space normalized to [0, 1].
+
+    The kernel length scale and the noise level are chosen among a fixed grid
+    of values by maximizing the marginal likelihood of the training data.
+    Only the `max_points` best training points are used, so fitting stays
+    cheap compared to a shark execution."""
+
+    length_scales = np.logspace(-1.5, 0.5, 9)
+    noise_levels = np.array([1e-6, 1e-4, 1e-2, 1e-1])
+
+    def __init__(self, lb, ub, max_points=500):
+        self.lb = np.asarray(lb, dtype=float)
+        self.ub = np.asarray(ub, dtype=float)
+        self.max_points = max_points
+
+    def _normalize(self, x):
+        return (np.asarray(x, dtype=float) - self.lb) / (self.ub - self.lb)
+
+    @staticmethod
+    def _sqdist(a, b):
+        return np.sum(a**2, 1)[:, None] + np.sum(b**2, 1)[None, :] - 2 * np.dot(a, b.T)
+
+    def fit(self, x, fx):
+        """Trains the emulator with the finite objective values fx at positions x"""
+        x = np.asarray(x, dtype=float)
+        fx = np.asarray(fx, dtype=float)
+        finite = np.isfinite(fx)
+        x, fx = x[finite], fx[finite]
+        if len(fx) > self.max_points:
+            best = np.argsort(fx)[:self.max_points]
+            x, fx = x[best], fx[best]
+
+        self.x = self._normalize(x)
+        self.mean = np.mean(fx)
+        self.std = np.std(fx) or 1.
+        y = (fx - self.mean) / self.std
+        d2 = np.maximum(self._sqdist(self.x, self.x), 0)
+
+        best = None
+        for length_scale in self.length_scales:
+            k = np.exp(-0.5 * d2 / length_scale**2)
+            for noise in self.noise_levels:
+                try:
+                    chol = scipy.linalg.cho_factor(k + noise * np.eye(len(y)), lower=True)
+                except np.linalg.LinAlgError:
+                    continue
+                alpha = scipy.linalg.cho_solve(chol, y)
+                loglike = -0.5 * np.dot(y, alpha) - np.sum(np.log(np.diag(chol[0])))
+                if best is None or loglike > best[0]:
+                    best = loglike, length_scale, chol, alpha
+        _, self.length_scale, self.chol, self.alpha = best
+        return self
+
+    def predict(self, x):
+        """Returns the predicted objective values at positions x, and their
+        standard deviations"""
+        x = self._normalize(np.atleast_2d(x))
+        ks = np.exp(-0.5 * np.maximum(self._sqdist(x, self.x), 0) / self.length_scale**2)
+        mu = np.dot(ks, self.alpha)
+        var = 1 - np.sum(ks * scipy.linalg.cho_solve(self.chol, ks.T).T, 1)
+        sigma = np.sqrt(np.maximum(var, 0))
+        return self.mean + mu * self.std, sigma * self.std
@@ -17,9 +17,15 @@
 #
 
 import argparse
+import functools
+import glob
+import multiprocessing
+import os
 
 import h5py
-from numpy import array_equal
+import numpy as np
+
+import galaxies_manifest
 
 
 def read_args():
@@ -32,38 +38,192 @@ def read_args():
         help='Whether the models are expected to be unequal.')
     arg_parser.add_argument(
         '-m', '--models', required=True, nargs=2,
-        help='Path where each model is found.'
+        help=('Path where each model is found. Either galaxies.hdf5 files, or model '
+              'directories, in which case all their snapshots and subvolumes are compared.')
         )
+    arg_parser.add_argument(
+        '-c', '--chunk-size', type=int, default=1000000,
+        help='Number of rows of each dataset read at a time. Defaults to 1000000.')
+    arg_parser.add_argument(
+        '-p', '--processes', type=int, default=1,
+        help='Number of processes comparing datasets in parallel. Defaults to 1.')
+    arg_parser.add_argument(
+        '-k', '--same-bytes-first', action='store_true',
+        help=('Compare the raw bytes of each chunk first, and look for differences (with the given '
+              'tolerances) only in chunks whose bytes differ.'))
+    arg_parser.add_argument(
+        '-r', '--rtol', type=float, default=0,
+        help='Relative tolerance when comparing floating point fields. Defaults to 0 (exact comparison).')
+    arg_parser.add_argument(
+        '-a', '--atol', type=float, default=0,
+        help='Absolute tolerance when comparing floating point fields. Defaults to 0 (exact comparison).')
+    arg_parser.add_argument(
+        '-M', '--no-manifests', action='store_true',
+        help=('Ignore the manifests written by galaxies_manifest.py. Otherwise, datasets whose '
+              'hashes are equal in both manifests are not read.'))
     return arg_parser.parse_args()
 
 
-def assert_galaxies_equal(galaxy1, galaxy2):
-    """Raise an AssertionError if two galaxies are not equal."""
-    if frozenset(galaxy1.keys()) != frozenset(galaxy2.keys()):
-        raise AssertionError('Galaxy keys unequal.')
-    for key in galaxy1.keys():
-        if not array_equal(galaxy1[key][:], galaxy2[key][:]):
-            raise AssertionError('Galaxies not equal.')
+def galaxies_files(path):
+    """Returns the galaxies.hdf5 files under the model in path, relative to it,
+    or '' if path is a file itself"""
+    if os.path.isfile(path):
+        return ['']
+    fnames = glob.glob(os.path.join(path, '*', '*', 'galaxies.hdf5'))
+    return sorted(os.path.relpath(fname, path) for fname in fnames)
+
+
+def dataset_names(group, prefix=''):
+    """Returns the names of all the datasets under group, recursively"""
+    names = []
+    for name, value in group.items():
+        if isinstance(value, h5py.Group):
+            names += dataset_names(value, prefix + name + '/')
+        else:
+            names.append(prefix + name)
+    return names
+
+
+class difference(object):
+    """The accumulated differences between two datasets"""
+
+    def __init__(self, fname, name):
+        self.fname = fname
+        self.name = name
+        self.error = None
+        self.count = 0
+        self.total = 0
+        self.max_abs = 0.
+        self.max_rel = 0.
+
+    def update(self, x1, x2, rtol, atol):
+        self.total += x1.size
+        if x1.dtype.kind in 'fc':
+            equal = np.isclose(x1, x2, rtol=rtol, atol=atol, equal_nan=True)
+        else:
+            equal = x1 == x2
+        differ = ~equal
+        n = np.count_nonzero(differ)
+        if not n:
+            return
+        self.count += n
+        if x1.dtype.kind in 'biufc':
+            with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+                a, b = x1[differ].astype(float), x2[differ].astype(float)
+                abs_diff = np.abs(a - b)
+                rel_diff = abs_diff / np.maximum(np.abs(a), np.abs(b))
+            # NaNs (e.g., of inf - inf) are ignored; fmax.reduce needs no initial value
+            self.max_abs = max(self.max_abs, np.fmax.reduce(abs_diff))
+            self.max_rel = max(self.max_rel, np.fmax.reduce(rel_diff))
+
+    def __bool__(self):
+        return bool(self.error or self.count)
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        where = '%s:%s' % (self.fname, self.name) if self.fname else self.name
+        if self.error:
+            return '%s: %s' % (where, self.error)
+        return '%s: %d of %d values differ, max abs diff %g, max rel diff %g' % (
+            where, self.count, self.total, self.max_abs, self.max_rel)
+
 
+def _same_bytes(x1, x2):
+    return np.array_equal(np.ascontiguousarray(x1).view(np.uint8), np.ascontiguousarray(x2).view(np.uint8))
 
-def assert_galaxies_not_equal(galaxy1, galaxy2):
-    """Raise an AssertionError if two galaxies are equal."""
-    try:
-        assert_galaxies_equal(galaxy1, galaxy2)
-    except AssertionError as e:
-        pass
+
+def compare_datasets(models, fname, name, chunk_size=1000000, same_bytes_first=False, rtol=0, atol=0):
+    """Compares dataset name of the fname file of the two models, reading at
+    most chunk_size rows at a time, and returns their difference"""
+    diff = difference(fname, name)
+    paths = [os.path.join(model, fname) if fname else model for model in models]
+    with h5py.File(paths[0], 'r') as f1, h5py.File(paths[1], 'r') as f2:
+        d1, d2 = f1[name], f2[name]
+        if d1.shape != d2.shape or d1.dtype != d2.dtype:
+            diff.error = 'shape/type differ: %r %s vs %r %s' % (d1.shape, d1.dtype, d2.shape, d2.dtype)
+            return diff
+        if not d1.shape:
+            diff.update(np.atleast_1d(d1[()]), np.atleast_1d(d2[()]), rtol, atol)
+            return diff
+        for start in range(0, d1.shape[0], chunk_size):
+            x1, x2 = d1[start:start + chunk_size], d2[start:start + chunk_size]
+            # Identical bytes are always equal, and cheaper to check than values
+            if same_bytes_first and not x1.dtype.hasobject and _same_bytes(x1, x2):
+                diff.total += x1.size
+                continue
+            diff.update(x1, x2, rtol, atol)
+    return diff
+
+
+def _compare_datasets(models, options, fname_name):
+    return compare_datasets(models, fname_name[0], fname_name[1], **options)
+
+
+def _manifest_datasets(paths):
+    """Returns the galaxies datasets of the up to date manifests of both
+    paths, or None if they don't have one, or they are not comparable"""
+    manifests = [galaxies_manifest.read_manifest(path) for path in paths]
+    if None in manifests or manifests[0]['algorithm'] != manifests[1]['algorithm']:
+        return None
+    return [dict((name, entry) for name, entry in m['datasets'].items()
+                 if name.startswith('galaxies/')) for m in manifests]
+
+
+def compare_models(models, processes=1, use_manifests=True, **options):
+    """Compares all datasets in the galaxies group of all galaxies.hdf5 files
+    of the two models, and returns the list of differences found.
+
+    If both files have an up to date manifest, datasets with the same
+    contents hash are not read at all."""
+
+    fnames = [set(galaxies_files(model)) for model in models]
+    diffs = []
+    for fname in sorted(fnames[0] ^ fnames[1]):
+        diff = difference(fname, 'galaxies')
+        diff.error = 'only present in %s' % (models[0] if fname in fnames[0] else models[1])
+        diffs.append(diff)
+
+    to_compare = []
+    for fname in sorted(fnames[0] & fnames[1]):
+        paths = [os.path.join(model, fname) if fname else model for model in models]
+        manifests = _manifest_datasets(paths) if use_manifests else None
+        if manifests:
+            names = [set(m.keys()) for m in manifests]
+        else:
+            with h5py.File(paths[0], 'r') as f1, h5py.File(paths[1], 'r') as f2:
+                names = [set(dataset_names(f['galaxies'], 'galaxies/')) for f in (f1, f2)]
+        for name in sorted(names[0] ^ names[1]):
+            diff = difference(fname, name)
+            diff.error = 'only present in %s' % (paths[0] if name in names[0] else paths[1])
+            diffs.append(diff)
+        to_compare += [(fname, name) for name in sorted(names[0] & names[1])
+                       if not manifests or manifests[0][name] != manifests[1][name]]
+
+    compare = functools.partial(_compare_datasets, models, options)
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            diffs += pool.map(compare, to_compare)
+        finally:
+            pool.terminate()
     else:
-        raise AssertionError('Galaxies expected to be unequal, but are equal.')
+        diffs += [compare(x) for x in to_compare]
+    return [diff for diff in diffs if diff]
+
 
 def main():
     args = read_args()
-    model_one, model_two = h5py.File(args.models[0]), h5py.File(args.models[1])
-    galaxies_one, galaxies_two = model_one['galaxies'], model_two['galaxies']
+    diffs = compare_models(args.models, processes=args.processes,
+                           use_manifests=not args.no_manifests,
+                           chunk_size=args.chunk_size, same_bytes_first=args.same_bytes_first,
+                           rtol=args.rtol, atol=args.atol)
+    for diff in diffs:
+        print(diff)
 
-    if args.expect_unequal:
-        assert_galaxies_not_equal(galaxies_one, galaxies_two)
-    else:
-        assert_galaxies_equal(galaxies_one, galaxies_two)
+    if args.expect_unequal and not diffs:
+        raise AssertionError('Galaxies expected to be unequal, but are equal.')
+    elif not args.expect_unequal and diffs:
+        raise AssertionError('Galaxies not equal.')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# Write content-hash manifests of shark galaxies outputs
+#
+# ICRAR - International Centre for Radio Astronomy Research
+# (c) UWA - The University of Western Australia, 2019
+# Copyright by UWA (in the framework of the ICRAR)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+"""
+Writes a manifest next to each galaxies.hdf5 file (galaxies.manifest.json)
+with the shape, type and a content hash of each of its datasets, so two
+outputs can be compared without reading them again
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+
+import h5py
+import numpy as np
+
+
+# blake2b is much faster than md5 over large buffers, but needs python 3.6
+if hasattr(hashlib, 'blake2b'):
+    algorithm = 'blake2b'
+    _new_hash = lambda: hashlib.blake2b(digest_size=16)
+else:
+    algorithm = 'md5'
+    _new_hash = hashlib.md5
+
+
+def read_args():
+    """Return an argparse.Namespace object with the CLI arguments"""
+    arg_parser = argparse.ArgumentParser(
+        "Write content-hash manifests of shark galaxies outputs."
+        )
+    arg_parser.add_argument(
+        'paths', nargs='+',
+        help='galaxies.hdf5 files, or model directories, in which case the files of all their snapshots and subvolumes are used.')
+    arg_parser.add_argument(
+        '-c', '--chunk-size', type=int, default=1000000,
+        help='Number of rows of each dataset read at a time. Defaults to 1000000.')
+    arg_parser.add_argument(
+        '-p', '--processes', type=int, default=1,
+        help='Number of files processed in parallel. Defaults to 1.')
+    return arg_parser.parse_args()
+
+
+def manifest_fname(fname):
+    return os.path.join(os.path.dirname(fname), 'galaxies.manifest.json')
+
+
+def _file_info(fname):
+    st = os.stat(fname)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def dataset_hash(dataset, chunk_size=1000000):
+    """Returns the hex digest of the raw contents of dataset, reading at
+    most chunk_size rows at a time"""
+    h = _new_hash()
+    if not dataset.shape:
+        h.update(np.ascontiguousarray(dataset[()]).tobytes())
+        return h.hexdigest()
+    for start in range(0, dataset.shape[0], chunk_size):
+        h.update(np.ascontiguousarray(dataset[start:start + chunk_size]).tobytes())
+    return h.hexdigest()
+
+
+def make_manifest(fname, chunk_size=1000000):
+    """Returns the manifest of the given HDF5 file"""
+    datasets = {}
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            datasets[name] = {
+                'shape': list(obj.shape),
+                'dtype': obj.dtype.str,
+                'hash': dataset_hash(obj, chunk_size)
+            }
+    with h5py.File(fname, 'r') as f:
+        f.visititems(visit)
+    return {'file': _file_info(fname), 'algorithm': algorithm, 'datasets': datasets}
+
+
+def write_manifest(fname, chunk_size=1000000):
+    """Writes the manifest of the given HDF5 file next to it"""
+    manifest = make_manifest(fname, chunk_size)
+    out_fname = manifest_fname(fname)
+    tmp_fname = '%s.%d.tmp' % (out_fname, os.getpid())
+    with open(tmp_fname, 'wt') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmp_fname, out_fname)
+    print('Wrote %s' % out_fname)
+    return manifest
+
+
+def read_manifest(fname):
+    """Returns the manifest of the given HDF5 file, or None if it has none or
+    if the file changed after the manifest was written"""
+    try:
+        with open(manifest_fname(fname)) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if manifest.get('file') != _file_info(fname):
+        return None
+    return manifest
+
+
+def galaxies_files(path):
+    """Returns the galaxies.hdf5 files of the model in path, or path itself if
+    it is a file"""
+    if os.path.isfile(path):
+        return [path]
+    return sorted(glob.glob(os.path.join(path, '*', '*', 'galaxies.hdf5')))
+
+
+def _write_manifest(args):
+    return write_manifest(*args)
+
+
+def main():
+    args = read_args()
+    fnames = [fname for path in args.paths for fname in galaxies_files(path)]
+    to_write = [(fname, args.chunk_size) for fname in fnames]
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes)
+        try:
+            pool.map(_write_manifest, to_write)
+        finally:
+            pool.terminate()
+    else:
+        for x in to_write:
+            _write_manifest(x)
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,8 @@
 import functools
 import os
 import multiprocessing
+import shutil
+import tempfile
 
 import common
 import coldgas
@@ -42,9 +44,21 @@ def main():
         args_with_obsdir: (coldgas, global_quantities, hmf, sizes, smf),
     }
 
+    # All modules read the galaxies data through a shared snapshot cache so
+    # each (snapshot, field) is read from disk only once. Users can point
+    # SHARK_PLOT_CACHE_DIR to a directory of their own (e.g., under /dev/shm),
+    # otherwise a temporary one is used and removed at the end
+    tmp_cache_dir = None
+    if not os.environ.get('SHARK_PLOT_CACHE_DIR'):
+        tmp_cache_dir = tempfile.mkdtemp(prefix='shark-plots-cache-')
+        os.environ['SHARK_PLOT_CACHE_DIR'] = tmp_cache_dir
+    print("Using %s as the snapshot cache directory" % os.environ['SHARK_PLOT_CACHE_DIR'])
+
     n_mods = functools.reduce(lambda x, y: x + y, [len(l) for l in args_and_mods.values()])
     n_procs = int(os.environ.get('SHARK_PLOT_PROCS', n_mods))
     print("Using %d processes to produce all plots" % n_procs)
+    # Modules run within this pool prepare their own data serially
+    # (see common.get_num_procs), so at most n_procs processes are busy
     pool = multiprocessing.Pool(n_procs)
 
     # Go, go, go!
@@ -53,8 +67,12 @@ def main():
         futures += [pool.apply_async(m.main, args) for m in mods]
 
     # Wait for all results to finish
-    for f in futures:
-        f.get()
+    try:
+        for f in futures:
+            f.get()
+    finally:
+        if tmp_cache_dir:
+            shutil.rmtree(tmp_cache_dir)
 
 if __name__ == '__main__':
     main()
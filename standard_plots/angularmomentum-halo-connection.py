@@ -81,6 +81,10 @@ def prepare_data(hdf5_data, index, sam_vs_sam_halo_disk, sam_vs_sam_halo_gal,
     zero_bulge = np.where(rbulge <= 0)
     if(len(rbulge) == len(rbulge[zero_bulge])):
             #case where there is zero bulge build up.
+            #copy first, as inputs can be read-only views of the snapshot cache.
+            rbulge = rbulge.copy()
+            specific_angular_momentum_bulge_star = specific_angular_momentum_bulge_star.copy()
+            mbulge = mbulge.copy()
             rbulge[zero_bulge] = 1e-10
             specific_angular_momentum_bulge_star[zero_bulge] = 1.0
             mbulge[zero_bulge] = 10.0
@@ -75,6 +75,10 @@ def prepare_data(hdf5_data, index, sam_stars_disk, sam_gas_disk_atom, sam_gas_di
     zero_bulge = np.where(rbulge <= 0)
     if(len(rbulge) == len(rbulge[zero_bulge])):
             #case where there is zero bulge build up.
+            #copy first, as inputs can be read-only views of the snapshot cache.
+            rbulge = rbulge.copy()
+            specific_angular_momentum_bulge_star = specific_angular_momentum_bulge_star.copy()
+            mbulge = mbulge.copy()
             rbulge[zero_bulge] = 1e-10
             specific_angular_momentum_bulge_star[zero_bulge] = 1.0
             mbulge[zero_bulge] = 10.0
@@ -969,8 +973,8 @@ def main(modeldir, outdir, redshift_table, subvols, obsdir):
     disk_size_cen = np.zeros(shape = (len(zlist), 3, len(xmf))) 
     bulge_size    = np.zeros(shape = (len(zlist), 3, len(xmf)))
 
-    for index, snapshot in enumerate(redshift_table[zlist]):
-        hdf5_data = common.read_data(modeldir, snapshot, fields, subvols)
+    # The next snapshot is read while the current one is prepared
+    for index, hdf5_data in enumerate(common.read_snapshots_data(modeldir, redshift_table[zlist], fields, subvols)):
         (lh, lj, lm, bt, ms, ssfr)  = prepare_data(hdf5_data, index, sam_stars_disk, sam_gas_disk_atom, sam_gas_disk_mol, sam_halo, sam_ratio_halo_disk, 
                      sam_ratio_halo_gal, sam_ratio_halo_disk_gas, disk_size_sat, disk_size_cen, bulge_size, sam_vs_sam_halo_disk, sam_vs_sam_halo_gal,
                      sam_vs_sam_halo_disk_gas, sam_bar, sam_stars, vmax_halo_gal)
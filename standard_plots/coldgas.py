@@ -44,28 +44,28 @@ def prepare_ax(ax, xmin, xmax, ymin, ymax, xtit, ytit):
     yleg = ymax - 0.1 * (ymax-ymin)
     #ax.text(xleg, yleg, 'z=0')
 
-def prepare_data(hdf5_data):
+def prepare_data(hdf5_data, stats=us):
 
-    bin_it = functools.partial(us.wmedians, xbins=xmf)
-    stack  = functools.partial(us.stacking, xbins=xmf)
+    bin_it = functools.partial(stats.wmedians, xbins=xmf)
+    stack  = functools.partial(stats.stacking, xbins=xmf)
 
     # Unpack data
     (h0, _, typeg, mdisk, mbulge, _, _, mHI, mH2, mgas,
-     mHI_bulge, mH2_bulge, mgas_bulge, mvir) = hdf5_data
+     mHI_bulge, mH2_bulge, mgas_bulge, mvir,
+     mstars, matom, mmol, mgas_tot, log_mstars) = hdf5_data
 
     XH = 0.72
-    h0log = np.log10(float(h0))
 
     n_typeg = len(typeg)
     morpho_type = np.zeros(shape = (n_typeg))
     morpho_type_stellar = np.zeros(shape = (n_typeg))
 
     # Early-type galaxies criterion of Khochfar et al. (2011).
-    ind = np.where((mbulge + mgas_bulge)/(mdisk + mbulge + mgas + mgas_bulge) > 0.5)
+    ind = np.where((mbulge + mgas_bulge)/(mstars + mgas + mgas_bulge) > 0.5)
     morpho_type[ind] = 1.0
 
     # Early-type galaxies criterion based on stellar mass alone.
-    ind = np.where((mbulge)/(mdisk + mbulge) > 0.5)
+    ind = np.where(mbulge/mstars > 0.5)
     morpho_type_stellar[ind] = 1.0
 
     mh2_gals = np.zeros(shape = (2, n_typeg))
@@ -85,50 +85,50 @@ def prepare_data(hdf5_data):
 
 
     #Gas scaling relations based on morphological criterion calculated using total baryon mass of disk and bulge
-    ind = np.where((mdisk + mbulge > 0) & (mgas + mgas_bulge > 0) & (mH2 + mH2_bulge > 0) & (morpho_type == 0))
+    ind = np.where((mstars > 0) & (mgas_tot > 0) & (mmol > 0) & (morpho_type == 0))
     # Data we'll use later
-    mass = mdisk[ind] + mbulge[ind]
-    mgas_gals_ltg[0,ind] = mh1_gals_ltg[0,ind] = mh2_gals_ltg[0,ind] = np.log10(mass) - h0log
-    mgas_gals_ltg[1,ind] = np.log10(XH * (mgas[ind] + mgas_bulge[ind]) / mass)
-    mh1_gals_ltg[1,ind] = np.log10(XH * (mHI[ind] + mHI_bulge[ind]) / mass)
-    mh2_gals_ltg[1,ind] = np.log10(XH * (mH2[ind] + mH2_bulge[ind]) / (mass))
+    mass = mstars[ind]
+    mgas_gals_ltg[0,ind] = mh1_gals_ltg[0,ind] = mh2_gals_ltg[0,ind] = log_mstars[ind]
+    mgas_gals_ltg[1,ind] = np.log10(XH * mgas_tot[ind] / mass)
+    mh1_gals_ltg[1,ind] = np.log10(XH * matom[ind] / mass)
+    mh2_gals_ltg[1,ind] = np.log10(XH * mmol[ind] / mass)
 
     mgas_relation_ltg = bin_it(x=mgas_gals_ltg[0, ind], y=mgas_gals_ltg[1, ind])
     mh1_relation_ltg = bin_it(x=mh1_gals_ltg[0, ind], y=mh1_gals_ltg[1, ind])
     mh2_relation_ltg = bin_it(x=mh2_gals_ltg[0, ind], y=mh2_gals_ltg[1, ind])
 
-    ind = np.where((mdisk + mbulge > 0) & (mgas + mgas_bulge > 0) & (mH2 + mH2_bulge > 0) & (morpho_type == 1))
+    ind = np.where((mstars > 0) & (mgas_tot > 0) & (mmol > 0) & (morpho_type == 1))
     # Data we'll use later
-    mass = mdisk[ind] + mbulge[ind]
-    mgas_gals_etg[0,ind] = mh1_gals_etg[0,ind] = mh2_gals_etg[0,ind] = np.log10(mass) - h0log
-    mgas_gals_etg[1,ind] = np.log10(XH * (mgas[ind] + mgas_bulge[ind]) / mass)
-    mh1_gals_etg[1,ind] = np.log10(XH * (mHI[ind] + mHI_bulge[ind]) / mass)
-    mh2_gals_etg[1,ind] = np.log10(XH * (mH2[ind] + mH2_bulge[ind]) / (mass))
+    mass = mstars[ind]
+    mgas_gals_etg[0,ind] = mh1_gals_etg[0,ind] = mh2_gals_etg[0,ind] = log_mstars[ind]
+    mgas_gals_etg[1,ind] = np.log10(XH * mgas_tot[ind] / mass)
+    mh1_gals_etg[1,ind] = np.log10(XH * matom[ind] / mass)
+    mh2_gals_etg[1,ind] = np.log10(XH * mmol[ind] / mass)
 
     mgas_relation_etg = bin_it(x=mgas_gals_etg[0, ind], y=mgas_gals_etg[1, ind])
     mh1_relation_etg = bin_it(x=mh1_gals_etg[0, ind], y=mh1_gals_etg[1, ind])
     mh2_relation_etg = bin_it(x=mh2_gals_etg[0, ind], y=mh2_gals_etg[1, ind])
 
     #Gas scaling relations based on morphological criterion calculated using stellar mass of disk and bulge
-    ind = np.where((mdisk + mbulge > 0) & (mgas + mgas_bulge > 0) & (mH2 + mH2_bulge > 0) & (morpho_type_stellar == 0))
+    ind = np.where((mstars > 0) & (mgas_tot > 0) & (mmol > 0) & (morpho_type_stellar == 0))
     # Data we'll use later
-    mass = mdisk[ind] + mbulge[ind]
-    mgas_gals_ltg[0,ind] = mh1_gals_ltg[0,ind] = mh2_gals_ltg[0,ind] = np.log10(mass) - h0log
-    mgas_gals_ltg[1,ind] = np.log10(XH * (mgas[ind] + mgas_bulge[ind]) / mass)
-    mh1_gals_ltg[1,ind] = np.log10(XH * (mHI[ind] + mHI_bulge[ind]) / mass)
-    mh2_gals_ltg[1,ind] = np.log10(XH * (mH2[ind] + mH2_bulge[ind]) / (mass))
+    mass = mstars[ind]
+    mgas_gals_ltg[0,ind] = mh1_gals_ltg[0,ind] = mh2_gals_ltg[0,ind] = log_mstars[ind]
+    mgas_gals_ltg[1,ind] = np.log10(XH * mgas_tot[ind] / mass)
+    mh1_gals_ltg[1,ind] = np.log10(XH * matom[ind] / mass)
+    mh2_gals_ltg[1,ind] = np.log10(XH * mmol[ind] / mass)
 
     mgas_ms_relation_ltg = bin_it(x=mgas_gals_ltg[0, ind], y=mgas_gals_ltg[1, ind])
     mh1_ms_relation_ltg = bin_it(x=mh1_gals_ltg[0, ind], y=mh1_gals_ltg[1, ind])
     mh2_ms_relation_ltg = bin_it(x=mh2_gals_ltg[0, ind], y=mh2_gals_ltg[1, ind])
 
-    ind = np.where((mdisk + mbulge > 0) & (mgas + mgas_bulge > 0) & (mH2 + mH2_bulge > 0) & (morpho_type_stellar == 1))
+    ind = np.where((mstars > 0) & (mgas_tot > 0) & (mmol > 0) & (morpho_type_stellar == 1))
     # Data we'll use later
-    mass = mdisk[ind] + mbulge[ind]
-    mgas_gals_etg[0,ind] = mh1_gals_etg[0,ind] = mh2_gals_etg[0,ind] = np.log10(mass) - h0log
-    mgas_gals_etg[1,ind] = np.log10(XH * (mgas[ind] + mgas_bulge[ind]) / mass)
-    mh1_gals_etg[1,ind] = np.log10(XH * (mHI[ind] + mHI_bulge[ind]) / mass)
-    mh2_gals_etg[1,ind] = np.log10(XH * (mH2[ind] + mH2_bulge[ind]) / (mass))
+    mass = mstars[ind]
+    mgas_gals_etg[0,ind] = mh1_gals_etg[0,ind] = mh2_gals_etg[0,ind] = log_mstars[ind]
+    mgas_gals_etg[1,ind] = np.log10(XH * mgas_tot[ind] / mass)
+    mh1_gals_etg[1,ind] = np.log10(XH * matom[ind] / mass)
+    mh2_gals_etg[1,ind] = np.log10(XH * mmol[ind] / mass)
 
     mgas_ms_relation_etg = bin_it(x=mgas_gals_etg[0, ind], y=mgas_gals_etg[1, ind])
     mh1_ms_relation_etg = bin_it(x=mh1_gals_etg[0, ind], y=mh1_gals_etg[1, ind])
@@ -137,49 +137,48 @@ def prepare_data(hdf5_data):
 
 
     # Constrains
-    ind = np.where((mdisk + mbulge > 0) & (mgas + mgas_bulge > 0) & (mH2 + mH2_bulge > 0))
+    ind = np.where((mstars > 0) & (mgas_tot > 0) & (mmol > 0))
 
     # Data we'll use later
-    mass = mdisk[ind] + mbulge[ind]
-    mgas_gals[0,ind] = mh1_gals[0,ind] = mh2_gals[0,ind] = np.log10(mass) - h0log
-    mgas_gals[1,ind] = np.log10(XH * (mgas[ind] + mgas_bulge[ind]) / mass)
-    mh1_gals[1,ind] = np.log10(XH * (mHI[ind] + mHI_bulge[ind]) / mass)
-    mh2_gals[1,ind] = np.log10(XH * (mH2[ind] + mH2_bulge[ind]) / (mass))
+    mass = mstars[ind]
+    mgas_gals[0,ind] = mh1_gals[0,ind] = mh2_gals[0,ind] = log_mstars[ind]
+    mgas_gals[1,ind] = np.log10(XH * mgas_tot[ind] / mass)
+    mh1_gals[1,ind] = np.log10(XH * matom[ind] / mass)
+    mh2_gals[1,ind] = np.log10(XH * mmol[ind] / mass)
 
     # Binned relations
     mgas_relation = bin_it(x=mgas_gals[0, ind], y=mgas_gals[1, ind])
     mh1_relation = bin_it(x=mh1_gals[0, ind], y=mh1_gals[1, ind])
     mh2_relation = bin_it(x=mh2_gals[0, ind], y=mh2_gals[1, ind])
-    mhr_relation = bin_it(x=np.log10(mdisk[ind]+mbulge[ind]) - h0log,
-                        y=np.log10((mH2[ind] + mH2_bulge[ind]) / (mHI[ind] + mHI_bulge[ind])))
-
-    ind = np.where((mdisk + mbulge > 0) & (mvir/h0 < 1e12) & (typeg > 0))
-    mh1_relation_satellites_halos[0] =  stack(x=np.log10((mdisk[ind] + mbulge[ind])/h0), y=(mHI[ind]+mHI_bulge[ind])/(mdisk[ind] + mbulge[ind]))
-    ind = np.where((mdisk + mbulge > 0) & (mvir/h0 >= 1e12)  & (mvir/h0 <= 1e13) & (typeg > 0))
-    mh1_relation_satellites_halos[1] =  stack(x=np.log10((mdisk[ind] + mbulge[ind])/h0), y=(mHI[ind]+mHI_bulge[ind])/(mdisk[ind] + mbulge[ind]))
-    ind = np.where((mdisk + mbulge > 0) & (mvir/h0 >= 1e13)  & (mvir/h0 <= 1e14) & (typeg > 0))
-    mh1_relation_satellites_halos[2] =  stack(x=np.log10((mdisk[ind] + mbulge[ind])/h0), y=(mHI[ind]+mHI_bulge[ind])/(mdisk[ind] + mbulge[ind]))
-    ind = np.where((mdisk + mbulge > 0) & (mvir/h0 >= 1e14)  & (mvir/h0 <= 1e15) & (typeg > 0))
-    mh1_relation_satellites_halos[3] =  stack(x=np.log10((mdisk[ind] + mbulge[ind])/h0), y=(mHI[ind]+mHI_bulge[ind])/(mdisk[ind] + mbulge[ind]))
-    ind = np.where((mdisk + mbulge > 0) & (typeg > 0))
-    mh1_relation_satellites_halos[4] =  stack(x=np.log10((mdisk[ind] + mbulge[ind])/h0), y=(mHI[ind]+mHI_bulge[ind])/(mdisk[ind] + mbulge[ind]))
-
-    ind = np.where((mdisk+mbulge > 0) & (typeg == 0))
-    mass_central = mdisk[ind] + mbulge[ind]
-    mgas_relation_cen = bin_it(x=np.log10(mass_central) - h0log,
-                               y=np.log10(XH * (mgas[ind] + mgas_bulge[ind]) / (mdisk[ind] + mbulge[ind] + XH*mgas[ind] + XH*mgas_bulge[ind])))
-    mhr_relation_cen = bin_it(x=np.log10(mass_central) - h0log,
-                              y=np.log10((mH2[ind] + mH2_bulge[ind]) / (mHI[ind] + mHI_bulge[ind])))
-
-    ind = np.where((mdisk+mbulge > 0) & (typeg > 0))
-    mass_sat = np.log10(mdisk[ind] + mbulge[ind]) - h0log
+    mhr_relation = bin_it(x=log_mstars[ind],
+                        y=np.log10(mmol[ind] / matom[ind]))
+
+    ind = np.where((mstars > 0) & (mvir/h0 < 1e12) & (typeg > 0))
+    mh1_relation_satellites_halos[0] =  stack(x=np.log10(mstars[ind]/h0), y=matom[ind]/mstars[ind])
+    ind = np.where((mstars > 0) & (mvir/h0 >= 1e12)  & (mvir/h0 <= 1e13) & (typeg > 0))
+    mh1_relation_satellites_halos[1] =  stack(x=np.log10(mstars[ind]/h0), y=matom[ind]/mstars[ind])
+    ind = np.where((mstars > 0) & (mvir/h0 >= 1e13)  & (mvir/h0 <= 1e14) & (typeg > 0))
+    mh1_relation_satellites_halos[2] =  stack(x=np.log10(mstars[ind]/h0), y=matom[ind]/mstars[ind])
+    ind = np.where((mstars > 0) & (mvir/h0 >= 1e14)  & (mvir/h0 <= 1e15) & (typeg > 0))
+    mh1_relation_satellites_halos[3] =  stack(x=np.log10(mstars[ind]/h0), y=matom[ind]/mstars[ind])
+    ind = np.where((mstars > 0) & (typeg > 0))
+    mh1_relation_satellites_halos[4] =  stack(x=np.log10(mstars[ind]/h0), y=matom[ind]/mstars[ind])
+
+    ind = np.where((mstars > 0) & (typeg == 0))
+    mgas_relation_cen = bin_it(x=log_mstars[ind],
+                               y=np.log10(XH * mgas_tot[ind] / (mstars[ind] + XH*mgas[ind] + XH*mgas_bulge[ind])))
+    mhr_relation_cen = bin_it(x=log_mstars[ind],
+                              y=np.log10(mmol[ind] / matom[ind]))
+
+    ind = np.where((mstars > 0) & (typeg > 0))
+    mass_sat = log_mstars[ind]
     mgas_relation_sat = bin_it(x=mass_sat,
-                               y=np.log10(XH * (mgas[ind] + mgas_bulge[ind]) / (mdisk[ind] + mbulge[ind] + XH*mgas[ind] + XH*mgas_bulge[ind])))
+                               y=np.log10(XH * mgas_tot[ind] / (mstars[ind] + XH*mgas[ind] + XH*mgas_bulge[ind])))
     mhr_relation_sat = bin_it(x=mass_sat,
-                              y=np.log10((mH2[ind] + mH2_bulge[ind]) / (mHI[ind] + mHI_bulge[ind])))
+                              y=np.log10(mmol[ind] / matom[ind]))
 
     return (mgas_relation, mgas_relation_cen, mgas_relation_sat,
-            mh2_gals, mh1_gals, mgas_gals,
+            stats.sample(mh2_gals), stats.sample(mh1_gals), stats.sample(mgas_gals),
             mh2_relation, mh1_relation, mhr_relation, mhr_relation_cen, mhr_relation_sat, 
             mgas_relation_ltg, mh2_relation_ltg, mh1_relation_ltg, mgas_relation_etg, mh2_relation_etg, 
 	    mh1_relation_etg, mgas_ms_relation_ltg, mh2_ms_relation_ltg, mh1_ms_relation_ltg, 
@@ -458,8 +457,11 @@ def main(model_dir, output_dir, redshift_table, subvols, obs_dir):
     plt = common.load_matplotlib()
     fields = {'galaxies': ('type', 'mstars_disk', 'mstars_bulge',
                            'rstar_disk', 'm_bh', 'matom_disk', 'mmol_disk', 'mgas_disk',
-                           'matom_bulge', 'mmol_bulge', 'mgas_bulge', 'mvir_hosthalo')}
-    hdf5_data = common.read_data(model_dir, redshift_table[0], fields, subvols)
+                           'matom_bulge', 'mmol_bulge', 'mgas_bulge', 'mvir_hosthalo'),
+              'derived': ('mstars', 'matom', 'mmol', 'mgas', 'log_mstars')}
+    # The results for the last chunk of data include those of all previous ones
+    for hdf5_data, stats in common.iter_data(model_dir, redshift_table[0], fields, subvols):
+        results = prepare_data(hdf5_data, stats)
 
     (mgas_relation, mgas_relation_cen, mgas_relation_sat,
      mh2_gals, mh1_gals, mgas_gals,
@@ -468,7 +470,7 @@ def main(model_dir, output_dir, redshift_table, subvols, obs_dir):
      mgas_relation_etg, mh2_relation_etg, mh1_relation_etg,
      mgas_ms_relation_ltg, mh2_ms_relation_ltg, mh1_ms_relation_ltg,
      mgas_ms_relation_etg, mh2_ms_relation_etg, mh1_ms_relation_etg, 
-     mh1_relation_satellites_halos) = prepare_data(hdf5_data)
+     mh1_relation_satellites_halos) = results
 
     plot_cold_gas_fraction(plt, output_dir, obs_dir, mgas_relation, mgas_relation_cen, mgas_relation_sat)
     plot_HI_stacking(plt, output_dir, obs_dir, mh1_relation_satellites_halos)
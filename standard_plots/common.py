@@ -21,19 +21,32 @@
 
 import argparse
 import collections
+import contextlib
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
 import os
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 import h5py
 import numpy as np
 
+import utilities_statistics as us
+
 PY2 = sys.version_info[0] == 2
 if PY2:
     import ConfigParser as configparser
 else:
     import configparser
 
+logger = logging.getLogger(__name__)
+
 def _select_closest(i1, i2, z, redshifts):
     i1 = min(i1, len(redshifts) - 1)
     i2 = min(i2, len(redshifts) - 1)
@@ -96,6 +109,19 @@ def read_configuration(config):
     redshift_file = cparser.get('simulation', 'redshift_file')
     return shark_dir, simu, model, redshift_file
 
+def read_output_snapshots(config):
+    """Returns the set of snapshots that shark outputs according to config"""
+    cparser = configparser.ConfigParser()
+    cparser.read(config)
+    snapshots = set()
+    for r in cparser.get('execution', 'output_snapshots').split():
+        if '-' in r:
+            first, last = sorted(int(x) for x in r.split('-'))
+            snapshots.update(range(first, last + 1))
+        else:
+            snapshots.add(int(r))
+    return snapshots
+
 def exec_command(cmd, shell=False, **kwargs):
     """Executes `cmd` and returns the stdout, stderr and exit code"""
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
@@ -233,32 +259,628 @@ def savefig(output_dir, fig, plotname):
     print('Saving plot to %s' % plotfile)
     fig.savefig(plotfile, dvi=300, pad_inches=0)
 
+def _hdf5_fnames(model_dir, snapshot, subvolumes, basename):
+    """Returns the list of files, one per subvolume, read for a given snapshot"""
+    #return [os.path.join(model_dir, str(snapshot), str(subv), basename) for subv in subvolumes]
+    return [os.path.join(model_dir, str(snapshot), 'multiple_batches', basename) for _ in subvolumes]
+
+# Columns derived from the galaxies fields, which can be requested from
+# read_data & co. under the 'derived' pseudo-group and are calculated only
+# once per snapshot. Each is given by the columns it depends on (galaxies
+# fields or other derived columns) and a function of h0 and those columns
+_derived_columns = collections.OrderedDict()
+
+def derived_column(name, *dependencies):
+    """Registers the decorated function as calculating the given derived column"""
+    def register(func):
+        _derived_columns[name] = (dependencies, func)
+        return func
+    return register
+
+def _log10_where(x, ind, offset=0.0):
+    result = np.zeros(shape = len(x))
+    result[ind] = np.log10(x[ind]) - offset
+    return result
+
+@derived_column('mstars', 'mstars_disk', 'mstars_bulge')
+def _mstars(h0, mdisk, mbulge):
+    return mdisk + mbulge
+
+@derived_column('sfr', 'sfr_disk', 'sfr_burst')
+def _sfr(h0, sfr_disk, sfr_burst):
+    return sfr_disk + sfr_burst
+
+@derived_column('mgas', 'mgas_disk', 'mgas_bulge')
+def _mgas(h0, mgas_disk, mgas_bulge):
+    return mgas_disk + mgas_bulge
+
+@derived_column('matom', 'matom_disk', 'matom_bulge')
+def _matom(h0, matom_disk, matom_bulge):
+    return matom_disk + matom_bulge
+
+@derived_column('mmol', 'mmol_disk', 'mmol_bulge')
+def _mmol(h0, mmol_disk, mmol_bulge):
+    return mmol_disk + mmol_bulge
+
+@derived_column('log_mstars', 'mstars')
+def _log_mstars(h0, mstars):
+    """log10 of the stellar mass in Msun, 0 for galaxies without stars"""
+    return _log10_where(mstars, np.where(mstars > 0), np.log10(float(h0)))
+
+@derived_column('log_ssfr', 'sfr', 'mstars')
+def _log_ssfr(h0, sfr, mstars):
+    """log10 of the specific SFR in 1/Gyr, 0 for galaxies without SF or stars"""
+    ind = np.where((sfr > 0) & (mstars > 0))
+    result = np.zeros(shape = len(sfr))
+    result[ind] = np.log10(sfr[ind] / mstars[ind])
+    return result
+
+@derived_column('log_sfr', 'sfr')
+def _log_sfr(h0, sfr):
+    """log10 of the SFR in Msun/yr, 0 for galaxies without SF"""
+    ind = np.where(sfr > 0)
+    result = np.zeros(shape = len(sfr))
+    result[ind] = np.log10(sfr[ind] / h0 / 1e9)
+    return result
+
+def _split_derived(fields):
+    """Returns the given fields without the 'derived' pseudo-group, plus the
+    galaxies fields the requested derived columns depend on"""
+
+    fields = collections.OrderedDict((gname, tuple(dsnames)) for gname, dsnames in fields.items())
+    derived = fields.pop('derived', ())
+    galaxies = list(fields.get('galaxies', ()))
+    pending = list(derived)
+    while pending:
+        name = pending.pop()
+        if name not in _derived_columns:
+            raise KeyError('Unknown derived column: %s' % name)
+        for dependency in _derived_columns[name][0]:
+            if dependency in _derived_columns:
+                pending.append(dependency)
+            elif dependency not in galaxies:
+                galaxies.append(dependency)
+    if galaxies:
+        fields['galaxies'] = tuple(galaxies)
+    return fields
+
+class _catalogue(collections.OrderedDict):
+    """The datasets read by read_catalogue, in the order they were requested.
+
+    Values are keyed by their full name (e.g., ``galaxies/mstars_disk``), but
+    can also be looked up by their bare dataset name if it is unambiguous.
+    Derived columns (see derived_column) are calculated the first time they
+    are looked up, and kept under ``derived/<name>``."""
+
+    def __missing__(self, key):
+        name = key[len('derived/'):] if key.startswith('derived/') else key
+        candidates = [k for k in self.keys() if k.rsplit('/', 1)[-1] == name]
+        if len(candidates) == 1:
+            return self[candidates[0]]
+        if not candidates and name in _derived_columns:
+            dependencies, func = _derived_columns[name]
+            value = func(self['h0'], *[self[dependency] for dependency in dependencies])
+            self['derived/' + name] = value
+            return value
+        raise KeyError(key)
+
+    def select(self, fields, include_h0_volh):
+        """Returns a new _catalogue with only the given fields (including any
+        derived columns), in the order they were given"""
+        data = _catalogue()
+        if include_h0_volh:
+            data['h0'] = self['h0']
+            data['vol'] = self['vol']
+        for gname, dsnames in fields.items():
+            for dsname in dsnames:
+                data['%s/%s' % (gname, dsname)] = self['%s/%s' % (gname, dsname)]
+        return data
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+def _read_catalogue(model_dir, snapshot, fields, subvolumes, include_h0_volh):
+
+    fnames = _hdf5_fnames(model_dir, snapshot, subvolumes, 'galaxies.hdf5')
+    full_names = ['%s/%s' % (gname, dsname)
+                  for gname, dsnames in fields.items() for dsname in dsnames]
+
+    # First pass: collect the shape and type of each dataset on each file
+    data = _catalogue()
+    lengths = collections.defaultdict(list)
+    dtypes = {}
+    shapes = {}
+    for idx, fname in enumerate(fnames):
+        with h5py.File(fname, 'r') as f:
+            if idx == 0 and include_h0_volh:
+                data['h0'] = f['cosmology/h'][()]
+                data['vol'] = f['run_info/effective_volume'][()] * len(subvolumes)
+            for full_name in full_names:
+                ds = f[full_name]
+                if idx == 0:
+                    dtypes[full_name] = ds.dtype
+                    shapes[full_name] = ds.shape[1:]
+                elif ds.shape[1:] != shapes[full_name]:
+                    raise ValueError('inconsistent shapes for %s: %r / %r' % (full_name, ds.shape[1:], shapes[full_name]))
+                lengths[full_name].append(ds.shape[0])
+
+    # Allocate each output buffer only once
+    for full_name in full_names:
+        data[full_name] = np.empty((sum(lengths[full_name]),) + shapes[full_name], dtype=dtypes[full_name])
+
+    # Second pass: read each dataset directly into its final place
+    for idx, fname in enumerate(fnames):
+        print('Reading galaxies data from %s' % fname)
+        with h5py.File(fname, 'r') as f:
+            for full_name in full_names:
+                start = sum(lengths[full_name][:idx])
+                n = lengths[full_name][idx]
+                if n:
+                    f[full_name].read_direct(data[full_name], dest_sel=np.s_[start:start + n])
+
+    return data
+
+@contextlib.contextmanager
+def _exclusive_lock(fname):
+    """Holds an exclusive lock on fname (shared by all processes) while in
+    this context. Where fcntl is not available (e.g., on Windows) the lock is
+    held instead by creating fname, which must not exist, and removing it
+    afterwards"""
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    if fcntl is not None:
+        with open(fname, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+        return
+
+    waiting = False
+    while True:
+        try:
+            fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except OSError:
+            if not waiting:
+                print('Waiting for lock %s (remove it if no other process is using it)' % fname)
+                waiting = True
+            time.sleep(0.5)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(fname)
+
+def _cache_fname(snapshot_dir, name):
+    return os.path.join(snapshot_dir, name.replace('/', '.') + '.npy')
+
+def _save_cached(fname, value):
+    with open(fname + '.tmp', 'wb') as f:
+        np.save(f, value)
+    os.rename(fname + '.tmp', fname)
+
+def _load_cached(fname):
+    try:
+        return np.load(fname, mmap_mode='r')
+    except ValueError:
+        # empty arrays cannot be memory-mapped
+        return np.load(fname)
+
+def _file_version(fname):
+    """Returns a string identifying the contents of the given galaxies.hdf5
+    file: a hash of the datasets hashes found in its up to date manifest, as
+    written by scripts/galaxies_manifest.py, or its size and modification time"""
+    st = os.stat(fname)
+    try:
+        with open(os.path.join(os.path.dirname(fname), 'galaxies.manifest.json')) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        manifest = None
+    if manifest and manifest.get('file') == {'size': st.st_size, 'mtime': st.st_mtime}:
+        hashes = json.dumps(manifest['datasets'], sort_keys=True)
+        return hashlib.md5(hashes.encode('utf8')).hexdigest()
+    return '%d:%r' % (st.st_size, st.st_mtime)
+
+def _read_cached_catalogue(cache_dir, model_dir, snapshot, fields, subvolumes, include_h0_volh):
+    """Like _read_catalogue, but going through the snapshot cache under cache_dir.
+
+    Each (snapshot, field) pair is stored once as an .npy file. Fields missing
+    from the cache are read from the galaxies.hdf5 files by whichever process
+    first needs them (while holding a lock on the snapshot), and all fields are
+    then returned as read-only memory-mapped arrays. Derived columns are
+    stored likewise, after calculating them from their (cached) dependencies.
+    Entries are keyed by the modification time of the galaxies.hdf5 files (or
+    their contents hash, see _file_version), so a cache directory can be
+    safely reused across runs."""
+
+    # Rewritten galaxies files (e.g., after re-running shark) get a new entry,
+    # unless their manifests show that their contents didn't change
+    fnames = _hdf5_fnames(model_dir, snapshot, subvolumes, 'galaxies.hdf5')
+    versions = ','.join(_file_version(fname) for fname in sorted(set(fnames)))
+    key = '%s:%s:%s' % (os.path.abspath(model_dir), ','.join(map(str, subvolumes)), versions)
+    key = hashlib.md5(key.encode('utf8')).hexdigest()
+    snapshot_dir = os.path.join(cache_dir, key, str(snapshot))
+    try:
+        os.makedirs(snapshot_dir)
+    except OSError:
+        pass
+
+    full_names = ['%s/%s' % (gname, dsname)
+                  for gname, dsnames in fields.items() for dsname in dsnames]
+    scalar_names = ['h0', 'vol'] if include_h0_volh else []
+
+    with _exclusive_lock(os.path.join(snapshot_dir, 'lock')):
+        missing_fields = collections.OrderedDict()
+        missing_derived = []
+        for full_name in full_names:
+            if not os.path.exists(_cache_fname(snapshot_dir, full_name)):
+                gname, dsname = full_name.rsplit('/', 1)
+                if gname == 'derived':
+                    missing_derived.append(full_name)
+                else:
+                    missing_fields.setdefault(gname, []).append(dsname)
+        missing_h0_volh = any(not os.path.exists(_cache_fname(snapshot_dir, name)) for name in scalar_names)
+
+        if missing_fields or missing_h0_volh:
+            data = _read_catalogue(model_dir, snapshot, missing_fields, subvolumes, missing_h0_volh)
+            for name, value in data.items():
+                _save_cached(_cache_fname(snapshot_dir, name), value)
+            del data
+
+        if missing_derived:
+            data = _catalogue()
+            data['h0'] = np.load(_cache_fname(snapshot_dir, 'h0'))[()]
+            for full_name in full_names:
+                if not full_name.startswith('derived/'):
+                    data[full_name] = _load_cached(_cache_fname(snapshot_dir, full_name))
+            for full_name in missing_derived:
+                _save_cached(_cache_fname(snapshot_dir, full_name), data[full_name])
+            del data
+
+    print('Reading cached galaxies data from %s' % snapshot_dir)
+    data = _catalogue()
+    for name in scalar_names:
+        data[name] = np.load(_cache_fname(snapshot_dir, name))[()]
+    for full_name in full_names:
+        data[full_name] = _load_cached(_cache_fname(snapshot_dir, full_name))
+    return data
+
+def read_catalogue(model_dir, snapshot, fields, subvolumes, include_h0_volh=True):
+    """Read the galaxies.hdf5 files for the given model/snapshot/subvolumes
+
+    All requested datasets are first sized across all subvolumes so a single
+    output buffer per field is allocated, and data is then read directly into
+    those buffers. The result is a _catalogue, optionally starting with h0 and
+    the total volume (under the 'h0' and 'vol' keys).
+
+    Derived columns (see derived_column) can be requested as the fields of
+    a 'derived' group; the galaxies fields they depend on are then read too,
+    but only returned if requested.
+
+    If the SHARK_PLOT_CACHE_DIR environment variable is set, data is read
+    through a snapshot cache stored in that directory, and fields are returned
+    as read-only, memory-mapped arrays shared by all processes using it."""
+
+    if 'derived' not in fields:
+        read_fields, read_h0_volh = fields, include_h0_volh
+    else:
+        read_fields, read_h0_volh = _split_derived(fields), True
+
+    cache_dir = os.environ.get('SHARK_PLOT_CACHE_DIR')
+    if cache_dir:
+        if 'derived' in fields:
+            read_fields['derived'] = fields['derived']
+        data = _read_cached_catalogue(cache_dir, model_dir, snapshot, read_fields, subvolumes, read_h0_volh)
+    else:
+        data = _read_catalogue(model_dir, snapshot, read_fields, subvolumes, read_h0_volh)
+
+    if read_fields is fields:
+        return data
+    return data.select(fields, include_h0_volh)
+
 def read_data(model_dir, snapshot, fields, subvolumes, include_h0_volh=True):
-    """Read the galaxies.hdf5 file for the given model/snapshot/subvolume"""
+    """Read the galaxies.hdf5 file for the given model/snapshot/subvolume
 
-    data = collections.OrderedDict()
-    for idx, subv in enumerate(subvolumes):
+    This returns the values of read_catalogue as a list, in the same order"""
+    return list(read_catalogue(model_dir, snapshot, fields, subvolumes, include_h0_volh).values())
+
+def iter_catalogue(model_dir, snapshot, fields, subvolumes, include_h0_volh=True, chunk_size=None):
+    """Like read_catalogue, but yields the data of one subvolume at a time,
+    or of at most `chunk_size` rows of a subvolume at a time, so only one such
+    chunk needs to be held in memory. h0 and vol (if included) are those of
+    the whole data set for all chunks"""
 
-        #fname = os.path.join(model_dir, str(snapshot), str(subv), 'galaxies.hdf5')
-        fname = os.path.join(model_dir, str(snapshot), 'multiple_batches', 'galaxies.hdf5')
+    fnames = _hdf5_fnames(model_dir, snapshot, subvolumes, 'galaxies.hdf5')
+    read_fields = _split_derived(fields)
+    full_names = ['%s/%s' % (gname, dsname)
+                  for gname, dsnames in read_fields.items() for dsname in dsnames]
+
+    for fname in fnames:
         print('Reading galaxies data from %s' % fname)
         with h5py.File(fname, 'r') as f:
-            if idx == 0 and include_h0_volh:
-                data['h0'] = f['cosmology/h'].value
-                data['vol'] = f['run_info/effective_volume'].value * len(subvolumes)
-
-            for gname, dsnames in fields.items():
-                group = f[gname]
-                for dsname in dsnames:
-                    full_name = '%s/%s' % (gname, dsname)
-                    l = data.get(full_name, None)
-                    if l is None:
-                        l = group[dsname].value
-                    else:
-                        l = np.concatenate([l, group[dsname].value])
-                    data[full_name] = l
-
-    return list(data.values())
+            lengths = set(f[full_name].shape[0] for full_name in full_names)
+            if chunk_size and len(lengths) > 1:
+                raise ValueError('Datasets of different lengths cannot be read in chunks from %s' % fname)
+            n = max(lengths) if lengths else 0
+            step = chunk_size or max(n, 1)
+            for start in range(0, max(n, 1), step):
+                data = _catalogue()
+                data['h0'] = f['cosmology/h'][()]
+                data['vol'] = f['run_info/effective_volume'][()] * len(subvolumes)
+                for full_name in full_names:
+                    data[full_name] = f[full_name][start:start + step]
+                yield data.select(fields, include_h0_volh)
+
+def streaming_chunk_size():
+    """Returns the number of rows to read at a time in streaming mode, as given
+    by the SHARK_PLOT_CHUNK_SIZE environment variable (0 meaning a whole
+    subvolume at a time), or None if streaming mode is not enabled"""
+    chunk_size = os.environ.get('SHARK_PLOT_CHUNK_SIZE')
+    if not chunk_size:
+        return None
+    return int(chunk_size)
+
+def iter_data(model_dir, snapshot, fields, subvolumes, include_h0_volh=True):
+    """Yields (hdf5_data, stats) pairs to be fed to prepare_data functions
+
+    Normally this yields the full data, as returned by read_data, only once,
+    together with the utilities_statistics module. In streaming mode (see
+    streaming_chunk_size) it yields each chunk of the data instead, together
+    with the same utilities_statistics.streaming_statistics object, which
+    merges the statistics calculated on each chunk with the previous ones"""
+
+    stats = us if streaming_chunk_size() is None else us.streaming_statistics()
+    for hdf5_data in _iter_chunks(model_dir, snapshot, fields, subvolumes, include_h0_volh):
+        if stats is not us:
+            stats.next_chunk()
+        yield hdf5_data, stats
+
+def _iter_chunks(model_dir, snapshot, fields, subvolumes, include_h0_volh=True):
+    """Yields the data iter_data feeds to prepare_data functions"""
+    chunk_size = streaming_chunk_size()
+    if chunk_size is None:
+        yield read_data(model_dir, snapshot, fields, subvolumes, include_h0_volh)
+        return
+    for data in iter_catalogue(model_dir, snapshot, fields, subvolumes, include_h0_volh, chunk_size):
+        yield list(data.values())
+
+def prefetch_depth():
+    """Returns how many items prefetch reads ahead, as given by the
+    SHARK_PLOT_PREFETCH environment variable (1 by default, 0 disables it)"""
+    return int(os.environ.get('SHARK_PLOT_PREFETCH', 1))
+
+def prefetch_max_bytes():
+    """Returns the maximum amount of memory used by the items prefetch has
+    read ahead, as given in MB by the SHARK_PLOT_PREFETCH_MAX_MB environment
+    variable, or None if not limited"""
+    max_mb = os.environ.get('SHARK_PLOT_PREFETCH_MAX_MB')
+    if not max_mb:
+        return None
+    return int(float(max_mb) * 1024 * 1024)
+
+def _nbytes(obj):
+    """Returns the memory taken by the (possibly nested) arrays in obj.
+    Memory-mapped arrays are not counted, as they are only paged in on use"""
+    if isinstance(obj, np.memmap):
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        obj = obj.values()
+    if isinstance(obj, (list, tuple, type({}.values()))):
+        return sum(_nbytes(o) for o in obj)
+    return 0
+
+def prefetch(iterable, depth=None, max_bytes=None):
+    """Yields the items of iterable, which are produced on a background thread
+    while the caller processes the previous ones. This is meant for
+    iterables reading data (e.g., one snapshot at a time), so reading the
+    next item overlaps with processing the current one.
+
+    At most `depth` items (see prefetch_depth) are read ahead, and no further
+    item is read while those read ahead take more than `max_bytes` (see
+    prefetch_max_bytes); the item being read when reaching that limit is
+    still finished. Exceptions raised by iterable are re-raised to the caller"""
+
+    depth = prefetch_depth() if depth is None else depth
+    max_bytes = prefetch_max_bytes() if max_bytes is None else max_bytes
+    if depth <= 0:
+        for item in iterable:
+            yield item
+        return
+
+    ready = collections.deque()
+    state = {'nbytes': 0, 'stop': False}
+    cond = threading.Condition()
+    end = object()
+
+    def has_room():
+        if len(ready) >= depth:
+            return False
+        return not max_bytes or not ready or state['nbytes'] < max_bytes
+
+    def produce():
+        try:
+            for item in iterable:
+                nbytes = _nbytes(item)
+                with cond:
+                    ready.append((item, nbytes, None))
+                    state['nbytes'] += nbytes
+                    cond.notify_all()
+                    while not state['stop'] and not has_room():
+                        cond.wait()
+                    if state['stop']:
+                        return
+            error = None
+        except Exception as e:
+            error = e
+        with cond:
+            ready.append((end, 0, error))
+            cond.notify_all()
+
+    thread = threading.Thread(target=produce, name='shark-plots-prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            with cond:
+                while not ready:
+                    cond.wait()
+                item, nbytes, error = ready.popleft()
+                state['nbytes'] -= nbytes
+                cond.notify_all()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        with cond:
+            state['stop'] = True
+            cond.notify_all()
+
+def iter_snapshots_data(model_dir, snapshots, fields, subvolumes, include_h0_volh=True):
+    """Yields (index, hdf5_data, stats) triplets for each of the given
+    snapshots in turn, as iter_data does for a single one. Data is read ahead
+    on a background thread while the previous data is processed (see prefetch)"""
+
+    chunks = ((index, hdf5_data) for index, snapshot in enumerate(snapshots)
+              for hdf5_data in _iter_chunks(model_dir, snapshot, fields, subvolumes, include_h0_volh))
+    streaming = streaming_chunk_size() is not None
+    stats, last_index = us, None
+    for index, hdf5_data in prefetch(chunks):
+        if streaming:
+            if index != last_index:
+                stats, last_index = us.streaming_statistics(), index
+            stats.next_chunk()
+        yield index, hdf5_data, stats
+
+def read_snapshots_data(model_dir, snapshots, fields, subvolumes, include_h0_volh=True):
+    """Yields the result of read_data for each of the given snapshots in turn,
+    reading the next ones on a background thread (see prefetch)"""
+    return prefetch(read_data(model_dir, snapshot, fields, subvolumes, include_h0_volh)
+                    for snapshot in snapshots)
+
+def get_num_procs():
+    """Returns the number of processes modules can use to prepare their data,
+    as given by the SHARK_PLOT_PROCS environment variable (1 by default).
+    Modules running within a process pool already (e.g., when run by all.py)
+    always use one, so the pool's processes don't start processes of their own"""
+    if multiprocessing.current_process().daemon:
+        return 1
+    return int(os.environ.get('SHARK_PLOT_PROCS', 1))
+
+def _reseed():
+    # Forked processes would otherwise all draw the same random numbers
+    np.random.seed()
+    us._random.seed()
+
+def _call(func_and_args):
+    func, args = func_and_args
+    return func(*args)
+
+def parallel_map(func, args):
+    """Returns [func(*a) for a in args], evaluated using get_num_procs() processes"""
+    args = list(args)
+    n_procs = min(get_num_procs(), len(args))
+    if n_procs <= 1:
+        return [func(*a) for a in args]
+    print("Using %d processes to prepare data" % n_procs)
+    pool = multiprocessing.Pool(n_procs, initializer=_reseed)
+    try:
+        # Pool.starmap is not available in python 2
+        return pool.map(_call, [(func, a) for a in args])
+    finally:
+        pool.terminate()
+
+def _read_and_prepare(read, prepare, args):
+    return prepare(*read(*args))
+
+def map_snapshots(read, prepare, args):
+    """Returns [prepare(*read(*a)) for a in args]. With several processes (see
+    get_num_procs) each item is read and prepared in parallel; otherwise the
+    data of the next items is read while the current one is prepared (see
+    prefetch)"""
+    args = list(args)
+    if min(get_num_procs(), len(args)) > 1:
+        return parallel_map(_read_and_prepare, [(read, prepare, a) for a in args])
+    return [prepare(*data) for data in prefetch(read(*a) for a in args)]
+
+def _prepare_subvolume(prepare_data, model_dir, snapshot, fields, subvolume, n_subvolumes, index, outputs, exact):
+    """Runs prepare_data for a single subvolume on zeroed copies of outputs"""
+
+    outputs = [np.zeros_like(output) for output in outputs]
+    if exact:
+        hdf5_data = read_data(model_dir, snapshot, fields, [subvolume])
+        return outputs, prepare_data(hdf5_data, index, *outputs, stats=us), None, None
+
+    chunk_size = streaming_chunk_size()
+    if chunk_size is None:
+        chunks = [read_catalogue(model_dir, snapshot, fields, [subvolume])]
+    else:
+        chunks = iter_catalogue(model_dir, snapshot, fields, [subvolume], chunk_size=chunk_size or None)
+
+    stats = us.streaming_statistics()
+    for data in chunks:
+        # Make sure that the total volume takes into account all subvolumes
+        hdf5_data = list(data.values())
+        hdf5_data[1] = hdf5_data[1] * n_subvolumes
+        stats.next_chunk()
+        result = prepare_data(hdf5_data, index, *outputs, stats=stats)
+
+    empty = hdf5_data[:2] + [datum[:0] for datum in hdf5_data[2:]]
+    return outputs, result, stats, empty
+
+def map_reduce_data(prepare_data, model_dir, snapshots, fields, subvolumes, outputs):
+    """Runs prepare_data(hdf5_data, index, *outputs, stats=stats) on the data
+    of each of the given snapshots, and returns a list with its results.
+
+    With a single process (see get_num_procs) data is read and fed to
+    prepare_data as given by iter_snapshots_data, so the next snapshot is read
+    while the current one is prepared. Otherwise each (snapshot, subvolume)
+    is prepared in parallel on zeroed copies of the outputs, which are then
+    added up; for that, prepare_data must only add to the outputs, or assign
+    them statistics calculated by stats. The statistics of all subvolumes of a
+    snapshot are merged, and fed once more to prepare_data, together with no
+    data, to assign their final values"""
+
+    if get_num_procs() == 1:
+        results = []
+        for index, hdf5_data, stats in iter_snapshots_data(model_dir, snapshots, fields, subvolumes):
+            result = prepare_data(hdf5_data, index, *outputs, stats=stats)
+            if index == len(results):
+                results.append(result)
+            else:
+                results[index] = result
+        return results
+
+    # With a single subvolume there is nothing to merge, and exact statistics
+    # can be used
+    exact = len(subvolumes) == 1
+    tasks = [(prepare_data, model_dir, snapshot, fields, subvolume, len(subvolumes), index, outputs, exact)
+             for index, snapshot in enumerate(snapshots) for subvolume in subvolumes]
+    partials = parallel_map(_prepare_subvolume, tasks)
+
+    results = []
+    for index in range(len(snapshots)):
+        snapshot_partials = partials[index * len(subvolumes):(index + 1) * len(subvolumes)]
+        for partial_outputs, _, _, _ in snapshot_partials:
+            for output, partial_output in zip(outputs, partial_outputs):
+                output += partial_output
+        _, result, stats, empty = snapshot_partials[0]
+        if not exact:
+            for _, _, other_stats, _ in snapshot_partials[1:]:
+                stats.merge(other_stats)
+            stats.next_chunk()
+            result = prepare_data(empty, index, *outputs, stats=stats)
+        results.append(result)
+    return results
 
 def read_sfh(model_dir, snapshot, fields, subvolumes, include_h0_volh=True):
     """Read the galaxies.hdf5 file for the given model/snapshot/subvolume"""
@@ -287,90 +909,122 @@ def read_sfh(model_dir, snapshot, fields, subvolumes, include_h0_volh=True):
     return list(data.values()), delta_t, LBT
 
 
-def read_photometry_data(model_dir, snapshot, subvolumes):
-    """Read the SharkSED.csv file for the given model/snapshot/subvolume"""
+def _photometry_npy_fname(csv_fname):
+    return os.path.splitext(csv_fname)[0] + '.npy'
 
-    nbands = None
-    seds = None
-    ids = None
-    for subv in subvolumes:
+def convert_photometry_data(csv_fname, npy_fname=None, chunk_rows=100000):
+    """Converts a Shark-SED CSV file into a binary .npy sidecar file.
 
-        #fname = os.path.join(model_dir, 'Photometry', str(snapshot), str(subv), 'Shark-SED.csv')
-        fname = os.path.join(model_dir, 'Photometry', str(snapshot), 'multiple_batches', 'Shark-SED.csv')
-        print('Reading photometry data from %s' % fname)
-        my_data = np.genfromtxt(fname, delimiter=',', skip_header=1)
+    The CSV file is parsed `chunk_rows` lines at a time, and each chunk is
+    written directly into the memory-mapped output file, so memory usage stays
+    bounded regardless of the size of the CSV file."""
 
-        # Make sure all files come with the same number of bands
-        _nbands = (len(my_data[0])-1)/5/2/2
-        if nbands is None:
-            nbands = _nbands
-            print('Number of bands %s' % nbands)
-        elif nbands != _nbands:
-            raise ValueError('inconsistent number of bands found: %d / %d' % (nbands, _nbands))
-        
-        # Reshape the 1-d data of each line to 4-d data with the following dimension lengths
-        # 2: absolute and apparent magnitude; 
-        # 2: no dust and dust.
-        # 5: bulge disk-instabilities, bulge mergers, bulge, disk and total; 
-        # nbands: each of the bands
-        _seds = my_data[:,1:].reshape((len(my_data), 2, 2, 5, nbands))
-        _ids = my_data[:,0]
+    npy_fname = npy_fname or _photometry_npy_fname(csv_fname)
+    print('Converting photometry data from %s to %s' % (csv_fname, npy_fname))
 
-        # Append values to global lists
-        if seds is None:
-            seds = _seds
-        else:
-            seds = np.concatenate([seds, _seds])
-        if ids is None:
-            ids = _ids
-        else:
-            ids = np.concatenate([ids, _ids])
-
-    return (seds, ids, nbands)
+    # The number of columns is taken from the data, as the header's names
+    # don't necessarily match it
+    with open(csv_fname) as f:
+        header = f.readline()
+        lines = (line for line in f if line.strip())
+        first = next(lines, None)
+        ncols = len((first or header).split(','))
+        nrows = sum(1 for _ in lines) + (first is not None)
 
-def read_photometry_data_variable_tau_screen(model_dir, snapshot, subvolumes):
-    """Read the SharkSED.csv file for the given model/snapshot/subvolume"""
+    # Written under a unique name first, so concurrent conversions (and
+    # readers) never see each other's partial outputs
+    fd, tmp_fname = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(npy_fname) + '.',
+                                     dir=os.path.dirname(os.path.abspath(npy_fname)))
+    os.close(fd)
+    try:
+        if nrows == 0:
+            with open(tmp_fname, 'wb') as out:
+                np.save(out, np.empty((0, ncols)))
+        else:
+            out = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=np.float64, shape=(nrows, ncols))
+            with open(csv_fname) as f:
+                f.readline()
+                lines = (line for line in f if line.strip())
+                start = 0
+                while start < nrows:
+                    chunk = np.loadtxt(itertools.islice(lines, chunk_rows), delimiter=',', ndmin=2)
+                    if chunk.shape[1] != ncols:
+                        raise ValueError('inconsistent number of columns in %s: %d / %d' % (csv_fname, chunk.shape[1], ncols))
+                    out[start:start + len(chunk)] = chunk
+                    start += len(chunk)
+            out.flush()
+            del out
+        os.rename(tmp_fname, npy_fname)
+    except BaseException:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+
+def _read_photometry_table(fname):
+    """Reads a Shark-SED CSV file as a 2-D array, going through its binary
+    sidecar, which is created the first time. The CSV file is only parsed
+    directly if the sidecar cannot be created."""
+
+    npy_fname = _photometry_npy_fname(fname)
+    is_fresh = lambda: os.path.exists(npy_fname) and os.path.getmtime(npy_fname) >= os.path.getmtime(fname)
+    if not is_fresh():
+        # Only one process converts the file, the rest wait for it to finish
+        try:
+            with _exclusive_lock(npy_fname + '.lock'):
+                if not is_fresh():
+                    convert_photometry_data(fname, npy_fname)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning('Cannot use binary sidecar for %s (%s), reading CSV data instead', fname, e)
+            print('Reading photometry data from %s' % fname)
+            return np.genfromtxt(fname, delimiter=',', skip_header=1)
+
+    print('Reading photometry data from %s' % npy_fname)
+    return _load_cached(npy_fname)
+
+def _read_photometry(model_dir, snapshot, subvolumes, basename, ncols_extra):
+    """Reads the given Shark-SED file for all subvolumes, returning the SEDs,
+    the ids, the number of bands and the `ncols_extra` columns in between"""
 
     nbands = None
-    seds = None
-    ids = None
+    seds = []
+    ids = []
+    extra = []
     for subv in subvolumes:
 
-        #fname = os.path.join(model_dir, 'Photometry', str(snapshot), str(subv), 'Shark-SED-tau-EAGLE.csv')
-        fname = os.path.join(model_dir, 'Photometry', str(snapshot), 'multiple_batches', 'Shark-SED-tau-EAGLE.csv')
-        print('Reading photometry data from %s' % fname)
-        my_data = np.genfromtxt(fname, delimiter=',', skip_header=1)
+        #fname = os.path.join(model_dir, 'Photometry', str(snapshot), str(subv), basename)
+        fname = os.path.join(model_dir, 'Photometry', str(snapshot), 'multiple_batches', basename)
+        my_data = _read_photometry_table(fname)
 
         # Make sure all files come with the same number of bands
-        _nbands = (len(my_data[0])-2)/5/2/2
+        _nbands = (my_data.shape[1] - 1 - ncols_extra) // 5 // 2 // 2
         if nbands is None:
             nbands = _nbands
             print('Number of bands %s' % nbands)
         elif nbands != _nbands:
             raise ValueError('inconsistent number of bands found: %d / %d' % (nbands, _nbands))
-        
+
         # Reshape the 1-d data of each line to 4-d data with the following dimension lengths
-        # 2: absolute and apparent magnitude; 
+        # 2: absolute and apparent magnitude;
         # 2: no dust and dust.
-        # 5: bulge disk-instabilities, bulge mergers, bulge, disk and total; 
+        # 5: bulge disk-instabilities, bulge mergers, bulge, disk and total;
         # nbands: each of the bands
-        _seds = my_data[:,2:].reshape((len(my_data), 2, 2, 5, nbands))
-        _ids = my_data[:,0]
-        _tau_screen = my_data[:,1]
+        seds.append(my_data[:,1 + ncols_extra:].reshape((len(my_data), 2, 2, 5, nbands)))
+        ids.append(my_data[:,0])
+        extra.append(my_data[:,1:1 + ncols_extra])
 
-        # Append values to global lists
-        if seds is None:
-            seds = _seds
-        else:
-            seds = np.concatenate([seds, _seds])
-        if ids is None:
-            ids = _ids
-            tau_screen = _tau_screen
-        else:
-            ids = np.concatenate([ids, _ids])
-            tau_screen = np.concatenate([tau_screen,_tau_screen])
+    # Only copy data when putting together more than one subvolume
+    join = lambda l: l[0] if len(l) == 1 else np.concatenate(l)
+    return join(seds), join(ids), nbands, join(extra)
+
+def read_photometry_data(model_dir, snapshot, subvolumes):
+    """Read the SharkSED.csv file for the given model/snapshot/subvolume"""
+    seds, ids, nbands, _ = _read_photometry(model_dir, snapshot, subvolumes, 'Shark-SED.csv', 0)
+    return (seds, ids, nbands)
 
-    return (seds, ids, nbands, tau_screen)
+def read_photometry_data_variable_tau_screen(model_dir, snapshot, subvolumes):
+    """Read the SharkSED.csv file for the given model/snapshot/subvolume"""
+    seds, ids, nbands, extra = _read_photometry(model_dir, snapshot, subvolumes, 'Shark-SED-tau-EAGLE.csv', 1)
+    return (seds, ids, nbands, extra[:,0])
 
 
 # If called as a program, print information taken from a configuration file
@@ -825,7 +825,8 @@ def main(modeldir, outdir, redshift_table, subvols, obsdir):
         subvol_data = common.read_data(modeldir, redshift_table[0], fields, [subvol])
         max_bhs_subvol = subvol_data[20].copy()
         if idx == 0:
-            hdf5_data        = subvol_data
+            # copy, as subvol_data can be read-only views of the snapshot cache
+            hdf5_data        = subvol_data[:3] + [np.array(datum) for datum in subvol_data[3:]]
             max_smbh         = max_bhs_subvol
         else:
             max_smbh = np.maximum(max_smbh, max_bhs_subvol)
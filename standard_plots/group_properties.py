@@ -22,6 +22,7 @@ import functools
 import numpy as np
 
 import common
+import halo_statistics
 import utilities_statistics as us
 
 ##################################
@@ -49,7 +50,7 @@ def prepare_ax(ax, xmin, xmax, ymin, ymax, xtit, ytit):
     yleg = ymax - 0.1 * (ymax-ymin)
     #ax.text(xleg, yleg, 'z=0')
 
-def prepare_data(hdf5_data):
+def prepare_data(hdf5_data, halos=None):
 
     bin_it = functools.partial(us.wmedians, xbins=xmf)
 
@@ -67,54 +68,35 @@ def prepare_data(hdf5_data):
 
     mHI_halos_stacking = np.zeros(shape = (len(xmf))) 
 
-    (unique_elements, counts_elements) = np.unique(id_halo, return_counts=True)
-
-    idmax = max(unique_elements)
-    print('number of halos: %d', len(unique_elements))
+    # All per-halo quantities are calculated at once for all halos
+    if halos is None:
+        halos = halo_statistics.halo_index(id_halo, typeg)
+    print('number of halos: %d', halos.ngroups)
     ind = np.where(typeg == 0)
     print('number of central galaxies: %d', len(typeg[ind]))
 
-  
-    mHI_halo   = np.zeros(shape = len(counts_elements))
-    mmass_halo = np.zeros(shape = len(counts_elements))
-    rvir_halo  = np.zeros(shape = len(counts_elements))
-    vvir_halo  = np.zeros(shape = len(counts_elements))
-    id_unique_halo = np.zeros(shape = len(counts_elements))
-    xyz_halo       = np.zeros(shape = (3,len(counts_elements)))
-    v_xyz_halo     = np.zeros(shape = (3,len(counts_elements)))
-
     print("will create vectors of halo mass and HI mass of individual groups")
     #create vector with halo masses and total HI masses in halos.
-    for i in range(0, len(counts_elements)):
-	#select galaxies that belong to this halo
-        ind = np.where(id_halo == unique_elements[i])
-        if(len(mhalo[ind]) > 0):
-                total_bar_mass = sum(mdisk[ind]) + sum(mbulge[ind]) + sum(mgas[ind]) + sum(mgas_bulge[ind]) + sum(mhot[ind])
-                mhalo_all      = mhalo[ind]
-                vvir_all       = vvir[ind]
-	        mmass_halo[i]  = mhalo_all[0] + total_bar_mass
-	        mHI_halo[i]    = (sum(mHI[ind]) * XH) #only HI
-                vvir_halo[i]   = vvir[0]
-                rvir_halo[i]   = G * mmass_halo[i] / pow(vvir_halo[i], 2.0)
-                id_unique_halo[i] = unique_elements[i]
-        #select central galaxy of this hal to assign positions and velocities to this halo.
-        ind = np.where((typeg == 0) & (id_halo == unique_elements[i]))
-        if(len(mhalo[ind]) > 0):
-           xyz_halo[0,i] = x[ind]
-           xyz_halo[1,i] = y[ind]
-           xyz_halo[2,i] = z[ind]
-           v_xyz_halo[0,i] = vx[ind]
-           v_xyz_halo[1,i] = vy[ind]
-           v_xyz_halo[2,i] = vz[ind]
- 
+    total_bar_mass = (halos.sums(mdisk, 'mstars_disk') + halos.sums(mbulge, 'mstars_bulge') +
+                      halos.sums(mgas, 'mgas_disk') + halos.sums(mgas_bulge, 'mgas_bulge') + halos.sums(mhot, 'mhot'))
+    mmass_halo = (halos.firsts(mhalo, 'mvir_hosthalo') + total_bar_mass).astype(np.float64)
+    mHI_halo   = (halos.sums(mHI, 'matom_disk') * XH).astype(np.float64) #only HI
+    # The virial velocity of the first galaxy is used for all halos
+    vvir_halo  = np.full(halos.ngroups, vvir[0] if len(vvir) else 0, dtype=np.float64)
+    rvir_halo  = G * mmass_halo / pow(vvir_halo, 2.0)
+
+    #the central galaxy of each halo assigns positions and velocities to the halo.
+    xyz_halo   = np.array([halos.centrals(x, 'position_x'), halos.centrals(y, 'position_y'), halos.centrals(z, 'position_z')], dtype=np.float64)
+    v_xyz_halo = np.array([halos.centrals(vx, 'velocity_x'), halos.centrals(vy, 'velocity_y'), halos.centrals(vz, 'velocity_z')], dtype=np.float64)
+
     print("will calculate total HI mass in groups")
     for i in range(0,len(xmf)):
-	mlow_r  = xmf[i] - dm/2.0
+        mlow_r  = xmf[i] - dm/2.0
         mhigh_r = xmf[i] + dm/2.0
-	#select halos in the mass range above
+        #select halos in the mass range above
         ind = np.where((np.log10(mmass_halo) >= mlow_r) & (np.log10(mmass_halo) < mhigh_r))
         if(len(mmass_halo[ind]) > 0):
-		mHI_halos_stacking[i] = np.log10(np.mean(mHI_halo[ind]))
+                mHI_halos_stacking[i] = np.log10(np.mean(mHI_halo[ind]))
 
     #select all satellite galaxies in halos with masses > 10^13.
     ind = np.where((mhalo > 1e12) & (typeg > 0))
@@ -126,19 +108,13 @@ def prepare_data(hdf5_data):
     sats_vy = vy[ind]
     sats_vz = vz[ind]
     sats_halo_id = id_halo[ind]
-    sats_vproj = np.zeros(shape = len(sats_x))
-    sats_rproj = np.zeros(shape = len(sats_x))
-
-    (unique_elements, counts_elements) = np.unique(sats_halo_id, return_counts=True)
-    for i in range(0, len(counts_elements)):
-        #select galaxies that belong to this halo
-        ind_gal = np.where(sats_halo_id == unique_elements[i])
-        ind_halo = np.where(id_unique_halo == unique_elements[i])
-        if(len(sats_vx[ind_gal]) > 0):
-           rthis_halo = rvir_halo[ind_halo]
-           vthis_halo = vvir_halo[ind_halo]
-           sats_vproj[ind_gal] = (sats_vx[ind_gal] - v_xyz_halo[0,ind_halo])/vthis_halo
-           sats_rproj[ind_gal] = (np.sqrt(pow(sats_x[ind_gal]-xyz_halo[0,ind_halo],2.0) + pow(sats_z[ind_gal]-xyz_halo[2,ind_halo],2.0) + pow(sats_y[ind_gal]-xyz_halo[1,ind_halo],2.0)))/rthis_halo
+
+    # Satellites are projected with respect to the central of their halo
+    sats_halo = halos.index(sats_halo_id)
+    rthis_halo = rvir_halo[sats_halo]
+    vthis_halo = vvir_halo[sats_halo]
+    sats_vproj = (sats_vx - v_xyz_halo[0,sats_halo])/vthis_halo
+    sats_rproj = (np.sqrt(pow(sats_x-xyz_halo[0,sats_halo],2.0) + pow(sats_z-xyz_halo[2,sats_halo],2.0) + pow(sats_y-xyz_halo[1,sats_halo],2.0)))/rthis_halo
 
     return (mHI_halos_stacking, sats_vproj, sats_rproj, sats_type)
 
@@ -161,7 +137,7 @@ def plot_HI_gas_fraction_groups(plt, output_dir, obs_dir, mHI_halos_stacking):
     xplot = xmf[ind]
     yplot = mHI_halos_stacking[ind]-xmf[ind]
     for i,j in zip (xplot,yplot):
-    	print i,j
+        print(i,j)
 
     ax.plot(xplot,yplot, color='k', linestyle='solid', label='Shark')
 
@@ -206,9 +182,12 @@ def main(model_dir, output_dir, redshift_table, subvols, obs_dir):
                            'matom_bulge', 'mmol_bulge', 'mgas_bulge', 'mvir_hosthalo',
                            'id_halo_tree', 'mhot', 'position_x', 'position_y', 'position_z', 
                            'velocity_x', 'velocity_y', 'velocity_z', 'vvir_hosthalo')}
-    hdf5_data = common.read_data(model_dir, redshift_table[0], fields, subvols)
+    data = common.read_catalogue(model_dir, redshift_table[0], fields, subvols)
+    hdf5_data = list(data.values())
+    halos = halo_statistics.get_halo_index(model_dir, redshift_table[0], subvols,
+                                           data['id_halo_tree'], data['type'])
 
-    (mHI_halos_stacking, sats_vproj, sats_rproj, sats_type) = prepare_data(hdf5_data)
+    (mHI_halos_stacking, sats_vproj, sats_rproj, sats_type) = prepare_data(hdf5_data, halos)
 
     plot_HI_gas_fraction_groups(plt, output_dir, obs_dir, mHI_halos_stacking)
     plot_caustic_halos(plt, output_dir, sats_vproj, sats_rproj, sats_type)
@@ -0,0 +1,112 @@
+#
+# ICRAR - International Centre for Radio Astronomy Research
+# (c) UWA - The University of Western Australia, 2019
+# Copyright by UWA (in the framework of the ICRAR)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Per-host halo statistics of galaxy properties"""
+
+import os
+
+import numpy as np
+
+import common
+import utilities_statistics as us
+
+
+class halo_index(us.grouped_statistics):
+    """Galaxies grouped by their host halo (their id_halo_tree), sorted only
+    once, so that per-halo statistics of any galaxy column are calculated
+    for all halos at once.
+
+    Halos are sorted by id. The statistics of named columns are remembered,
+    so different modules (or plots) asking for the same statistic of the same
+    column array of a snapshot only calculate it once. Asking for a statistic
+    under the same name but of a different array calculates it again."""
+
+    def __init__(self, id_halo, typeg):
+        super(halo_index, self).__init__(id_halo)
+        self._results = {}
+
+        # The central galaxy of each halo, or -1 if it has none
+        cen = np.flatnonzero(np.ravel(typeg) == 0)
+        self.central = np.full(self.ngroups, -1, dtype=np.intp)
+        self.central[self.group[cen]] = cen
+
+    def _cached(self, stat, name, y, *args):
+        if name is None:
+            return stat(y, *args)
+        # Results are only reused for the very same array they were calculated
+        # from (which is kept, so its id can't be reused by another one)
+        key = (stat.__name__, name) + args
+        y = np.asarray(y)
+        cached = self._results.get(key)
+        if cached is None or cached[0] is not y or cached[1] != (y.shape, y.dtype):
+            cached = self._results[key] = (y, (y.shape, y.dtype), stat(y, *args))
+        return cached[2]
+
+    def sums(self, y, name=None):
+        """Returns the sum of y in each halo, remembered under name if given"""
+        return self._cached(super(halo_index, self).sums, name, y)
+
+    def means(self, y, name=None):
+        """Returns the mean of y in each halo, remembered under name if given"""
+        return self.sums(y, name) / self.counts
+
+    def maxs(self, y, name=None):
+        """Returns the maximum of y in each halo, remembered under name if given"""
+        return self._cached(super(halo_index, self).maxs, name, y)
+
+    def firsts(self, y, name=None):
+        """Returns the y value of the first galaxy of each halo, remembered
+        under name if given"""
+        return self._cached(super(halo_index, self).firsts, name, y)
+
+    def _centrals(self, y, default):
+        y = np.ravel(y)
+        result = np.full(self.ngroups, default, dtype=y.dtype)
+        has_central = self.central >= 0
+        result[has_central] = y[self.central[has_central]]
+        return result
+
+    def centrals(self, y, name=None, default=0):
+        """Returns the y value of the central galaxy of each halo (or default
+        for halos without one), remembered under name if given"""
+        return self._cached(self._centrals, name, y, default)
+
+    def of_galaxies(self, halo_values, galaxies=None):
+        """Returns the value of their halo for all galaxies, or for the given
+        galaxies (indices or a boolean mask) only"""
+        group = self.group if galaxies is None else self.group[galaxies]
+        return np.asarray(halo_values)[group]
+
+
+# Halo indices already built, by model, snapshot and subvolumes
+_halo_indices = {}
+
+def get_halo_index(model_dir, snapshot, subvolumes, id_halo=None, typeg=None):
+    """Returns the halo_index of the given model/snapshot/subvolumes, building
+    it only the first time it is asked for.
+
+    id_halo and typeg (the id_halo_tree and type of all galaxies) are read if
+    not given."""
+
+    key = (os.path.abspath(model_dir), snapshot, tuple(subvolumes))
+    if key not in _halo_indices:
+        if id_halo is None or typeg is None:
+            fields = {'galaxies': ('id_halo_tree', 'type')}
+            id_halo, typeg = common.read_data(model_dir, snapshot, fields, subvolumes, include_h0_volh=False)
+        _halo_indices[key] = halo_index(id_halo, typeg)
+    return _halo_indices[key]
@@ -177,8 +177,9 @@ def main(model_dir, outdir, redshift_table, subvols, obsdir):
 
     for index, snapshot in enumerate(snapshots):
 
-        hdf5_data = common.read_data(model_dir, snapshot, fields, subvols)
-        prepare_data(hdf5_data, hist, histsh, index)
+        # Histograms add up, so data can be read in chunks
+        for hdf5_data, _ in common.iter_data(model_dir, snapshot, fields, subvols):
+            prepare_data(hdf5_data, hist, histsh, index)
 
         h0, volh = hdf5_data[0], hdf5_data[1]
         if(volh > 0.):
@@ -239,111 +239,96 @@ def prepare_data(hdf5_data, index, redshift, mainseqsf, passive_fractions, hist_
 
     (h0, volh, sfr_disk, sfr_burst, mdisk, mbulge, rstar_disk, mBH, mHI, mH2, 
      mgas_disk, mHI_bulge, mH2_bulge, mgas_bulge, mgas_metals_disk, mgas_metals_bulge, 
-     mstars_metals_disk, mstars_metals_bulge, typeg, mvir_hosthalo, rstar_bulge) = hdf5_data
+     mstars_metals_disk, mstars_metals_bulge, typeg, mvir_hosthalo, rstar_bulge,
+     mstars, sfr_tot, log_mstars, log_ssfr, log_sfr) = hdf5_data
 
     bin_it = functools.partial(us.wmedians, xbins=xmf)
     bin_it_2sigma = functools.partial(us.wmedians_2sigma, xbins=xmf)
 
-    mgas = mgas_disk+mgas_bulge
-    mgas_metals = mgas_metals_disk+mgas_metals_bulge
-
-    mass          = np.zeros(shape = len(mdisk))
+    mass          = log_mstars
+    sfr           = log_sfr
     mhalo         = np.zeros(shape = len(mdisk))
-    sfr           = np.zeros(shape = len(mdisk))
     active_flag   = np.zeros(shape = len(mdisk))
 
-    ind = np.where(mdisk+mbulge > 0)
-    mass[ind] = np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0))
+    ind = np.where(mstars > 0)
     mhalo[ind] = np.log10(mvir_hosthalo[ind]) - np.log10(float(h0))
 
-    ind = np.where(sfr_disk+sfr_burst > 0)
-    sfr[ind] = np.log10((sfr_disk[ind]+sfr_burst[ind])/h0/GyrToYr)
+    # Galaxies are assigned to mass bins only once, and each statistic below
+    # then selects the galaxies it needs among them
+    select = lambda b, cond: b.select(b.values(cond))
+    mass2_bins = us.binned_statistics(mass, xmf2)
 
-    ind = np.where((sfr_disk+sfr_burst > 0) & (mdisk+mbulge > 0))
-    passive_fractions[index,0,:] = us.fractions(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)), y = np.log10((sfr_disk[ind]+sfr_burst[ind])/(mdisk[ind]+mbulge[ind])), xbins=xmf2, ythresh=-2.2)
+    ind = np.where((sfr_tot > 0) & (mstars > 0))
+    passive_fractions[index,0,:] = select(mass2_bins, (sfr_tot > 0) & (mstars > 0)).fractions(log_ssfr, -2.2)
     passive_fractions[index,0,:] = 1.0 - passive_fractions[index,0,:] 
-    H, _ = np.histogram(np.log10((sfr_disk[ind]+sfr_burst[ind])/(mdisk[ind]+mbulge[ind])),bins=np.append(ssfrbins,ssfrupp))
+    H, _ = np.histogram(log_ssfr[ind],bins=np.append(ssfrbins,ssfrupp))
     hist_ssfr[index,:] = hist_ssfr[index,:] + H
 
-    ind = np.where((sfr_disk+sfr_burst > 0) & (mdisk+mbulge > 0) & (mvir_hosthalo < 1e11))
-    passive_fractions[index,1,:] = us.fractions(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)), y = np.log10((sfr_disk[ind]+sfr_burst[ind])/(mdisk[ind]+mbulge[ind])), xbins=xmf2, ythresh=-2.2)
+    passive_fractions[index,1,:] = select(mass2_bins, (sfr_tot > 0) & (mstars > 0) & (mvir_hosthalo < 1e11)).fractions(log_ssfr, -2.2)
     passive_fractions[index,1,:] = 1.0 - passive_fractions[index,1,:] 
 
-    ind = np.where((sfr_disk+sfr_burst > 0) & (mdisk+mbulge > 0) & (mvir_hosthalo >= 1e11))
-    passive_fractions[index,2,:] = us.fractions(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)), y = np.log10((sfr_disk[ind]+sfr_burst[ind])/(mdisk[ind]+mbulge[ind])), xbins=xmf2, ythresh=-2.2)
+    passive_fractions[index,2,:] = select(mass2_bins, (sfr_tot > 0) & (mstars > 0) & (mvir_hosthalo >= 1e11)).fractions(log_ssfr, -2.2)
     passive_fractions[index,2,:] = 1.0 - passive_fractions[index,2,:] 
 
-    ind = np.where((sfr_disk+sfr_burst > 0) & (mdisk+mbulge > 0) & ((sfr_disk+sfr_burst)/(mdisk+mbulge) > 1e-3))
-    mainseqsf[index,:] = bin_it_2sigma(x=mass[ind], y=np.log10((sfr_disk[ind]+sfr_burst[ind])/h0/GyrToYr))
+    ind = np.where((sfr_tot > 0) & (mstars > 0) & (sfr_tot/mstars > 1e-3))
+    mainseqsf[index,:] = bin_it_2sigma(x=mass[ind], y=sfr[ind])
+
+    # The main sequence uses bins including their upper limit
+    ms_offset = sfr - mass + 9.0
+    mass_bins = us.binned_statistics(mass, xmf, dx=dm, right=True)
 
     # calculate main sequence:
-    ms = np.zeros(shape = len(xmf))
-    for j in range(0,len(xmf)):
-        ind = np.where((mass > xmf[j]-dm/2.0) & (mass <= xmf[j]+dm/2.0) & (sfr - mass + 9.0 > -5 + 0.5*redshift) & (typeg == 0))
-        if(len(mass[ind] > 0)):
-               ms[j] = np.median(sfr[ind] - mass[ind] + 9.0)
+    b = select(mass_bins, (ms_offset > -5 + 0.5*redshift) & (typeg == 0))
+    ms = b.simple_medians(ms_offset)
     ind = np.where((ms != 0) & (xmf > 8) & (xmf < 9.8))
     (ms_fit_slope, ms_fit_offs) = np.polyfit(xmf[ind],ms[ind],1)
 
-    # calculate main sequence. sfr, m need to be given in log10 units.
-    def calculate_sigma_sfr_fromfixssfr(sfr, m, sigma, mscut, offms, flag):
-        ms = np.zeros(shape = len(xmf))
-        for j in range(0,len(xmf)):
- 	    ind = np.where((m > xmf[j]-dm/2.0) & (m <= xmf[j]+dm/2.0) & (sfr - m + 9.0 > mscut + np.log10(offms)))
-            if(len(m[ind] > 0)):
-                   sigma[j] = np.std(sfr[ind] - m[ind] + 9.0)
-                   flag[ind] = 1
-
-    def calculate_sigma_sfr_fromms(sfr, m, sigma, mscut, offms, flag):
-        ms = np.zeros(shape = len(xmf))
-        for j in range(0,len(xmf)):
-            ind = np.where((m > xmf[j]-dm/2.0) & (m <= xmf[j]+dm/2.0) & (sfr - m + 9.0 > mscut))
-            if(len(m[ind] > 0)):
-                   ms[j] = np.median(sfr[ind] - m[ind] + 9.0)
- 	    ind = np.where((m > xmf[j]-dm/2.0) & (m <= xmf[j]+dm/2.0) & (sfr - m + 9.0 > ms[j]+np.log10(offms)))
-            if(len(m[ind] > 0)):
-                   sigma[j] = np.std(sfr[ind] - m[ind] + 9.0)
-                   flag[ind] = 1
-
-    def calculate_sigma_sfr_frommsfit(sfr, m, sigma, ms_fit_slope, ms_fit_offs, offms, flag):
-        ms = np.zeros(shape = len(xmf))
-        for j in range(0,len(xmf)):
- 	    ind = np.where((m > xmf[j]-dm/2.0) & (m <= xmf[j]+dm/2.0) & (sfr - m + 9.0 > ms_fit_slope * m + ms_fit_offs + np.log10(offms)))
-            if(len(m[ind] > 0)):
-                   sigma[j]  = np.std(sfr[ind] - m[ind] + 9.0)
-                   flag[ind] = 1
-
-    ind = np.where((mass > 0) & (sfr != 0))
-    calculate_sigma_sfr_fromfixssfr(sfr[ind], mass[ind], sigmamainseqsf[index,0,:], -3.5, 1.0, active_flag[ind])
-    #calculate_sigma_sfr_frommsfit(sfr[ind], mass[ind], sigmamainseqsf[index,1,:], ms_fit_slope,ms_fit_offs, 1.0/20.0, active_flag[ind])
-    calculate_sigma_sfr_fromfixssfr(sfr[ind], mass[ind], sigmamainseqsf[index,1,:], -2, 1.0, active_flag[ind])
-    calculate_sigma_sfr_frommsfit(sfr[ind], mass[ind], sigmamainseqsf[index,2,:], ms_fit_slope,ms_fit_offs, 1.0/10.0, active_flag[ind])
-    calculate_sigma_sfr_frommsfit(sfr[ind], mass[ind], sigmamainseqsf[index,3,:], ms_fit_slope,ms_fit_offs, 1.0/8.0, active_flag[ind])
-    #calculate_sigma_sfr_frommsfit(sfr[ind], mass[ind], sigmamainseqsf[index,4,:], ms_fit_slope,ms_fit_offs, 1.0/6.0, active_flag[ind])
-    #calculate_sigma_sfr_frommsfit(sfr[ind], mass[ind], sigmamainseqsf[index,5,:], ms_fit_slope,ms_fit_offs, 1.0/4.0, active_flag[ind])
-    #calculate_sigma_sfr_frommsfit(sfr, mass, sigmamainseqsf[index,6,:], ms_fit_slope, ms_fit_offs, 0.15848931924, active_flag)
-    ind = np.where((mass > 0) & (sfr != 0) & (mvir_hosthalo <= 2e12))
-    calculate_sigma_sfr_fromfixssfr(sfr[ind], mass[ind], sigmamainseqsf[index,4,:], -3.5, 1.0, active_flag[ind])
-    calculate_sigma_sfr_fromfixssfr(sfr[ind], mass[ind], sigmamainseqsf[index,5,:], -2, 1.0, active_flag[ind])
-
-
-    for i in range(0,len(xmflr)):
-        for j in range(0,len(xmf2)):
-            #centrals
-            ind = np.where((mass > xmflr[i]-dmlr/2.0) & (mass <= xmflr[i]+dmlr/2.0) & (mhalo > xmf2[j] - dm2/2.0) & (mhalo <= xmf2[j] + dm2/2.0) & (typeg <= 0))
-            if(len(mass[ind]) > 9):
-                   totnumber      = len(mass[ind])
-                   onms           = active_flag[ind]
-                   moffs          = np.where(onms <= 0)
-                   passivenumber  = len(onms[moffs])
-                   passive_fractions_cens_sats[index,0,i,j] = (passivenumber + 0.0)/(totnumber + 0.0)
-            ind = np.where((mass > xmflr[i]-dmlr/2.0) & (mass <= xmflr[i]+dmlr/2.0) & (mhalo > xmf2[j] - dm2/2.0) & (mhalo <= xmf2[j] + dm2/2.0) & (typeg > 0))
-            if(len(mass[ind]) > 9):
-                   totnumber      = len(mass[ind])
-                   onms           = active_flag[ind]
-                   moffs          = np.where(onms <= 0)
-                   passivenumber  = len(onms[moffs])
-                   passive_fractions_cens_sats[index,1,i,j] = (passivenumber + 0.0)/(totnumber + 0.0)
+    # calculate main sequence. b are the mass bins of the galaxies to use.
+    def set_sigma(b, sigma):
+        ind = np.where(b.counts > 0)
+        sigma[ind] = b.stds(ms_offset)[ind]
+
+    def calculate_sigma_sfr_fromfixssfr(b, sigma, mscut, offms):
+        set_sigma(select(b, ms_offset > mscut + np.log10(offms)), sigma)
+
+    def calculate_sigma_sfr_fromms(b, sigma, mscut, offms):
+        ms = select(b, ms_offset > mscut).simple_medians(ms_offset)
+        set_sigma(b.select(b.values(ms_offset) > ms[b.bin] + np.log10(offms)), sigma)
+
+    def calculate_sigma_sfr_frommsfit(b, sigma, ms_fit_slope, ms_fit_offs, offms):
+        set_sigma(select(b, ms_offset > ms_fit_slope * mass + ms_fit_offs + np.log10(offms)), sigma)
+
+    # The galaxies these functions flagged as being on the main sequence
+    # never made it into active_flag (they were set on copies of it), so all
+    # galaxies count as passive below; this is kept as it was.
+    b = select(mass_bins, (mass > 0) & (sfr != 0))
+    calculate_sigma_sfr_fromfixssfr(b, sigmamainseqsf[index,0,:], -3.5, 1.0)
+    #calculate_sigma_sfr_frommsfit(b, sigmamainseqsf[index,1,:], ms_fit_slope,ms_fit_offs, 1.0/20.0)
+    calculate_sigma_sfr_fromfixssfr(b, sigmamainseqsf[index,1,:], -2, 1.0)
+    calculate_sigma_sfr_frommsfit(b, sigmamainseqsf[index,2,:], ms_fit_slope,ms_fit_offs, 1.0/10.0)
+    calculate_sigma_sfr_frommsfit(b, sigmamainseqsf[index,3,:], ms_fit_slope,ms_fit_offs, 1.0/8.0)
+    #calculate_sigma_sfr_frommsfit(b, sigmamainseqsf[index,4,:], ms_fit_slope,ms_fit_offs, 1.0/6.0)
+    #calculate_sigma_sfr_frommsfit(b, sigmamainseqsf[index,5,:], ms_fit_slope,ms_fit_offs, 1.0/4.0)
+    #calculate_sigma_sfr_frommsfit(mass_bins, sigmamainseqsf[index,6,:], ms_fit_slope, ms_fit_offs, 0.15848931924)
+    b = select(mass_bins, (mass > 0) & (sfr != 0) & (mvir_hosthalo <= 2e12))
+    calculate_sigma_sfr_fromfixssfr(b, sigmamainseqsf[index,4,:], -3.5, 1.0)
+    calculate_sigma_sfr_fromfixssfr(b, sigmamainseqsf[index,5,:], -2, 1.0)
+
+    # Passive fractions of centrals and satellites with more than 9 galaxies
+    # in each (stellar mass, halo mass) cell, all counted at once. Each
+    # galaxy is paired with its stellar mass bin(s), and each pair with its
+    # halo mass bin(s)
+    lr_bins = us.binned_statistics(mass, xmflr, dx=dmlr, right=True)
+    halo_bins = us.binned_statistics(lr_bins.values(mhalo), xmf2, dx=dm2, right=True)
+    galaxy = lr_bins.index[halo_bins.index]
+    cell = lr_bins.bin[halo_bins.index] * len(xmf2) + halo_bins.bin
+    passive = active_flag[galaxy] <= 0
+    ncells = len(xmflr) * len(xmf2)
+    for k, in_sample in enumerate((typeg[galaxy] <= 0, typeg[galaxy] > 0)):
+        totnumber = np.bincount(cell[in_sample], minlength=ncells).reshape((len(xmflr), len(xmf2)))
+        passivenumber = np.bincount(cell[in_sample & passive], minlength=ncells).reshape((len(xmflr), len(xmf2)))
+        ind = np.where(totnumber > 9)
+        passive_fractions_cens_sats[index,k][ind] = (passivenumber[ind] + 0.0)/(totnumber[ind] + 0.0)
 
     return (mass, ms_fit_slope, ms_fit_offs)
 
@@ -367,7 +352,8 @@ def main(modeldir, outdir, redshift_table, subvols, obsdir):
                            'matom_bulge', 'mmol_bulge', 'mgas_bulge',
                            'mgas_metals_disk', 'mgas_metals_bulge',
                            'mstars_metals_disk', 'mstars_metals_bulge', 'type', 
-			   'mvir_hosthalo', 'rstar_bulge')}
+			   'mvir_hosthalo', 'rstar_bulge'),
+              'derived': ('mstars', 'sfr', 'log_mstars', 'log_ssfr', 'log_sfr')}
 
     for index, snapshot in enumerate(snapshots):
         hdf5_data = common.read_data(modeldir, snapshot, fields, subvols)
@@ -376,11 +362,11 @@ def main(modeldir, outdir, redshift_table, subvols, obsdir):
 
         h0 = hdf5_data[0]
         if index == 0:
-            (sfr_disk, sfr_burst, mdisk, mbulge) = hdf5_data[2:6]
-            sfr_seq = np.zeros(shape = (2, len(mdisk)))
-            ind  = np.where((sfr_disk + sfr_burst > 0) & (mdisk + mbulge > 0))
+            (mstars, sfr, _, _, log_sfr) = hdf5_data[-5:]
+            sfr_seq = np.zeros(shape = (2, len(mstars)))
+            ind  = np.where((sfr > 0) & (mstars > 0))
             sfr_seq[0,ind] = mass[ind]
-            sfr_seq[1,ind] = np.log10((sfr_disk[ind] + sfr_burst[ind]) / h0 / GyrToYr)
+            sfr_seq[1,ind] = log_sfr[ind]
             slope_ms_z0  = slope
             offset_ms_z0 = offset
             #print 'scatter MS'
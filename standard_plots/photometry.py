@@ -1119,6 +1119,36 @@ def prepare_data(hdf5_data, phot_data, ids_sed, LFs_dust, LFs_nodust, colours_di
         colours_dist[index,mag,1,:] = colours_dist[index,mag,1,:] + H
         colours_dist[index,mag,1,:] = colours_dist[index,mag,1,:] / (len(gbandl[ind]) * dc)
  
+def read_snapshot(model_dir, snapshot, fields, subvols):
+    """Reads the galaxies and photometry data of a single snapshot"""
+
+    hdf5_data = common.read_data(model_dir, snapshot, fields, subvols)
+    #sfh, delta_t, LBT = common.read_sfh(model_dir, snapshot, sfh_fields, subvols)
+    seds, ids, nbands = common.read_photometry_data(model_dir, snapshot, subvols)
+    return hdf5_data, seds, ids, nbands
+
+def prepare_snapshot(hdf5_data, seds, ids, nbands):
+    """Prepares the data of a single snapshot, returning h0 and the values for
+    that snapshot of each of the arrays filled by prepare_data"""
+
+    LFs_dust     = np.zeros(shape = (1, 5, nbands, len(mbins)))
+    LFs_nodust   = np.zeros(shape = (1, 5, nbands, len(mbins)))
+    colours_dist = np.zeros(shape = (1, len(magbins)-1, 2, len(cbins)))
+    fdisk_emission    = np.zeros(shape = (1, nbands, len(mbins)))
+    fbulge_m_emission = np.zeros(shape = (1, nbands, len(mbins)))
+    fbulge_d_emission = np.zeros(shape = (1, nbands, len(mbins)))
+
+    prepare_data(hdf5_data, seds, ids, LFs_dust, LFs_nodust, colours_dist, 0, nbands, 
+                 fdisk_emission, fbulge_m_emission, fbulge_d_emission)
+
+    h0, volh = hdf5_data[0], hdf5_data[1]
+    if(volh > 0.):
+        LFs_dust[0,:]   = LFs_dust[0,:]/volh
+        LFs_nodust[0,:] = LFs_nodust[0,:]/volh
+
+    return (h0, LFs_dust[0], LFs_nodust[0], colours_dist[0], fdisk_emission[0],
+            fbulge_m_emission[0], fbulge_d_emission[0])
+
 def main(model_dir, outdir, redshift_table, subvols, obsdir):
 
     # Loop over redshift and subvolumes
@@ -1134,28 +1164,12 @@ def main(model_dir, outdir, redshift_table, subvols, obsdir):
     z = (0, 0.25, 0.5, 1.0, 2.0, 3.0, 6.0, 8.0) #, 1.0, 1.5, 2.0)
     snapshots = redshift_table[z]
 
-    # Create histogram
-    for index, snapshot in enumerate(snapshots):
-
-        hdf5_data = common.read_data(model_dir, snapshot, fields, subvols)
-        #sfh, delta_t, LBT = common.read_sfh(model_dir, snapshot, sfh_fields, subvols)
-        seds, ids, nbands = common.read_photometry_data(model_dir, snapshot, subvols)
-        
-        if(index == 0):
-            LFs_dust     = np.zeros(shape = (len(z), 5, nbands, len(mbins)))
-            LFs_nodust   = np.zeros(shape = (len(z), 5, nbands, len(mbins)))
-            colours_dist = np.zeros(shape = (len(z), len(magbins)-1, 2, len(cbins)))
-            fdisk_emission    = np.zeros(shape = (len(z), nbands, len(mbins)))
-            fbulge_m_emission = np.zeros(shape = (len(z), nbands, len(mbins)))
-            fbulge_d_emission = np.zeros(shape = (len(z), nbands, len(mbins)))
-
-        prepare_data(hdf5_data, seds, ids, LFs_dust, LFs_nodust, colours_dist, index, nbands, 
-                     fdisk_emission, fbulge_m_emission, fbulge_d_emission)
-
-        h0, volh = hdf5_data[0], hdf5_data[1]
-        if(volh > 0.):
-            LFs_dust[index,:]   = LFs_dust[index,:]/volh
-            LFs_nodust[index,:] = LFs_nodust[index,:]/volh
+    # Snapshots are independent of each other, and can be prepared in parallel
+    results = common.map_snapshots(read_snapshot, prepare_snapshot,
+                                   [(model_dir, snapshot, fields, subvols) for snapshot in snapshots])
+    h0 = results[-1][0]
+    (LFs_dust, LFs_nodust, colours_dist, fdisk_emission,
+     fbulge_m_emission, fbulge_d_emission) = [np.array(r) for r in list(zip(*results))[1:]]
 
     # Take logs
     ind = np.where(LFs_dust > 0.)
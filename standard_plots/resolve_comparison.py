@@ -40,7 +40,8 @@ xmf = mbins + dm/2.0
 # Create histogram 
 def prepare_data(hdf5_data):
 
-    (h0, volh, typeg, mdisk, mbulge, _, _, mHI, _, _, mHI_bulge, _, _, mhalo) = hdf5_data
+    (h0, volh, typeg, mdisk, mbulge, _, _, mHI, _, _, mHI_bulge, _, _, mhalo,
+     mstars, matom, log_mstars) = hdf5_data
 
     hist_bmf = np.zeros(shape = (5,len(mbins)))
     hist_bmf_sat = np.zeros(shape = (5, len(mbins)))
@@ -54,49 +55,30 @@ def prepare_data(hdf5_data):
     Nbinshalo   = len(Mvir_thresh)
 
     mhalo  = np.log10(mhalo) - np.log10(h0)
-    mbar_pseudo = mHI_bulge + mHI + mdisk + mbulge
-    mstar       = mdisk + mbulge
+    mbar_pseudo = matom + mdisk + mbulge
 
-    ind = np.where(mbar_pseudo > 0)
-    H, bins_edges = np.histogram(np.log10(mbar_pseudo[ind]) - np.log10(h0),bins=np.append(mbins,mupp))
-    hist_bmf[0,:] = hist_bmf[0,:] + H
-
-    ind = np.where((mbar_pseudo > 0) & (typeg > 0))
-    H, bins_edges = np.histogram(np.log10(mbar_pseudo[ind]) - np.log10(h0),bins=np.append(mbins,mupp))
-    hist_bmf_sat[0,:] = hist_bmf_sat[0,:] + H
-
-    ind = np.where(mstar > 0)
-    H, bins_edges = np.histogram(np.log10(mstar[ind]) - np.log10(h0),bins=np.append(mbins,mupp))
-    hist_smf[0,:] = hist_smf[0,:] + H
-
-    ind = np.where((mstar > 0) & (typeg > 0))
-    H, bins_edges = np.histogram(np.log10(mstar[ind]) - np.log10(h0),bins=np.append(mbins,mupp))
-    hist_smf_sat[0,:] = hist_smf_sat[0,:] + H
-
-    ind = np.where(mHI_bulge+mHI > 0)
-    H, bins_edges = np.histogram(np.log10(mHI_bulge[ind]+mHI[ind]) - np.log10(h0),bins=np.append(mbins,mupp))
-    hist_himf[0,:] = hist_himf[0,:] + H
+    # The histograms of all galaxies and of each halo mass range (plus their
+    # satellite versions) are calculated together for each quantity
+    everything = np.ones(len(typeg), dtype=bool)
+    halo_ranges = [everything] + [(mhalo > Mvir_thresh[i-1]) & (mhalo < Mvir_thresh[i]) for i in range(1,Nbinshalo)]
+    halo_ranges_sat = [r & (typeg > 0) for r in halo_ranges]
 
-    for i in range(1,Nbinshalo):
-        ind = np.where((mbar_pseudo > 0) & (mhalo > Mvir_thresh[i-1]) & (mhalo < Mvir_thresh[i]))
-        H, bins_edges = np.histogram(np.log10(mbar_pseudo[ind]) - np.log10(h0),bins=np.append(mbins,mupp))
-        hist_bmf[i,:] = hist_bmf[i,:] + H
-
-        ind = np.where((mbar_pseudo > 0) & (mhalo > Mvir_thresh[i-1]) & (mhalo < Mvir_thresh[i]) & (typeg > 0))
-        H, bins_edges = np.histogram(np.log10(mbar_pseudo[ind]) - np.log10(h0),bins=np.append(mbins,mupp))
-        hist_bmf_sat[i,:] = hist_bmf_sat[i,:] + H
-
-        ind = np.where((mstar > 0) & (mhalo > Mvir_thresh[i-1]) & (mhalo < Mvir_thresh[i]))
-        H, bins_edges = np.histogram(np.log10(mstar[ind]) - np.log10(h0),bins=np.append(mbins,mupp))
-        hist_smf[i,:] = hist_smf[i,:] + H
-
-        ind = np.where((mstar > 0) & (typeg > 0) & (mhalo > Mvir_thresh[i-1]) & (mhalo < Mvir_thresh[i]))
-        H, bins_edges = np.histogram(np.log10(mstar[ind]) - np.log10(h0),bins=np.append(mbins,mupp))
-        hist_smf_sat[i,:] = hist_smf_sat[i,:] + H
-
-        ind = np.where((mHI_bulge+mHI > 0) & (mhalo > Mvir_thresh[i-1]) & (mhalo < Mvir_thresh[i]))
-        H, bins_edges = np.histogram(np.log10(mHI_bulge[ind]+mHI[ind]) - np.log10(h0),bins=np.append(mbins,mupp))
-        hist_himf[i,:] = hist_himf[i,:] + H
+    ind = np.where(mbar_pseudo > 0)
+    H = us.histograms(np.log10(mbar_pseudo[ind]) - np.log10(h0), np.append(mbins,mupp),
+                      [r[ind] for r in halo_ranges + halo_ranges_sat])
+    hist_bmf = hist_bmf + H[:Nbinshalo]
+    hist_bmf_sat = hist_bmf_sat + H[Nbinshalo:]
+
+    ind = np.where(mstars > 0)
+    H = us.histograms(log_mstars[ind], np.append(mbins,mupp),
+                      [r[ind] for r in halo_ranges + halo_ranges_sat])
+    hist_smf = hist_smf + H[:Nbinshalo]
+    hist_smf_sat = hist_smf_sat + H[Nbinshalo:]
+
+    ind = np.where(matom > 0)
+    H = us.histograms(np.log10(matom[ind]) - np.log10(h0), np.append(mbins,mupp),
+                      [r[ind] for r in halo_ranges])
+    hist_himf = hist_himf + H
 
     mHImhalo      = np.zeros(shape = (3,3,len(xmf)))
     mHIms         = np.zeros(shape = (3,3,len(xmf)))
@@ -106,17 +88,17 @@ def prepare_data(hdf5_data):
     mass    =  np.zeros(shape = (len(typeg)))
     gasfrac =  np.zeros(shape = (len(typeg)))
 
-    ind = np.where(mdisk+mbulge > 0)
+    ind = np.where(mstars > 0)
     mass[ind] = np.log10(mdisk[ind]+mbulge[ind]/h0)
 
-    ind = np.where((mHI_bulge+mHI > 0) & (mdisk+mbulge > 0))
-    gasfrac[ind] = (mHI_bulge[ind]+mHI[ind])/(mdisk[ind]+mbulge[ind])
+    ind = np.where((matom > 0) & (mstars > 0))
+    gasfrac[ind] = matom[ind]/mstars[ind]
 
     #apply gas fraction limit of RESOLVE 0.05:
     ind = np.where(gasfrac < HILIM)
     gasfrac[ind] = HILIM
-    HIcorr = gasfrac * (mdisk+mbulge) / h0
-    HItrue = (mHI_bulge+mHI) / h0
+    HIcorr = gasfrac * mstars / h0
+    HItrue = matom / h0
 
     bin_it = functools.partial(us.wmedians, xbins=xmf)
 
@@ -142,17 +124,17 @@ def prepare_data(hdf5_data):
     LTGsmhalo      = np.zeros(shape = (3,len(xmf)))
 
     ind = np.where(mass > 8.5)
-    result = us.fractions(x=mhalo[ind],y=mbulge[ind]/(mdisk[ind]+mbulge[ind]), xbins=xmf, ythresh=0.5)
+    result = us.fractions(x=mhalo[ind],y=mbulge[ind]/mstars[ind], xbins=xmf, ythresh=0.5)
     ETGsmhalo[0,:] = result
     LTGsmhalo[0,:] = 1.0-result
 
     ind = np.where((mass > 8.5) & (mbar_pseudo > 1e10))
-    result = us.fractions(x=mhalo[ind],y=mbulge[ind]/(mdisk[ind]+mbulge[ind]), xbins=xmf, ythresh=0.5)
+    result = us.fractions(x=mhalo[ind],y=mbulge[ind]/mstars[ind], xbins=xmf, ythresh=0.5)
     ETGsmhalo[1,:] = result
     LTGsmhalo[1,:] = 1.0-result
 
     ind = np.where((mass > 8.5) & (mbar_pseudo < 1e10))
-    result = us.fractions(x=mhalo[ind],y=mbulge[ind]/(mdisk[ind]+mbulge[ind]), xbins=xmf, ythresh=0.5)
+    result = us.fractions(x=mhalo[ind],y=mbulge[ind]/mstars[ind], xbins=xmf, ythresh=0.5)
     ETGsmhalo[2,:] = result
     LTGsmhalo[2,:] = 1.0-result
 
@@ -882,7 +864,8 @@ def main(modeldir, outdir, redshift_table, subvols, obsdir):
     fields = {'galaxies': ('type', 'mstars_disk', 'mstars_bulge', 'rstar_disk',
                            'm_bh', 'matom_disk', 'mmol_disk', 'mgas_disk',
                            'matom_bulge', 'mmol_bulge', 'mgas_bulge',
-                           'mvir_hosthalo')}
+                           'mvir_hosthalo'),
+              'derived': ('mstars', 'matom', 'log_mstars')}
 
     hdf5_data = common.read_data(modeldir, redshift_table[0], fields, subvols)
 
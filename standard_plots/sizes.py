@@ -53,15 +53,15 @@ xv    = vbins + dv/2.0
 
 def prepare_data(hdf5_data, index, rcomb, disk_size, bulge_size, bulge_size_mergers, bulge_size_diskins, BH,
                  disk_size_sat, disk_size_cen, BT_fractions, BT_fractions_nodiskins, bulge_vel, 
-                 disk_vel, BT_fractions_centrals, BT_fractions_satellites, baryonic_TF):
+                 disk_vel, BT_fractions_centrals, BT_fractions_satellites, baryonic_TF, stats=us, no_bulges=None):
 
     (h0, _, mdisk, mbulge, mburst_mergers, mburst_diskins, mstars_bulge_mergers_assembly, mstars_bulge_diskins_assembly, 
      mBH, rdisk, rbulge, typeg, specific_angular_momentum_disk_star, specific_angular_momentum_bulge_star, 
      specific_angular_momentum_disk_gas, specific_angular_momentum_bulge_gas, specific_angular_momentum_disk_gas_atom, 
      specific_angular_momentum_disk_gas_mol, lambda_sub, mvir_s, mgas_disk, mgas_bulge, matom_disk, mmol_disk, matom_bulge, 
-     mmol_bulge, mbh_acc_hh, mbh_acc_sb) = hdf5_data
+     mmol_bulge, mbh_acc_hh, mbh_acc_sb, mstars, mgas, log_mstars) = hdf5_data
 
-    mstars_tot = (mdisk+mbulge)/h0
+    mstars_tot = mstars/h0
     #if index in (2, 3):
     #   for x, y, z, m in zip(mBH, mbh_acc_hh, mbh_acc_sb, mstars_tot):
     #       if x > 1e5 and m > 1e8:
@@ -69,61 +69,73 @@ def prepare_data(hdf5_data, index, rcomb, disk_size, bulge_size, bulge_size_merg
 
     mbulge_mergers = mburst_mergers + mstars_bulge_mergers_assembly
     zero_bulge = np.where(rbulge <= 0)
-    if(len(rbulge) == len(rbulge[zero_bulge])):
+    # no_bulges tells, for each snapshot, whether its whole volume has no
+    # bulges, when hdf5_data is only a part of it (see find_no_bulges)
+    if no_bulges is None:
+        no_bulge_build_up = len(rbulge) == len(rbulge[zero_bulge])
+    else:
+        no_bulge_build_up = no_bulges[index]
+    if(no_bulge_build_up):
             #case where there is zero bulge build up.
+            #copy first, as inputs can be read-only views of the snapshot cache.
+            rbulge = rbulge.copy()
+            specific_angular_momentum_bulge_star = specific_angular_momentum_bulge_star.copy()
+            mbulge = mbulge.copy()
             rbulge[zero_bulge] = 1e-10
             specific_angular_momentum_bulge_star[zero_bulge] = 1.0
             mbulge[zero_bulge] = 10.0
+            mstars = mdisk + mbulge
+            log_mstars = np.log10(mstars) - np.log10(float(h0))
 
-    bin_it   = functools.partial(us.wmedians, xbins=xmf)
-    bin_it_v = functools.partial(us.wmedians, xbins=xv)
+    bin_it   = functools.partial(stats.wmedians, xbins=xmf)
+    bin_it_v = functools.partial(stats.wmedians, xbins=xv)
 
     vdisk = specific_angular_momentum_disk_star / rdisk / 2.0  #in km/s
     vbulge = specific_angular_momentum_bulge_star / rbulge / 2.0 #in km/s
    
-    ind = np.where(mdisk+mbulge > 0)
-    rcomb[index,:] = bin_it(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)),
-                            y=np.log10((mdisk[ind]*rdisk[ind]  + mbulge[ind]*rbulge[ind])*MpcToKpc / (mdisk[ind]+mbulge[ind])))
-    BT_fractions[index] = us.fractional_contribution(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)),y=mbulge[ind]/(mdisk[ind]+mbulge[ind]), xbins=xmf)
+    ind = np.where(mstars > 0)
+    rcomb[index,:] = bin_it(x=log_mstars[ind],
+                            y=np.log10((mdisk[ind]*rdisk[ind]  + mbulge[ind]*rbulge[ind])*MpcToKpc / mstars[ind]))
+    BT_fractions[index] = stats.fractional_contribution(x=log_mstars[ind],y=mbulge[ind]/mstars[ind], xbins=xmf)
 
-    BT_fractions_nodiskins[index] = us.fractional_contribution(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)),
-		                    y=(mbulge_mergers[ind])/(mdisk[ind]+mbulge[ind]), xbins=xmf)
+    BT_fractions_nodiskins[index] = stats.fractional_contribution(x=log_mstars[ind],
+		                    y=(mbulge_mergers[ind])/mstars[ind], xbins=xmf)
 
-    ind = np.where((mdisk+mbulge > 0) & (typeg == 0))
-    BT_fractions_centrals[index] = us.fractional_contribution(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)),y=mbulge[ind]/(mdisk[ind]+mbulge[ind]), xbins=xmf)
-    ind = np.where((mdisk+mbulge > 0) & (typeg > 0))
-    BT_fractions_satellites[index] = us.fractional_contribution(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)),y=mbulge[ind]/(mdisk[ind]+mbulge[ind]), xbins=xmf)
+    ind = np.where((mstars > 0) & (typeg == 0))
+    BT_fractions_centrals[index] = stats.fractional_contribution(x=log_mstars[ind],y=mbulge[ind]/mstars[ind], xbins=xmf)
+    ind = np.where((mstars > 0) & (typeg > 0))
+    BT_fractions_satellites[index] = stats.fractional_contribution(x=log_mstars[ind],y=mbulge[ind]/mstars[ind], xbins=xmf)
 
-    ind = np.where((mdisk > 0)  & (mdisk/(mdisk+mbulge) > 0.5))
+    ind = np.where((mdisk > 0)  & (mdisk/mstars > 0.5))
     disk_size[index,:] = bin_it(x=np.log10(mdisk[ind]) - np.log10(float(h0)),
                                 y=np.log10(rdisk[ind]*MpcToKpc) - np.log10(float(h0)))
 
     ind = np.where((mdisk > 0) & (typeg == 0) & (mbulge/mdisk < 0.5))
-    disk_vel[index,:] = bin_it(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)),
+    disk_vel[index,:] = bin_it(x=log_mstars[ind],
                                 y=np.log10(vdisk[ind]))
 
-    ind = np.where((mdisk > 0) & ((mgas_disk+mgas_bulge)/(mdisk+mbulge) > 1))
+    ind = np.where((mdisk > 0) & (mgas/mstars > 1))
     baryonic_TF[index,:] = bin_it_v(x=np.log10(vdisk[ind]), 
-                                y=np.log10(mdisk[ind]+mbulge[ind]+matom_disk[ind]+mmol_disk[ind]+
+                                y=np.log10(mstars[ind]+matom_disk[ind]+mmol_disk[ind]+
                                 matom_bulge[ind]+mmol_bulge[ind]) - np.log10(float(h0)))
 
-    ind = np.where((mdisk > 0) & (typeg == 0) & (mdisk/(mdisk+mbulge) > 0.5))
+    ind = np.where((mdisk > 0) & (typeg == 0) & (mdisk/mstars > 0.5))
     disk_size_cen[index,:]  = bin_it(x=np.log10(mdisk[ind]) - np.log10(float(h0)),
                                     y=np.log10(rdisk[ind]*MpcToKpc) - np.log10(float(h0)))
 
-    ind = np.where((mdisk > 0) & (typeg > 0) & (mdisk/(mdisk+mbulge) > 0.5))
+    ind = np.where((mdisk > 0) & (typeg > 0) & (mdisk/mstars > 0.5))
     disk_size_sat[index,:] = bin_it(x=np.log10(mdisk[ind]) - np.log10(float(h0)),
                                     y=np.log10(rdisk[ind]*MpcToKpc) - np.log10(float(h0)))
 
-    ind = np.where((mbulge > 0) & (mbulge/(mbulge+mdisk) > 0.5) & (rbulge > 1e-6))
+    ind = np.where((mbulge > 0) & (mbulge/mstars > 0.5) & (rbulge > 1e-6))
     bulge_size[index,:] = bin_it(x=np.log10(mbulge[ind]) - np.log10(float(h0)),
                                  y=np.log10(rbulge[ind]*MpcToKpc) - np.log10(float(h0)))
 
-    ind = np.where((mbulge > 0) & (mbulge/(mbulge+mdisk) > 0.5) & (rbulge > 1e-6) & (mbulge_mergers/mbulge > 0.5))
+    ind = np.where((mbulge > 0) & (mbulge/mstars > 0.5) & (rbulge > 1e-6) & (mbulge_mergers/mbulge > 0.5))
     bulge_size_mergers[index,:] = bin_it(x=np.log10(mbulge[ind]) - np.log10(float(h0)),
                                  y=np.log10(rbulge[ind]*MpcToKpc) - np.log10(float(h0)))
 
-    ind = np.where((mbulge > 0) & (mbulge/(mbulge+mdisk) > 0.5) & (rbulge > 1e-6) & ((mbulge - mbulge_mergers) / mbulge > 0.5))
+    ind = np.where((mbulge > 0) & (mbulge/mstars > 0.5) & (rbulge > 1e-6) & ((mbulge - mbulge_mergers) / mbulge > 0.5))
     bulge_size_diskins[index,:] = bin_it(x=np.log10(mbulge[ind]) - np.log10(float(h0)),
                                  y=np.log10(rbulge[ind]*MpcToKpc) - np.log10(float(h0)))
 
@@ -132,7 +144,7 @@ def prepare_data(hdf5_data, index, rcomb, disk_size, bulge_size, bulge_size_merg
                     y=np.log10(mBH[ind]) - np.log10(float(h0)))
     
     ind = np.where((mbulge > 0) & (mbulge/mdisk > 0.5))
-    bulge_vel[index,:] = bin_it(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)),
+    bulge_vel[index,:] = bin_it(x=log_mstars[ind],
                     y=np.log10(vbulge[ind]))
     
 
@@ -493,6 +505,19 @@ def plot_bt_fractions(plt, outdir, obsdir, BT_fractions, BT_fractions_nodiskins,
     common.savefig(outdir, fig, 'BTfractions.pdf')
 
 
+def find_no_bulges(modeldir, snapshots, subvols):
+    """Returns, for each snapshot, whether none of its galaxies (over all
+    subvolumes) has a bulge. Data is read one chunk at a time, as in streaming
+    mode, stopping at the first chunk with a bulge"""
+    fields = {'galaxies': ('rstar_bulge',)}
+    chunk_size = common.streaming_chunk_size()
+    no_bulges = []
+    for snapshot in snapshots:
+        chunks = common.iter_catalogue(modeldir, snapshot, fields, subvols, include_h0_volh=False,
+                                       chunk_size=chunk_size or None)
+        no_bulges.append(not any(np.any(~(data['galaxies/rstar_bulge'] <= 0)) for data in chunks))
+    return no_bulges
+
 def main(modeldir, outdir, redshift_table, subvols, obsdir):
 
     plt = common.load_matplotlib()
@@ -502,7 +527,8 @@ def main(modeldir, outdir, redshift_table, subvols, obsdir):
                            'specific_angular_momentum_disk_gas', 'specific_angular_momentum_bulge_gas',
                            'specific_angular_momentum_disk_gas_atom', 'specific_angular_momentum_disk_gas_mol',
                            'lambda_subhalo', 'mvir_subhalo', 'mgas_disk', 'mgas_bulge','matom_disk', 'mmol_disk', 
-                           'matom_bulge', 'mmol_bulge', 'bh_accretion_rate_hh', 'bh_accretion_rate_sb')}
+                           'matom_bulge', 'mmol_bulge', 'bh_accretion_rate_hh', 'bh_accretion_rate_sb'),
+              'derived': ('mstars', 'mgas', 'log_mstars')}
 
     # Loop over redshift and subvolumes
     rcomb = np.zeros(shape = (len(zlist), 3, len(xmf)))
@@ -522,11 +548,16 @@ def main(modeldir, outdir, redshift_table, subvols, obsdir):
     bulge_vel =  np.zeros(shape = (len(zlist), 3, len(xmf)))
     baryonic_TF =  np.zeros(shape = (len(zlist), 3, len(xv))) 
    
-    for index, snapshot in enumerate(redshift_table[zlist]):
-        hdf5_data = common.read_data(modeldir, snapshot, fields, subvols)
-        prepare_data(hdf5_data, index, rcomb, disk_size, bulge_size, bulge_size_mergers, bulge_size_diskins, BH,
-                     disk_size_sat, disk_size_cen, BT_fractions, BT_fractions_nodiskins, bulge_vel, disk_vel, 
-                     BT_fractions_centrals, BT_fractions_satellites, baryonic_TF)
+    outputs = (rcomb, disk_size, bulge_size, bulge_size_mergers, bulge_size_diskins, BH,
+               disk_size_sat, disk_size_cen, BT_fractions, BT_fractions_nodiskins, bulge_vel, disk_vel, 
+               BT_fractions_centrals, BT_fractions_satellites, baryonic_TF)
+    # Whether there are bulges at all is decided over whole snapshots, so it's
+    # found beforehand only if data is prepared by chunks or subvolumes
+    no_bulges = None
+    if common.streaming_chunk_size() is not None or (common.get_num_procs() > 1 and len(subvols) > 1):
+        no_bulges = find_no_bulges(modeldir, redshift_table[zlist], subvols)
+    prepare = functools.partial(prepare_data, no_bulges=no_bulges)
+    common.map_reduce_data(prepare, modeldir, redshift_table[zlist], fields, subvols, outputs)
 
     plot_sizes(plt, outdir, obsdir, disk_size_cen, disk_size_sat, bulge_size, bulge_size_mergers, bulge_size_diskins)
     plot_velocities(plt, outdir, disk_vel, bulge_vel, baryonic_TF)
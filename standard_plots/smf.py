@@ -1075,37 +1075,41 @@ def prepare_data(hdf5_data, index, hist_smf, hist_smf_err, hist_smf_cen, hist_sm
                  hist_H2mf_cen, hist_H2mf_sat, mainseq, mainseqsf, sfe, mainseq_cen, 
                  mainseqsf_cen, sfe_cen, mainseq_sat, mainseqsf_sat, sfe_sat, mzr, 
                  fmzr, mzr_cen, mzr_sat, plotz, plotz_HImf, passive_fractions, hist_ssfr, 
-                 mszr, mszr_cen, mszr_sat, mainseqsf_1s, mainseqHI, mainseqH2):
+                 mszr, mszr_cen, mszr_sat, mainseqsf_1s, mainseqHI, mainseqH2, stats=us):
 
     (h0, volh, sfr_disk, sfr_burst, mdisk, mbulge, rstar_disk, mBH, mHI, mH2, 
      mgas_disk, mHI_bulge, mH2_bulge, mgas_bulge, mgas_metals_disk, mgas_metals_bulge, 
-     mstars_metals_disk, mstars_metals_bulge, typeg, mvir_hosthalo, rstar_bulge) = hdf5_data
+     mstars_metals_disk, mstars_metals_bulge, typeg, mvir_hosthalo, rstar_bulge,
+     mstars, sfr, mgas, matom, mmol, mass, log_ssfr, log_sfr) = hdf5_data
 
-    mgas = mgas_disk+mgas_bulge
     mgas_metals = mgas_metals_disk+mgas_metals_bulge
 
-    mass          = np.zeros(shape = len(mdisk))
     mass_30kpc    = np.zeros(shape = len(mdisk))
     massd_30kpc   = np.zeros(shape = len(mdisk))
     massb_30kpc   = np.zeros(shape = len(mdisk))
     mass_atom     = np.zeros(shape = len(mdisk))
-    mass_atom_cen = np.zeros(shape = len(mdisk))
-    mass_atom_sat = np.zeros(shape = len(mdisk))
-
-    mass_mol = np.zeros(shape = len(mdisk))
-    mass_mol_cen = np.zeros(shape = len(mdisk))
-    mass_mol_sat = np.zeros(shape = len(mdisk))
-
-    ind = np.where((mdisk+mbulge) > 0.0)
-    mass[ind] = np.log10(mdisk[ind] + mbulge[ind]) - np.log10(float(h0))
-    print('number of galaxies with mstars>0 and max mass: %d, %d' % (len(mass[ind]), max(mass[ind])))
-
-    H, _ = np.histogram(mass,bins=np.append(mbins,mupp))
-    hist_smf[index,:] = hist_smf[index,:] + H
+    mass_mol      = np.zeros(shape = len(mdisk))
+
+    ind = np.where(mstars > 0.0)
+    print('number of galaxies with mstars>0 and max mass: %d, %d' % (len(mass[ind]), mass[ind].max() if len(mass[ind]) else 0))
+
+    # Histograms are normalised as they are accumulated, so they can be
+    # accumulated over several chunks of data
+    vol = volh/pow(h0,3.)  # In Mpc^3
+    def normalised(H):
+        return H/vol/dm if volh > 0 else H
+
+    # All, centrals and satellites histograms are calculated together
+    everything = np.ones(len(typeg), dtype=bool)
+    selections = (everything, typeg == 0, typeg > 0)
+    H = us.histograms(mass, np.append(mbins,mupp), selections)
+    hist_smf[index,:] = hist_smf[index,:] + normalised(H[0])
+    hist_smf_cen[index,:] = hist_smf_cen[index,:] + normalised(H[1])
+    hist_smf_sat[index,:] = hist_smf_sat[index,:] + normalised(H[2])
     ran_err = np.random.normal(0.0, 0.25, len(mass))
     mass_err = mass + ran_err
     H, _ = np.histogram(mass_err,bins=np.append(mbins,mupp))
-    hist_smf_err[index,:] = hist_smf_err[index,:] + H
+    hist_smf_err[index,:] = hist_smf_err[index,:] + normalised(H)
 
     #Calculate the stellar mass contained in 30pkpc, assuming an exponential profile for the disk and a Plummer profile for the bulge.
     ind = np.where((mdisk > 0.0)  & (rstar_disk > 0))
@@ -1116,127 +1120,97 @@ def prepare_data(hdf5_data, index, hist_smf, hist_smf_err, hist_smf_cen, hist_sm
     ind = np.where((massd_30kpc + massb_30kpc) > 0)
     mass_30kpc[ind] = np.log10(massd_30kpc[ind] + massb_30kpc[ind]) - np.log10(float(h0))
     H, _ = np.histogram(mass_30kpc,bins=np.append(mbins,mupp))
-    hist_smf_30kpc[index,:] = hist_smf_30kpc[index,:] + H
-
-
-    ind = np.where(typeg == 0)
-    H, _ = np.histogram(mass[ind],bins=np.append(mbins,mupp))
-    hist_smf_cen[index,:] = hist_smf_cen[index,:] + H
-    ind = np.where(typeg > 0)
-    H, _ = np.histogram(mass[ind],bins=np.append(mbins,mupp))
-    hist_smf_sat[index,:] = hist_smf_sat[index,:] + H
-
-    ind = np.where((mHI+mHI_bulge) > 0)
-    mass_atom[ind] = np.log10(mHI[ind]+mHI_bulge[ind]) - np.log10(float(h0)) + np.log10(XH)
-
-    H_HI, _ = np.histogram(mass_atom,bins=np.append(mbins,mupp))
-    hist_HImf[index,:] = hist_HImf[index,:] + H_HI
-
-    ind = np.where(((mHI+mHI_bulge) > 0) & (typeg == 0))
-    mass_atom_cen[ind] = np.log10(mHI[ind]+mHI_bulge[ind]) - np.log10(float(h0)) + np.log10(XH)
-    H_HI, _ = np.histogram(mass_atom_cen,bins=np.append(mbins,mupp))
-    hist_HImf_cen[index,:] = hist_HImf_cen[index,:] + H_HI
-
-    ind = np.where(((mHI+mHI_bulge) > 0) & (typeg > 0))
-    mass_atom_sat[ind] = np.log10(mHI[ind]+mHI_bulge[ind]) - np.log10(float(h0)) + np.log10(XH)
-    H_HI, _ = np.histogram(mass_atom_sat,bins=np.append(mbins,mupp))
-    hist_HImf_sat[index,:] = hist_HImf_sat[index,:] + H_HI
-
-    ind = np.where((mH2+mH2_bulge) > 0)
-    mass_mol[ind] = np.log10(mH2[ind]+mH2_bulge[ind]) - np.log10(float(h0)) + np.log10(XH)
-    H_H2, _ = np.histogram(mass_mol,bins=np.append(mbins,mupp))
-    hist_H2mf[index,:] = hist_H2mf[index,:] + H_H2
-
-    ind = np.where(((mH2+mH2_bulge) > 0) & (typeg == 0))
-    mass_mol_cen[ind] = np.log10(mH2[ind]+mH2_bulge[ind]) - np.log10(float(h0)) + np.log10(XH)
-    H_H2, _ = np.histogram(mass_mol_cen,bins=np.append(mbins,mupp))
-    hist_H2mf_cen[index,:] = hist_H2mf_cen[index,:] + H_H2
-
-    ind = np.where(((mH2+mH2_bulge) > 0) & (typeg > 0))
-    mass_mol_sat[ind] = np.log10(mH2[ind]+mH2_bulge[ind]) - np.log10(float(h0)) + np.log10(XH)
-    H_H2, _ = np.histogram(mass_mol_sat,bins=np.append(mbins,mupp))
-    hist_H2mf_sat[index,:] = hist_H2mf_sat[index,:] + H_H2
-
-    bin_it = functools.partial(us.wmedians, xbins=xmf)
-    bin_it_2sigma = functools.partial(us.wmedians_2sigma, xbins=xmf)
-
-    ind = np.where((sfr_disk+sfr_burst > 0) & (mdisk+mbulge > 0))
-    mainseq[index,:] = bin_it(x=mass[ind], y=np.log10((sfr_disk[ind]+sfr_burst[ind])/(mdisk[ind]+mbulge[ind])))
-    passive_fractions[index,0,:] = us.fractions(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)), y = np.log10((sfr_disk[ind]+sfr_burst[ind])/(mdisk[ind]+mbulge[ind])), xbins=xmf2, ythresh=-2.2)
+    hist_smf_30kpc[index,:] = hist_smf_30kpc[index,:] + normalised(H)
+
+    # Galaxies without HI/H2 are left with 0, outside the histogram range
+    ind = np.where(matom > 0)
+    mass_atom[ind] = np.log10(matom[ind]) - np.log10(float(h0)) + np.log10(XH)
+    H_HI = us.histograms(mass_atom, np.append(mbins,mupp), selections)
+    hist_HImf[index,:] = hist_HImf[index,:] + normalised(H_HI[0])
+    hist_HImf_cen[index,:] = hist_HImf_cen[index,:] + normalised(H_HI[1])
+    hist_HImf_sat[index,:] = hist_HImf_sat[index,:] + normalised(H_HI[2])
+
+    ind = np.where(mmol > 0)
+    mass_mol[ind] = np.log10(mmol[ind]) - np.log10(float(h0)) + np.log10(XH)
+    H_H2 = us.histograms(mass_mol, np.append(mbins,mupp), selections)
+    hist_H2mf[index,:] = hist_H2mf[index,:] + normalised(H_H2[0])
+    hist_H2mf_cen[index,:] = hist_H2mf_cen[index,:] + normalised(H_H2[1])
+    hist_H2mf_sat[index,:] = hist_H2mf_sat[index,:] + normalised(H_H2[2])
+
+    bin_it = functools.partial(stats.wmedians, xbins=xmf)
+
+    ind = np.where((sfr > 0) & (mstars > 0))
+    mainseq[index,:] = bin_it(x=mass[ind], y=log_ssfr[ind])
+    passive_fractions[index,0,:] = stats.fractions(x=mass[ind], y = log_ssfr[ind], xbins=xmf2, ythresh=-2.2)
     passive_fractions[index,0,:] = 1.0 - passive_fractions[index,0,:] 
-    H, _ = np.histogram(np.log10((sfr_disk[ind]+sfr_burst[ind])/(mdisk[ind]+mbulge[ind])),bins=np.append(ssfrbins,ssfrupp))
+    H, _ = np.histogram(log_ssfr[ind],bins=np.append(ssfrbins,ssfrupp))
     hist_ssfr[index,:] = hist_ssfr[index,:] + H
 
-    ind = np.where((sfr_disk+sfr_burst > 0) & (mdisk+mbulge > 0) & (mvir_hosthalo < 1e11))
-    passive_fractions[index,1,:] = us.fractions(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)), y = np.log10((sfr_disk[ind]+sfr_burst[ind])/(mdisk[ind]+mbulge[ind])), xbins=xmf2, ythresh=-2.2)
+    ind = np.where((sfr > 0) & (mstars > 0) & (mvir_hosthalo < 1e11))
+    passive_fractions[index,1,:] = stats.fractions(x=mass[ind], y = log_ssfr[ind], xbins=xmf2, ythresh=-2.2)
     passive_fractions[index,1,:] = 1.0 - passive_fractions[index,1,:] 
 
-    ind = np.where((sfr_disk+sfr_burst > 0) & (mdisk+mbulge > 0) & (mvir_hosthalo >= 1e11))
-    passive_fractions[index,2,:] = us.fractions(x=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)), y = np.log10((sfr_disk[ind]+sfr_burst[ind])/(mdisk[ind]+mbulge[ind])), xbins=xmf2, ythresh=-2.2)
+    ind = np.where((sfr > 0) & (mstars > 0) & (mvir_hosthalo >= 1e11))
+    passive_fractions[index,2,:] = stats.fractions(x=mass[ind], y = log_ssfr[ind], xbins=xmf2, ythresh=-2.2)
     passive_fractions[index,2,:] = 1.0 - passive_fractions[index,2,:] 
 
-    ind = np.where((sfr_disk+sfr_burst > 0) & (mH2+mH2_bulge > 0) & (mass > 0))
-    sfe[index,:] = bin_it(x=mass[ind], y=np.log10((mH2[ind]+mH2_bulge[ind])/(sfr_disk[ind]+sfr_burst[ind])))
+    ind = np.where((sfr > 0) & (mmol > 0) & (mass > 0))
+    sfe[index,:] = bin_it(x=mass[ind], y=np.log10(mmol[ind]/sfr[ind]))
 
-    ind = np.where((sfr_disk+sfr_burst > 0) & (typeg == 0) & (mdisk+mbulge > 0))
-    mainseq_cen[index,:] = bin_it(x=mass[ind], y=np.log10((sfr_disk[ind]+sfr_burst[ind])/(mdisk[ind]+mbulge[ind])))
-    mainseqsf_cen[index,:] = bin_it(x=mass[ind], y=np.log10((sfr_disk[ind]+sfr_burst[ind])/h0/GyrToYr))
-    sfe_cen[index,:] = bin_it(x=mass[ind], y=np.log10((mH2[ind]+mH2_bulge[ind])/(sfr_disk[ind]+sfr_burst[ind])))
+    # Relations sharing the same x values bin them only once
+    ind = np.where((sfr > 0) & (typeg == 0) & (mstars > 0))
+    binned = stats.binned_statistics(mass[ind], xmf)
+    mainseq_cen[index,:] = binned.medians(log_ssfr[ind])
+    mainseqsf_cen[index,:] = binned.medians(log_sfr[ind])
+    sfe_cen[index,:] = binned.medians(np.log10(mmol[ind]/sfr[ind]))
 
-    ind = np.where((sfr_disk+sfr_burst > 0) & (typeg > 0) & (mdisk+mbulge > 0))
-    mainseq_sat[index,:] = bin_it(x=mass[ind], y=np.log10((sfr_disk[ind]+sfr_burst[ind])/(mdisk[ind]+mbulge[ind])))
-    mainseqsf_sat[index,:] = bin_it(x=mass[ind], y=np.log10((sfr_disk[ind]+sfr_burst[ind])/h0/GyrToYr))
-    sfe_sat[index,:] = bin_it(x=mass[ind], y=np.log10((mH2[ind]+mH2_bulge[ind])/(sfr_disk[ind]+sfr_burst[ind])))
+    ind = np.where((sfr > 0) & (typeg > 0) & (mstars > 0))
+    binned = stats.binned_statistics(mass[ind], xmf)
+    mainseq_sat[index,:] = binned.medians(log_ssfr[ind])
+    mainseqsf_sat[index,:] = binned.medians(log_sfr[ind])
+    sfe_sat[index,:] = binned.medians(np.log10(mmol[ind]/sfr[ind]))
 
     ind = np.where((mgas_metals > 0.0) & (mgas > 0))
     mzr[index,:] = bin_it(x=mass[ind], y=np.log10((mgas_metals[ind]/mgas[ind]/Zsun)))
 
     ind = np.where(mstars_metals_disk+mstars_metals_bulge > 0.0)
-    mszr[index,:] = bin_it(x=mass[ind], y=np.log10(((mstars_metals_disk[ind]+mstars_metals_bulge[ind])/(mdisk[ind]+mbulge[ind])/Zsun)))
+    mszr[index,:] = bin_it(x=mass[ind], y=np.log10(((mstars_metals_disk[ind]+mstars_metals_bulge[ind])/mstars[ind]/Zsun)))
 
-    ind = np.where((mgas_metals > 0.0) & (mgas > 0) & (sfr_disk+sfr_burst > 0))
-    fmzr[index,:] = bin_it(x=mass[ind]-0.66*np.log10((sfr_disk[ind]+sfr_burst[ind])/h0/GyrToYr),
+    ind = np.where((mgas_metals > 0.0) & (mgas > 0) & (sfr > 0))
+    fmzr[index,:] = bin_it(x=mass[ind]-0.66*log_sfr[ind],
                            y=np.log10((mgas_metals[ind]/mgas[ind]/Zsun)))
 
     ind = np.where((mgas_metals > 0.0) & (typeg == 0) & (mgas > 1e5))
     mzr_cen[index,:] = bin_it(x=mass[ind], y=np.log10((mgas_metals[ind]/mgas[ind]/Zsun)))
     ind = np.where((mstars_metals_disk+mstars_metals_bulge > 0.0) & (typeg == 0) )
-    mszr_cen[index,:] = bin_it(x=mass[ind], y=np.log10(((mstars_metals_disk[ind]+mstars_metals_bulge[ind])/(mdisk[ind]+mbulge[ind])/Zsun)))
+    mszr_cen[index,:] = bin_it(x=mass[ind], y=np.log10(((mstars_metals_disk[ind]+mstars_metals_bulge[ind])/mstars[ind]/Zsun)))
 
     ind = np.where((mgas_metals > 0.0) & (typeg > 0) & (mgas > 1e5) & (mass > 8))
     mzr_sat[index,:] = bin_it(x=mass[ind], y=np.log10((mgas_metals[ind]/mgas[ind]/Zsun)))
     ind = np.where((mstars_metals_disk+mstars_metals_bulge > 0.0) & (typeg > 0) & (mass > 8))
-    mszr_sat[index,:] = bin_it(x=mass[ind], y=np.log10(((mstars_metals_disk[ind]+mstars_metals_bulge[ind])/(mdisk[ind]+mbulge[ind])/Zsun)))
+    mszr_sat[index,:] = bin_it(x=mass[ind], y=np.log10(((mstars_metals_disk[ind]+mstars_metals_bulge[ind])/mstars[ind]/Zsun)))
 
-    ind = np.where((sfr_disk+sfr_burst > 0) & (mdisk+mbulge > 0) & ((sfr_disk+sfr_burst)/(mdisk+mbulge) > 1e-3))
-    mainseqsf[index,:] = bin_it_2sigma(x=mass[ind], y=np.log10((sfr_disk[ind]+sfr_burst[ind])/h0/GyrToYr))
-    mainseqsf_1s[index,:] = bin_it(x=mass[ind], y=np.log10((sfr_disk[ind]+sfr_burst[ind])/h0/GyrToYr))
-    mainseqHI[index,:] = bin_it(x=mass[ind], y=np.log10((mHI[ind]+mHI_bulge[ind])/(mdisk[ind]+mbulge[ind])))
-    mainseqH2[index,:] = bin_it(x=mass[ind], y=np.log10((mH2[ind]+mH2_bulge[ind])/(mdisk[ind]+mbulge[ind])))
+    ind = np.where((sfr > 0) & (mstars > 0) & (sfr/mstars > 1e-3))
+    binned = stats.binned_statistics(mass[ind], xmf)
+    mainseqsf[index,:] = binned.medians(log_sfr[ind], percentiles=(0.025, 0.975))
+    mainseqsf_1s[index,:] = binned.medians(log_sfr[ind])
+    mainseqHI[index,:] = binned.medians(np.log10(matom[ind]/mstars[ind]))
+    mainseqH2[index,:] = binned.medians(np.log10(mmol[ind]/mstars[ind]))
 
     if volh > 0:
-        vol = volh/pow(h0,3.)  # In Mpc^3
-        hist_smf[index,:]  = hist_smf[index,:]/vol/dm
-        hist_smf_30kpc[index,:]= hist_smf_30kpc[index,:]/vol/dm
-        hist_smf_err[index,:]  = hist_smf_err[index,:]/vol/dm
-        hist_smf_cen[index,:]  = hist_smf_cen[index,:]/vol/dm
-        hist_smf_sat[index,:]  = hist_smf_sat[index,:]/vol/dm
-
-        hist_HImf[index,:] = hist_HImf[index,:]/vol/dm
-        hist_HImf_cen[index,:] = hist_HImf_cen[index,:]/vol/dm
-        hist_HImf_sat[index,:] = hist_HImf_sat[index,:]/vol/dm
-
-        hist_H2mf[index,:] = hist_H2mf[index,:]/vol/dm
-        hist_H2mf_cen[index,:] = hist_H2mf_cen[index,:]/vol/dm
-        hist_H2mf_sat[index,:] = hist_H2mf_sat[index,:]/vol/dm
-
         plotz[index]     = True
         plotz_HImf[index]= True
     else:
         plotz[index]     = False
         plotz_HImf[index]= False
 
-    return mass
+    # Individual star-forming galaxies, used for density contours
+    sfr_seq = np.zeros(shape = (2, len(mdisk)))
+    ind  = np.where((sfr > 0) & (mstars > 0))
+    sfr_seq[0,ind] = mass[ind]
+    sfr_seq[1,ind] = log_sfr[ind]
+
+    return h0, stats.sample(sfr_seq)
 
 def main(modeldir, outdir, redshift_table, subvols, obsdir):
 
@@ -1278,11 +1252,11 @@ def main(modeldir, outdir, redshift_table, subvols, obsdir):
     hist_smf_cen   = np.zeros(shape = (len(zlist), len(mbins)))
     hist_smf_sat   = np.zeros(shape = (len(zlist), len(mbins)))
 
-    plotz = np.empty(shape=(len(zlist)), dtype=np.bool_)
+    plotz = np.zeros(shape=(len(zlist)), dtype=np.bool_)
     hist_HImf = np.zeros(shape = (len(zlist), len(mbins)))
     hist_HImf_cen = np.zeros(shape = (len(zlist), len(mbins)))
     hist_HImf_sat = np.zeros(shape = (len(zlist), len(mbins)))
-    plotz_HImf = np.empty(shape=(len(zlist)), dtype=np.bool_)
+    plotz_HImf = np.zeros(shape=(len(zlist)), dtype=np.bool_)
     hist_H2mf = np.zeros(shape = (len(zlist), len(mbins)))
     hist_H2mf_cen = np.zeros(shape = (len(zlist), len(mbins)))
     hist_H2mf_sat = np.zeros(shape = (len(zlist), len(mbins)))
@@ -1294,25 +1268,18 @@ def main(modeldir, outdir, redshift_table, subvols, obsdir):
                            'matom_bulge', 'mmol_bulge', 'mgas_bulge',
                            'mgas_metals_disk', 'mgas_metals_bulge',
                            'mstars_metals_disk', 'mstars_metals_bulge', 'type', 
-			   'mvir_hosthalo', 'rstar_bulge')}
-
-    for index, snapshot in enumerate(redshift_table[zlist]):
-        hdf5_data = common.read_data(modeldir, snapshot, fields, subvols)
-        mass = prepare_data(hdf5_data, index, hist_smf, hist_smf_err, hist_smf_cen,
-                             hist_smf_sat, hist_smf_30kpc, hist_HImf, hist_HImf_cen, hist_HImf_sat,
-                             hist_H2mf, hist_H2mf_cen, hist_H2mf_sat, mainseq, mainseqsf,
-                             sfe, mainseq_cen, mainseqsf_cen, sfe_cen, mainseq_sat,
-                             mainseqsf_sat, sfe_sat, mzr, fmzr, mzr_cen, mzr_sat, plotz,
-                             plotz_HImf, passive_fractions, hist_ssfr, mszr, mszr_cen, 
-			     mszr_sat, mainseqsf_1s, mainseqHI, mainseqH2)
-
-        h0 = hdf5_data[0]
-        if index == 0:
-            (sfr_disk, sfr_burst, mdisk, mbulge) = hdf5_data[2:6]
-            sfr_seq = np.zeros(shape = (2, len(mdisk)))
-            ind  = np.where((sfr_disk + sfr_burst > 0) & (mdisk + mbulge > 0))
-            sfr_seq[0,ind] = mass[ind]
-            sfr_seq[1,ind] = np.log10((sfr_disk[ind] + sfr_burst[ind]) / h0 / GyrToYr)
+			   'mvir_hosthalo', 'rstar_bulge'),
+              'derived': ('mstars', 'sfr', 'mgas', 'matom', 'mmol', 'log_mstars', 'log_ssfr', 'log_sfr')}
+
+    outputs = (hist_smf, hist_smf_err, hist_smf_cen, hist_smf_sat, hist_smf_30kpc,
+               hist_HImf, hist_HImf_cen, hist_HImf_sat, hist_H2mf, hist_H2mf_cen, hist_H2mf_sat,
+               mainseq, mainseqsf, sfe, mainseq_cen, mainseqsf_cen, sfe_cen, mainseq_sat,
+               mainseqsf_sat, sfe_sat, mzr, fmzr, mzr_cen, mzr_sat, plotz, plotz_HImf,
+               passive_fractions, hist_ssfr, mszr, mszr_cen, mszr_sat, mainseqsf_1s,
+               mainseqHI, mainseqH2)
+    results = common.map_reduce_data(prepare_data, modeldir, redshift_table[zlist], fields, subvols, outputs)
+    h0 = results[-1][0]
+    sfr_seq = results[0][1]
 
 
     # This should be the same in all HDF5 files
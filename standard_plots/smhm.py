@@ -34,17 +34,17 @@ def prepare_data(hdf5_data, index, massgal, massbar, massbar_inside):
     OmegaM = 0.3121
 
     (h0, _, mdisk, mbulge, mBH, mgas, mgas_bulge, mhot,
-     mreheated, mhalo, typeg) = hdf5_data
+     mreheated, mhalo, typeg, mstars, log_mstars) = hdf5_data
      
-    ind = np.where((typeg <= 0) & (mdisk+mbulge > 0))
+    ind = np.where((typeg <= 0) & (mstars > 0))
     massgal[index,:] = us.wmedians(x=np.log10(mhalo[ind]) - np.log10(float(h0)),
-                                   y=np.log10(mdisk[ind]+mbulge[ind]) - np.log10(float(h0)),
+                                   y=log_mstars[ind],
                                    xbins=xmf)
     massbar[index,:] = us.wmedians(x=np.log10(mhalo[ind]) - np.log10(float(h0)),
-                                   y=np.log10(mdisk[ind]+mbulge[ind]+mBH[ind]+mgas[ind]+mgas_bulge[ind]+mhot[ind]+mreheated[ind]) - np.log10(mhalo[ind]) - np.log10(Omegab/(OmegaM-Omegab)),
+                                   y=np.log10(mstars[ind]+mBH[ind]+mgas[ind]+mgas_bulge[ind]+mhot[ind]+mreheated[ind]) - np.log10(mhalo[ind]) - np.log10(Omegab/(OmegaM-Omegab)),
                                    xbins=xmf)
     massbar_inside[index,:] = us.wmedians(x=np.log10(mhalo[ind]) - np.log10(float(h0)),
-                                   y=np.log10(mdisk[ind]+mbulge[ind]+mBH[ind]+mgas[ind]+mgas_bulge[ind]+mhot[ind]) - np.log10(mhalo[ind]) - np.log10(Omegab/(OmegaM-Omegab)),
+                                   y=np.log10(mstars[ind]+mBH[ind]+mgas[ind]+mgas_bulge[ind]+mhot[ind]) - np.log10(mhalo[ind]) - np.log10(Omegab/(OmegaM-Omegab)),
                                    xbins=xmf)
 
 
@@ -257,7 +257,8 @@ def main(modeldir, outdir, redshift_table, subvols):
     plt = common.load_matplotlib()
     fields = {'galaxies': ('mstars_disk', 'mstars_bulge', 'm_bh', 'mgas_disk',
                            'mgas_bulge', 'mhot', 'mreheated', 'mvir_hosthalo',
-                           'type')}
+                           'type'),
+              'derived': ('mstars', 'log_mstars')}
 
     zlist = (0, 0.5, 1, 2, 3, 4)
     snapshots = redshift_table[zlist]
@@ -20,122 +20,579 @@
 import numpy as np
 import scipy.optimize as so
 
-def wmedians_2sigma(x=None, y=None, xbins=None):
+# Random numbers used by the streaming summaries, kept apart from those of
+# np.random so that the plots' own random draws don't depend on them
+_random = np.random.RandomState(0)
+
+def _medians(n, has_nans, values_at, percentiles, low_numbers):
+    """wmedians-like results given the number of values in each bin, whether
+    any of them is NaN, and a function returning the values at the given
+    (0-based) ranks within the selected bins"""
 
-    nbins = len(xbins)
-    #define size of bins, assuming bins are all equally spaced.
-    dx = xbins[1] - xbins[0]
+    nbins = len(n)
     result = np.zeros(shape = (3, nbins))
 
-    for i in range (0,nbins):
-        xlow = xbins[i]-dx/2.0
-        xup  = xbins[i]+dx/2.0
-        ind  = np.where((x > xlow) & (x< xup))
-        if(len(x[ind]) > 9):
-
-            obj_bin = len(x[ind])
-            ybin    = y[ind]
-            result[0, i] = np.median(ybin)
-            #sort array on 1/y because we want it to sort from the smallest to the largest item, and the default of argsort is to order from the largest to the smallest.
-            IDs = np.argsort(ybin,kind='quicksort')
-            ID16th = int(np.floor(obj_bin*0.025))+1   #take the lower edge.
-            ID84th = int(np.floor(obj_bin*0.975))-1   #take the upper edge.
-            result[1, i] = np.abs(result[0, i] - ybin[IDs[ID16th]])
-            result[2, i] = np.abs(ybin[IDs[ID84th]] - result[0, i])
+    enough = n > 9
+    some = (n > 0) & ~enough if low_numbers else np.zeros(nbins, dtype=bool)
+    with_median = enough | some
+
+    # Medians average the two middle values for bins with an even count
+    nbin = n[with_median]
+    lower_mid = values_at(with_median, (nbin - 1) // 2)
+    upper_mid = values_at(with_median, nbin // 2)
+    median = np.where(nbin % 2 == 1, upper_mid, (lower_mid + upper_mid) / 2.0)
+    median[has_nans[with_median]] = np.nan
+    result[0, with_median] = median
+
+    # Percentiles take the lower/upper edges
+    nbin = n[enough]
+    median = result[0, enough]
+    low = values_at(enough, np.floor(nbin * percentiles[0]).astype(int) + 1)
+    high = values_at(enough, np.floor(nbin * percentiles[1]).astype(int) - 1)
+    result[1, enough] = np.abs(median - low)
+    result[2, enough] = np.abs(high - median)
+
+    # Minimum and maximum if there are not enough values
+    nbin = n[some]
+    median = result[0, some]
+    low = np.where(has_nans[some], np.nan, values_at(some, np.zeros_like(nbin)))
+    high = values_at(some, nbin - 1)
+    result[1, some] = np.abs(median - low)
+    result[2, some] = np.abs(high - median)
 
     return result
 
+def _sequential_sums(ys, starts, counts, initial=None, vectorised_length=32):
+    """Returns the sum of each ys[starts[i]:starts[i] + counts[i]] range,
+    starting from the `initial` sums if given.
+
+    Values are added one by one in their order, like in ``sum(range_values)``,
+    so results are identical to those of summing each range on its own with
+    the builtin sum (unlike those of np.add.reduceat or np.bincount, which
+    can differ by rounding errors). The first `vectorised_length` values are
+    added for all ranges at once, and the rest of each longer range with a
+    single np.add.accumulate"""
+    if initial is None:
+        result = np.zeros(shape = (len(counts)), dtype=ys.dtype)
+    else:
+        result = np.array(initial, dtype=np.result_type(initial, ys))
+    active = np.arange(len(counts))
+    max_count = counts.max() if len(counts) else 0
+    for k in range(min(vectorised_length, max_count)):
+        active = active[counts[active] > k]
+        result[active] += ys[starts[active] + k]
+    active = active[counts[active] > vectorised_length]
+    for i in active:
+        rest = ys[starts[i] + vectorised_length:starts[i] + counts[i]]
+        result[i] = np.add.accumulate(np.append(result[i:i + 1], rest))[-1]
+    return result
 
-def wmedians(x=None, y=None, xbins=None, low_numbers=False):
+class binned_statistics(object):
+    """Assigns x values to bins once, so that several statistics of y values
+    can then be calculated for all bins in a single pass.
+
+    As in wmedians & co., bins are centred on the `xbins` values, are assumed
+    to be equally spaced (by `dx`, defaulting to the distance between the
+    first two), and contain the x values strictly within them, or also those
+    on their upper limit if `right` is True.
+    x and y values can have any shape (e.g., the (1, n) arrays given by
+    indexing with the result of np.where), and are used flattened."""
+
+    def __init__(self, x, xbins, dx=None, right=False):
+
+        x = np.ravel(x)
+        xbins = np.asarray(xbins)
+        if dx is None:
+            dx = xbins[1] - xbins[0]
+        self.nbins = len(xbins)
+
+        # Each bin is a contiguous range of the sorted x values
+        order = np.argsort(x, kind='stable')
+        xsorted = x[order]
+        starts = np.searchsorted(xsorted, xbins - dx/2.0, side='right')
+        ends = np.searchsorted(xsorted, xbins + dx/2.0, side='right' if right else 'left')
+        self.counts = np.maximum(ends - starts, 0)
+        self.offsets = np.cumsum(self.counts) - self.counts
+
+        # The bin of each selected element, and its index on the original x
+        # array, keeping the original order within each bin.
+        # Rounding errors in the bin limits can make adjacent bins overlap,
+        # in which case the element is (correctly) selected in both
+        self.bin = np.repeat(np.arange(self.nbins), self.counts)
+        pos = np.arange(len(self.bin)) - np.repeat(self.offsets - starts, self.counts)
+        # (sorting a single integer key, which is much faster than lexsort)
+        index = order[pos]
+        key = np.sort(self.bin.astype(np.int64) * max(len(x), 1) + index)
+        self.index = key % max(len(x), 1)
+
+    def values(self, y):
+        """y values of the binned elements, grouped by bin"""
+        return np.ravel(y)[self.index]
+
+    def select(self, selected):
+        """Returns the binned_statistics of only the binned elements where
+        `selected` (an array like those returned by values) is True"""
+        b = binned_statistics.__new__(binned_statistics)
+        b.nbins = self.nbins
+        b.bin = self.bin[selected]
+        b.index = self.index[selected]
+        b.counts = np.bincount(b.bin, minlength=self.nbins)
+        b.offsets = np.cumsum(b.counts) - b.counts
+        return b
+
+    def _sorted_values(self, y):
+        """y values of each bin, sorted by (bin, y)"""
+        ys = self.values(y)
+        if not np.issubdtype(ys.dtype, np.floating):
+            ys = ys.astype(np.float64)
+        return ys[np.lexsort((ys, self.bin))]
+
+    def _split(self, values):
+        return np.split(values, self.offsets[1:])
+
+    def medians(self, y, percentiles=(0.16, 0.84), low_numbers=False):
+        """Returns the median of y in each bin, and its distance to the given
+        lower and upper percentiles. See wmedians for details"""
+
+        ys = self._sorted_values(y)
+        has_nans = np.bincount(self.bin, weights=np.isnan(ys), minlength=self.nbins) > 0
+        values_at = lambda which, ranks: ys[self.offsets[which] + ranks]
+        return _medians(self.counts, has_nans, values_at, percentiles, low_numbers)
+
+    def fractions(self, y, ythresh):
+        """Returns the fraction of y values above ythresh in each bin with
+        more than 9 values, -1 otherwise"""
+        nabove = np.bincount(self.bin, weights=(self.values(y) > ythresh), minlength=self.nbins)
+        enough = self.counts > 9
+        result = np.full(self.nbins, -1.0)
+        result[enough] = nabove[enough] / self.counts[enough]
+        return result
+
+    def _reduce(self, func, y):
+        # One call per bin, over its contiguous values: reductions like np.mean
+        # sum pairwise, which neither np.bincount nor np.add.reduceat reproduce
+        ys = self.values(y)
+        dtype = ys.dtype if np.issubdtype(ys.dtype, np.floating) else np.float64
+        result = np.zeros(shape = (self.nbins), dtype=dtype)
+        for i, ybin in enumerate(self._split(ys)):
+            if len(ybin):
+                result[i] = func(ybin)
+        return result
+
+    def means(self, y):
+        """Returns the mean of y in each bin, 0 for empty bins"""
+        return self._reduce(np.mean, y)
+
+    def stds(self, y):
+        """Returns the standard deviation of y in each bin, 0 for empty bins"""
+        return self._reduce(np.std, y)
+
+    def simple_medians(self, y):
+        """Returns the median of y in each bin, 0 for empty bins (unlike
+        medians, which needs more than 9 values per bin)"""
+        return self._reduce(np.median, y)
+
+    def sums(self, y, initial=None):
+        """Returns the sum of y in each bin (plus the initial sums, if given),
+        adding the values of each bin one by one in their original order
+        (see _sequential_sums)"""
+        return _sequential_sums(self.values(y), self.offsets, self.counts, initial)
+
+
+class grouped_statistics(object):
+    """Groups elements by their key, sorting them only once, so that several
+    per-group statistics of other values can then be calculated for all
+    groups at once (e.g., per-halo statistics of galaxies keyed by their
+    halo id).
+
+    Groups are sorted by key, and the elements within each group keep their
+    original order."""
+
+    def __init__(self, keys):
+
+        keys = np.ravel(keys)
+        self.order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[self.order]
+        is_start = np.ones(len(keys), dtype=bool)
+        is_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        self.starts = np.flatnonzero(is_start)
+        self.keys = sorted_keys[self.starts]
+        self.counts = np.diff(np.append(self.starts, len(keys)))
+        self.ngroups = len(self.keys)
+
+        # The group each element belongs to
+        self.group = np.empty(len(keys), dtype=np.intp)
+        self.group[self.order] = np.repeat(np.arange(self.ngroups), self.counts)
+
+    def index(self, keys):
+        """Returns the group index of each of the given (existing) keys"""
+        return np.searchsorted(self.keys, keys)
+
+    def _sorted_values(self, y):
+        return np.ravel(y)[self.order]
+
+    def sums(self, y):
+        """Returns the sum of y in each group, adding the values of each group
+        one by one in their original order (see _sequential_sums)"""
+        return _sequential_sums(self._sorted_values(y), self.starts, self.counts)
+
+    def means(self, y):
+        """Returns the mean of y in each group"""
+        return self.sums(y) / self.counts
+
+    def maxs(self, y):
+        """Returns the maximum of y in each group"""
+        return np.maximum.reduceat(self._sorted_values(y), self.starts) if self.ngroups else np.zeros(0)
+
+    def firsts(self, y):
+        """Returns the y value of the first element of each group"""
+        return np.ravel(y)[self.order[self.starts]]
+
+def histograms(x, edges, selections, nselections=None):
+    """Histograms of x (as computed by np.histogram with the given bin edges)
+    for several selections of its elements, all computed in a single pass.
+
+    `selections` is either a sequence of boolean masks, which can overlap, or
+    an integer array with the selection each element belongs to (negative
+    values belonging to none, and `nselections` defaulting to its maximum + 1).
+    Returns an array of shape (nselections, len(edges) - 1)."""
+
+    x = np.asarray(x)
+    edges = np.asarray(edges)
+    nbins = len(edges) - 1
+
+    # As in np.histogram, the last bin includes its right edge
+    valid = (x >= edges[0]) & (x <= edges[-1])
+    xbin = np.searchsorted(edges, x, side='right') - 1
+    xbin[x == edges[-1]] = nbins - 1
+
+    if isinstance(selections, np.ndarray) and np.issubdtype(selections.dtype, np.integer):
+        if nselections is None:
+            nselections = selections.max() + 1 if len(selections) else 0
+        valid &= (selections >= 0) & (selections < nselections)
+        counts = np.bincount(selections[valid] * nbins + xbin[valid], minlength=nselections * nbins)
+        return counts.reshape((nselections, nbins))
+
+    # Each element is labelled with the combination of masks it belongs to,
+    # giving a single 2-D bincount over (combination, bin), from which the
+    # histogram of each mask is the sum over the combinations including it
+    nmasks = len(selections)
+    if nmasks > 16:
+        raise ValueError('Too many selections for a single pass: %d' % nmasks)
+    combination = np.zeros(len(x), dtype=np.int64)
+    for i, mask in enumerate(selections):
+        combination |= np.asarray(mask, dtype=np.int64) << i
+    counts = np.bincount(combination[valid] * nbins + xbin[valid], minlength=(1 << nmasks) * nbins)
+    counts = counts.reshape((1 << nmasks, nbins))
+    combinations = np.arange(1 << nmasks)
+    return np.array([counts[(combinations >> i) & 1 == 1].sum(axis=0) for i in range(nmasks)], dtype=counts.dtype).reshape((nmasks, nbins))
 
-    nbins = len(xbins)
-    #define size of bins, assuming bins are all equally spaced.
-    dx = xbins[1] - xbins[0]
-    result = np.zeros(shape = (3, nbins))
+def wmedians_2sigma(x=None, y=None, xbins=None):
+    """Median of y in each x bin with more than 9 values, plus its distance
+    to the 2.5th and 97.5th percentiles"""
+    return binned_statistics(x, xbins).medians(y, percentiles=(0.025, 0.975))
 
-    for i in range (0,nbins):
-        xlow = xbins[i]-dx/2.0
-        xup  = xbins[i]+dx/2.0
-        ind  = np.where((x > xlow) & (x< xup))
-        if(len(x[ind]) > 9):
-
-            obj_bin = len(x[ind])
-            ybin    = y[ind]
-            result[0, i] = np.median(ybin)
-            #sort array on 1/y because we want it to sort from the smallest to the largest item, and the default of argsort is to order from the largest to the smallest.
-            IDs = np.argsort(ybin,kind='quicksort')
-            ID16th = int(np.floor(obj_bin*0.16))+1   #take the lower edge.
-            ID84th = int(np.floor(obj_bin*0.84))-1   #take the upper edge.
-            result[1, i] = np.abs(result[0, i] - ybin[IDs[ID16th]])
-            result[2, i] = np.abs(ybin[IDs[ID84th]] - result[0, i])
-        elif(low_numbers and len(x[ind]) > 0):
-            ybin    = y[ind]
-            result[0, i] = np.median(ybin)
-            result[1, i] = np.abs(result[0, i] - np.min(y[ind]))
-            result[2, i] = np.abs(np.max(y[ind]) - result[0, i])
 
-    return result
+def wmedians(x=None, y=None, xbins=None, low_numbers=False):
+    """Median of y in each x bin with more than 9 values, plus its distance
+    to the 16th and 84th percentiles. If low_numbers is True, bins with fewer
+    values give instead the distance to their minimum and maximum values"""
+    return binned_statistics(x, xbins).medians(y, low_numbers=low_numbers)
 
 def stacking(x=None, y=None, xbins=None, low_numbers=False):
 
-    nbins = len(xbins)
-    #define size of bins, assuming bins are all equally spaced.
-    dx = xbins[1] - xbins[0]
-    result = np.zeros(shape = (nbins))
-
-    for i in range (0,nbins):
-        xlow = xbins[i]-dx/2.0
-        xup  = xbins[i]+dx/2.0
-        ind  = np.where((x > xlow) & (x< xup))
-        if(len(x[ind]) > 0):
-            ybin    = y[ind]
-            result[i] = np.log10(np.mean(ybin))
-
+    b = binned_statistics(x, xbins)
+    result = np.zeros(shape = (b.nbins))
+    ind = np.where(b.counts > 0)
+    result[ind] = np.log10(b.means(y)[ind])
     return result
 
 
 def fractions(x=None, y=None, xbins=None, ythresh=None):
-
-    nbins = len(xbins)
-    #define size of bins, assuming bins are all equally spaced.
-    dx = xbins[1]-xbins[0]
-    result = np.zeros(shape = (nbins))
-
-    for i in range (0,nbins):
-        xlow = xbins[i]-dx/2.0
-        xup  = xbins[i]+dx/2.0
-        ind  = np.where((x > xlow) & (x< xup))
-        if(len(x[ind]) > 9):
-            ngalaxies = len(x[ind])
-            ybin      = y[ind]
-            above     = np.where(ybin > ythresh)
-            nabove    = len(ybin[above])
-            result[i] = (nabove+ 0.0)/(ngalaxies+0.0)
-        else:
-            result[i] = -1
-
-    return result
+    return binned_statistics(x, xbins).fractions(y, ythresh)
 
 def fractional_contribution(x=None, y=None, xbins=None):
 
-    nbins = len(xbins)
-    #define size of bins, assuming bins are all equally spaced.
-    dx = xbins[1]-xbins[0]
-    result = np.zeros(shape = (nbins))
-
-    for i in range (0,nbins):
-        xlow = xbins[i]-dx/2.0
-        xup  = xbins[i]+dx/2.0
-        ind  = np.where((x > xlow) & (x< xup))
-        if(len(x[ind]) > 4):
-            mtotal    = sum(x[ind])
-            mbulge_tot= sum(x[ind]*y[ind])
-            result[i] = mbulge_tot/mtotal
-        else:
-            result[i] = -1
-
+    x = np.ravel(x)
+    b = binned_statistics(x, xbins)
+    result = np.full(b.nbins, -1.0)
+    ind = np.where(b.counts > 4)
+    result[ind] = b.sums(x * y)[ind] / b.sums(x)[ind]
     return result
 
+def sample(values):
+    """Returns a sample of values (taken along their last axis) to be used
+    for e.g. density contours. When all data is available at once this is
+    the data itself; see streaming_statistics.sample for the chunked case"""
+    return values
+
+
+class quantile_sketch(object):
+    """Mergeable summary of a stream of values from which the value at any
+    given rank can be estimated, with memory bounded by ~3k values.
+
+    This is a KLL sketch (Karnin, Lang & Liberty 2016): values are kept in
+    levels, items on level h standing for 2**h values each. When a level
+    grows over its capacity it is sorted, and every other item (starting at
+    a random offset) is promoted to the next level, halving its size.
+
+    Ranks are exact until the sketch first compacts (i.e., for up to ~k
+    values). After that, the value returned for rank r has a true rank
+    within r +/- eps * n, where eps is about 1.7% for the default k=200 with
+    99% probability, and scales as 1/k. Merging sketches gives the same
+    guarantee as a single sketch fed with all their values."""
+
+    def __init__(self, k=200):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self._cdf = None
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                # An odd item out stays on this level
+                items = np.sort(items)
+                odd = len(items) % 2
+                promoted = items[odd + _random.randint(2)::2]
+                self.levels[level] = items[:odd]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+        self._cdf = None
+
+    def update(self, values):
+        """Adds the given values to the sketch"""
+        values = np.ravel(values).astype(np.float64)
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        """Adds the values summarised by other to this sketch"""
+        self.n += other.n
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self._compress()
+
+    def values_at(self, ranks):
+        """Returns the values at the given (0-based) ranks"""
+        if self._cdf is None:
+            items = np.concatenate(self.levels)
+            weights = np.concatenate([np.full(len(l), 2 ** h, dtype=np.int64) for h, l in enumerate(self.levels)])
+            order = np.argsort(items, kind='stable')
+            self._cdf = items[order], np.cumsum(weights[order])
+        items, cumulative = self._cdf
+        index = np.searchsorted(cumulative, ranks, side='right')
+        return items[np.minimum(index, len(items) - 1)]
+
+
+class binned_quantiles(object):
+    """Mergeable summary of the y values in each x bin, from which wmedians-like
+    results can be calculated without keeping all y values in memory, and
+    which can be updated chunk by chunk, and merged with others (e.g., from
+    other subvolumes or processes) with the same bins.
+
+    The y values of each bin are kept in a quantile_sketch, so medians and
+    percentiles are exact for bins with up to ~k values, and are otherwise
+    taken from values whose rank is off by at most ~1.7% of the number of
+    values in the bin (for the default k=200; see quantile_sketch).
+    The number of values in each bin, and thus which bins get a result, is
+    always exact. Results have the (3, nbins) layout of wmedians."""
+
+    def __init__(self, xbins, k=200):
+        self.xbins = np.array(xbins)
+        self.k = k
+        self.n = np.zeros(len(self.xbins), dtype=np.int64)
+        self.nans = np.zeros(len(self.xbins), dtype=np.int64)
+        self.sketches = [None] * len(self.xbins)
+
+    def update(self, x, y):
+        """Adds the y values of the given x values"""
+        self.update_binned(binned_statistics(x, self.xbins), y)
+
+    def update_binned(self, b, y):
+        """Adds the y values of the elements selected by the binned_statistics b"""
+        ys = b.values(y)
+        nan = np.isnan(ys)
+        self.n += b.counts
+        self.nans += np.bincount(b.bin[nan], minlength=len(self.n))
+        for i, ybin in enumerate(b._split(ys)):
+            ybin = ybin[~np.isnan(ybin)]
+            if len(ybin):
+                self._sketch(i).update(ybin)
+
+    def _sketch(self, i):
+        if self.sketches[i] is None:
+            self.sketches[i] = quantile_sketch(self.k)
+        return self.sketches[i]
+
+    def merge(self, other):
+        """Adds the values summarised by other, which must have the same bins"""
+        if not np.array_equal(self.xbins, other.xbins):
+            raise ValueError('Cannot merge binned_quantiles with different bins')
+        self.n += other.n
+        self.nans += other.nans
+        for i, sketch in enumerate(other.sketches):
+            if sketch is not None:
+                self._sketch(i).merge(sketch)
+
+    def _values_at(self, which, ranks):
+        values = [self.sketches[i].values_at(r) if self.sketches[i] is not None else np.nan
+                  for i, r in zip(np.flatnonzero(which), ranks)]
+        return np.array(values, dtype=np.float64)
+
+    def medians(self, percentiles=(0.16, 0.84), low_numbers=False):
+        """Returns the medians and percentile distances as wmedians does"""
+        return _medians(self.n, self.nans > 0, self._values_at, percentiles, low_numbers)
+
+
+class _random_sample(object):
+    """A uniform random sample of at most `size` values, which can be updated
+    with further values by keeping those with the smallest random keys"""
+
+    def __init__(self, size):
+        self.size = size
+        self.keys = None
+        self.values = None
+
+    def update(self, values):
+        values = np.asarray(values)
+        self._add(_random.random_sample(values.shape[-1]), values)
+
+    def merge(self, other):
+        if other.values is not None:
+            self._add(other.keys, other.values)
+
+    def _add(self, keys, values):
+        if self.values is not None:
+            keys = np.concatenate([self.keys, keys])
+            values = np.concatenate([self.values, values], axis=-1)
+        if len(keys) > self.size:
+            keep = np.argpartition(keys, self.size)[:self.size]
+            keys, values = keys[keep], values[..., keep]
+        self.keys, self.values = keys, values
+
+
+class _streaming_binned(object):
+    """The streaming_statistics version of a binned_statistics object"""
+
+    def __init__(self, stats, x, xbins):
+        self._stats = stats
+        self._binned = binned_statistics(x, xbins)
+        self._xbins = np.array(xbins)
+
+    def medians(self, y, percentiles=(0.16, 0.84), low_numbers=False):
+        b = self._binned
+        summary = self._stats._accumulator('medians', self._xbins, lambda: binned_quantiles(self._xbins))
+        summary.update_binned(b, y)
+        return summary.medians(percentiles, low_numbers)
+
+    def fractions(self, y, ythresh):
+        b = self._binned
+        n, nabove = self._stats._accumulator('fractions', self._xbins, lambda: np.zeros((2, b.nbins)))
+        n += b.counts
+        nabove += np.bincount(b.bin, weights=(b.values(y) > ythresh), minlength=b.nbins)
+        result = np.full(b.nbins, -1.0)
+        enough = n > 9
+        result[enough] = nabove[enough] / n[enough]
+        return result
+
+
+class streaming_statistics(object):
+    """Calculates the same statistics as the module-level functions of the
+    same name, but over data given in chunks (e.g., one subvolume at a time),
+    merging the partial results of each chunk with those of previous ones.
+
+    Callers must make the same sequence of calls on every chunk, calling
+    next_chunk() before each: the n-th call on a chunk is merged with the n-th
+    call on the previous ones, and returns the merged result so far.
+    Medians and percentiles are calculated using binned_quantiles, and are
+    thus approximate for bins with many values; everything else is
+    calculated from sums and counts."""
+
+    def __init__(self, sample_size=100000):
+        self.sample_size = sample_size
+        self._accumulators = []
+        self._next = 0
+
+    def next_chunk(self):
+        self._next = 0
+
+    def merge(self, other):
+        """Merges the statistics accumulated by other, which must have gone
+        through the same sequence of calls (e.g., on another subvolume)"""
+        if len(self._accumulators) != len(other._accumulators):
+            raise ValueError('Cannot merge statistics from different sequences of calls')
+        for (kind, xbins, acc), (other_kind, other_xbins, other_acc) in zip(self._accumulators, other._accumulators):
+            if kind != other_kind or not np.array_equal(xbins, other_xbins):
+                raise ValueError('Cannot merge statistics from different sequences of calls')
+            if isinstance(acc, np.ndarray):
+                acc += other_acc
+            else:
+                acc.merge(other_acc)
+
+    def _accumulator(self, kind, xbins, factory):
+        if self._next == len(self._accumulators):
+            self._accumulators.append((kind, xbins, factory()))
+        acc_kind, acc_xbins, acc = self._accumulators[self._next]
+        if acc_kind != kind or not np.array_equal(acc_xbins, xbins):
+            raise ValueError('Call #%d differs from that on previous chunks' % self._next)
+        self._next += 1
+        return acc
+
+    def binned_statistics(self, x, xbins):
+        return _streaming_binned(self, x, xbins)
+
+    def wmedians_2sigma(self, x=None, y=None, xbins=None):
+        return self.binned_statistics(x, xbins).medians(y, percentiles=(0.025, 0.975))
+
+    def wmedians(self, x=None, y=None, xbins=None, low_numbers=False):
+        return self.binned_statistics(x, xbins).medians(y, low_numbers=low_numbers)
+
+    def fractions(self, x=None, y=None, xbins=None, ythresh=None):
+        return self.binned_statistics(x, xbins).fractions(y, ythresh)
+
+    def stacking(self, x=None, y=None, xbins=None, low_numbers=False):
+        b = binned_statistics(x, xbins)
+        n, total = self._accumulator('stacking', np.array(xbins), lambda: np.zeros((2, b.nbins)))
+        n += b.counts
+        total += b.sums(y)
+        result = np.zeros(shape = (b.nbins))
+        ind = np.where(n > 0)
+        result[ind] = np.log10(total[ind] / n[ind])
+        return result
+
+    def fractional_contribution(self, x=None, y=None, xbins=None):
+        x = np.ravel(x)
+        b = binned_statistics(x, xbins)
+        n, xysum, xsum = self._accumulator('fractional_contribution', np.array(xbins), lambda: np.zeros((3, b.nbins)))
+        # Sums continue from those of previous chunks, so they are the same
+        # as those over the whole data set (when not merged)
+        n += b.counts
+        xysum[:] = b.sums(x * np.ravel(y), initial=xysum)
+        xsum[:] = b.sums(x, initial=xsum)
+        result = np.full(b.nbins, -1.0)
+        ind = np.where(n > 4)
+        result[ind] = xysum[ind] / xsum[ind]
+        return result
+
+    def sample(self, values):
+        """Returns a uniform random sample of at most sample_size of all the
+        values given so far (taken along their last axis)"""
+        acc = self._accumulator('sample', None, lambda: _random_sample(self.sample_size))
+        acc.update(values)
+        return acc.values
+
 
 
 def find_confidence_interval(x, pdf, confidence_level):